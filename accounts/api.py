@@ -1,88 +1,84 @@
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from django.db.models import Max
 from django.utils import timezone
-from datetime import datetime
 from .models import Notification
-from rides.models import Ride
-from django.urls import reverse
+from .utils import get_active_rides, get_notification_high_water, seed_notification_high_water
+from cabby.db_routers import use_read_replica
 
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def get_notifications(request):
-    """
-    Get user's notifications, optionally filtered by timestamp
-    """
-    # Check if we have a 'since' parameter to filter by timestamp
-    since_str = request.GET.get('since', None)
-    since_time = None
-    
-    if since_str:
-        try:
-            since_time = datetime.fromisoformat(since_str.replace('Z', '+00:00'))
-        except (ValueError, TypeError):
-            # If parsing fails, ignore the parameter
-            pass
-    
-    # Build notification query
-    notification_query = Notification.objects.filter(user=request.user)
-    
-    # Apply time filter if provided
-    if since_time:
-        notification_query = notification_query.filter(created_at__gt=since_time)
-    else:
-        # Without time filter, just get unread notifications
-        notification_query = notification_query.filter(is_read=False)
-    
-    # Get latest notifications
-    notifications = notification_query.order_by('-created_at')[:10]
-    
-    notification_data = [{
+# Most notifications returned by one poll; the client catches up over the
+# next polls when more are waiting
+PAGE_SIZE = 50
+
+
+def notification_data(notification):
+    return {
         'id': notification.id,
         'title': notification.title,
         'message': notification.message,
         'created_at': notification.created_at.isoformat(),
         'is_read': notification.is_read,
         'action_url': notification.action_url
-    } for notification in notifications]
-    
-    # Check if the user has any active ride for ride status updates
-    ride_updates = []
-    
-    if request.user.is_rider():
-        # Get active ride for rider
-        active_rides = Ride.objects.filter(
-            rider=request.user,
-            status__in=['REQUESTED', 'ACCEPTED', 'STARTED']
-        ).order_by('-created_at')
+    }
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@use_read_replica
+def get_notifications(request):
+    """
+    Get user's notifications newer than the after_id cursor, or the latest
+    unread ones without a cursor, plus their active rides.
+
+    The response's last_id is the cursor for the next poll. With a shared
+    cache (CACHE_URL), no notification query runs when the cached high-water
+    mark shows nothing newer than the cursor, and active rides come from a
+    cached snapshot; otherwise both are read from the database.
+    """
+    user_id = request.user.id
+    try:
+        after_id = int(request.GET['after_id'])
+    except (KeyError, ValueError):
+        after_id = None
+
+    version, high_water = get_notification_high_water(user_id)
+    if high_water is None:
+        # Read from the primary: a lagging replica could miss the newest
+        # notification, and the cached mark would then hide it
+        high_water = Notification.objects.using('default').filter(
+            user_id=user_id
+        ).aggregate(newest=Max('id'))['newest'] or 0
+        seed_notification_high_water(user_id, version, high_water)
+
+    notification_list = []
+    if after_id is None:
+        # First poll: show what's unread, and start the cursor at the newest
+        # notification so the next poll only returns new ones
+        notification_list = [
+            notification_data(notification)
+            for notification in Notification.objects.filter(
+                user_id=user_id,
+                is_read=False
+            ).order_by('-id')[:10]
+        ]
+        last_id = high_water
+    elif high_water > after_id:
+        notification_list = [
+            notification_data(notification)
+            for notification in Notification.objects.filter(
+                user_id=user_id,
+                id__gt=after_id
+            ).order_by('id')[:PAGE_SIZE]
+        ]
+        # Stay put if the replica hasn't caught up yet
+        last_id = notification_list[-1]['id'] if notification_list else after_id
     else:
-        # Get active ride for driver
-        active_rides = Ride.objects.filter(
-            driver=request.user,
-            status__in=['ACCEPTED', 'STARTED']
-        ).order_by('-created_at')
-    
-    # Format ride updates
-    for ride in active_rides:
-        status_messages = {
-            'REQUESTED': 'Waiting for driver',
-            'ACCEPTED': 'Driver is on the way',
-            'STARTED': 'Ride in progress',
-            'COMPLETED': 'Ride completed',
-            'CANCELLED': 'Ride cancelled'
-        }
-        
-        ride_updates.append({
-            'id': ride.id,
-            'status': ride.status,
-            'is_active': True,
-            'status_message': status_messages.get(ride.status, ride.status),
-            'detail_url': reverse('ride_detail', args=[ride.id])
-        })
-    
-    # Return both notifications and ride updates
+        last_id = after_id
+
     return Response({
-        'notifications': notification_data,
-        'ride_updates': ride_updates,
+        'notifications': notification_list,
+        'ride_updates': get_active_rides(request.user),
+        'last_id': last_id,
         'timestamp': timezone.now().isoformat()
-    })
\ No newline at end of file
+    })
@@ -1,14 +1,27 @@
 import json
+import logging
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from asgiref.sync import async_to_sync
 from accounts.models import Notification
+from accounts.presence import presence
+from accounts.replay import replay_buffer
+from accounts.utils import get_unread_notifications
+from cabby.tracing import tracer
 from rides.models import Ride
 from django.contrib.auth.models import AnonymousUser
 
+logger = logging.getLogger(__name__)
+
 User = get_user_model()
 
+# Traced messages a socket may have unacknowledged at once
+MAX_PENDING_ACKS = 100
+
 class NotificationConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for handling real-time notifications.
@@ -20,8 +33,10 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         Handles the connection logic for the WebSocket consumer.
         Joins the user to a personal notification group.
         """
-        # Get user from scope (set by AuthMiddlewareStack)
+        # Get user from scope (set by CachedAuthMiddlewareStack)
         self.user = self.scope.get('user', None)
+        # Send times of traced messages awaiting the client's ack, by span id
+        self.pending_acks = OrderedDict()
         
         # Anonymous users can still connect but won't get authenticated notifications
         if self.user and self.user.is_authenticated:
@@ -36,31 +51,35 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             # Accept the connection
             await self.accept()
             
+            # A reconnecting client sends the last sequence number it saw;
+            # replay only what it missed from the in-memory buffer
+            missed_events = self.get_missed_events()
+            
             # Send a connection status message
             await self.send(text_data=json.dumps({
                 'type': 'connection_status',
                 'status': 'connected',
-                'message': 'Successfully connected to notification channel'
+                'message': 'Successfully connected to notification channel',
+                'seq': replay_buffer.current_seq(self.user.id),
+                'epoch': replay_buffer.epoch,
+                'replay': missed_events is not None
             }))
             
-            print(f"User {self.user.id} connected to notification channel")
+            logger.info('Notification socket connected', extra={'user_id': self.user.id})
             
-            # Send any unread notifications on connect
+            if missed_events is not None:
+                for event in missed_events:
+                    await getattr(self, event['type'])(event)
+                return
+            
+            # Send any unread notifications on connect, or when the replay
+            # buffer has been overrun
             unread_notifications = await self.get_unread_notifications()
             
-            if unread_notifications.exists():
+            if unread_notifications:
                 await self.send(text_data=json.dumps({
                     'type': 'unread_notifications',
-                    'notifications': [
-                        {
-                            'id': notification.id,
-                            'title': notification.title,
-                            'message': notification.message,
-                            'created_at': notification.created_at.isoformat(),
-                            'is_read': notification.is_read
-                        }
-                        for notification in unread_notifications
-                    ]
+                    'notifications': unread_notifications
                 }))
         else:
             # Accept connection for anonymous users too, but with a warning
@@ -73,7 +92,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 'message': 'Connected without authentication. Some notifications may not be received.'
             }))
             
-            print("Anonymous user connected to notification channel")
+            logger.info('Anonymous notification socket connected')
 
     async def disconnect(self, close_code):
         """
@@ -86,7 +105,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
             
-            print(f"User disconnected from notification channel, code: {close_code}")
+            logger.info('Notification socket disconnected', extra={'user_id': self.user.id, 'code': close_code})
 
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -97,6 +116,10 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type', '')
         
+        # Heartbeats and pings keep an online driver from expiring
+        if message_type in ('heartbeat', 'ping'):
+            await self.touch_presence()
+        
         # Handle heartbeat to keep connection alive
         if message_type == 'heartbeat':
             await self.send(text_data=json.dumps({
@@ -115,6 +138,16 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 'type': 'pong',
                 'timestamp': text_data_json.get('timestamp')
             }))
+        
+        # The client acknowledges a traced event once it has handled it,
+        # closing the trace from the HTTP request to the browser
+        elif message_type == 'trace_ack':
+            self.record_trace_ack(text_data_json)
+
+    async def touch_presence(self):
+        if self.user and self.user.is_authenticated and self.user.is_driver():
+            # touch() loads the registry from the database on first use
+            await database_sync_to_async(presence.touch)(self.user.id)
 
     # Receive message from room group
     async def notification_message(self, event):
@@ -122,31 +155,85 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         Receive notification from group and forward to WebSocket.
         """
         # Send message to WebSocket
-        await self.send(text_data=json.dumps(event))
+        await self.send_traced(event, 'consumer.notification_message', dict(event))
 
     async def ride_status_update(self, event):
         """
         Receive ride status update from group and forward to WebSocket.
         """
-        await self.send(text_data=json.dumps({
+        await self.send_traced(event, 'consumer.ride_status_update', {
             'type': 'ride_status_update',
             'ride_id': event['ride_id'],
             'status': event['status'],
             'driver_id': event.get('driver_id'),
             'driver_name': event.get('driver_name'),
             'message': event['message'],
-            'redirect_url': event.get('redirect_url')
-        }))
+            'redirect_url': event.get('redirect_url'),
+            'seq': event.get('seq'),
+            'epoch': event.get('epoch')
+        })
+
+    async def demand_hint(self, event):
+        """
+        Receive a repositioning hint for a driver and forward it to WebSocket.
+        """
+        await self.send_traced(event, 'consumer.demand_hint', {
+            'type': 'demand_hint',
+            'lat': event['lat'],
+            'lng': event['lng'],
+            'distance_km': event['distance_km'],
+            'expected_requests': event['expected_requests'],
+            'horizon_minutes': event['horizon_minutes'],
+            'message': event['message']
+        })
+
+    async def send_traced(self, event, name, message):
+        """
+        Send message to the socket inside the trace event carries, if any.
+        The message then carries its own trace context and send time for
+        the client to acknowledge.
+        """
+        with tracer.continue_trace(event, name, user_id=self.user.id):
+            with tracer.span('websocket.send') as span:
+                message.pop('trace', None)
+                if span is not None:
+                    message['trace'] = {**span.context(), 'sent_at': span.start}
+                    self.pending_acks[span.span_id] = span.start
+                    while len(self.pending_acks) > MAX_PENDING_ACKS:
+                        self.pending_acks.popitem(last=False)
+                await self.send(text_data=json.dumps(message))
+
+    def record_trace_ack(self, data):
+        # Only the first ack of a traced message this socket was sent counts,
+        # timed from when it was sent, so clients can't add spans of their own
+        trace = data.get('trace')
+        if not isinstance(trace, dict) or not isinstance(trace.get('span_id'), str):
+            return
+        sent_at = self.pending_acks.pop(trace['span_id'], None)
+        if sent_at is not None and time.time() - sent_at <= 60:
+            tracer.record(data, 'client.ack', sent_at, user_id=self.user.id)
+
+    def get_missed_events(self):
+        """
+        Get the buffered events after the client's last_seq.
+        Returns None when the client sent no cursor or the buffer can't
+        cover the gap, in which case unread notifications come from the DB.
+        """
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            last_seq = int(params['last_seq'][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+        
+        epoch = params.get('epoch', [None])[0]
+        return replay_buffer.since(self.user.id, last_seq, epoch)
 
     @database_sync_to_async
     def get_unread_notifications(self):
         """
-        Get unread notifications for the user.
+        Get unread notifications for the user, cached between connects.
         """
-        return Notification.objects.filter(
-            user=self.user,
-            is_read=False
-        ).order_by('-created_at')[:5]
+        return get_unread_notifications(self.user.id)
 
     async def mark_notification_read(self, notification_id):
         """
@@ -1,5 +1,6 @@
 from django.conf import settings
 from .models import Notification
+from .presence import presence
 
 def notifications(request):
     """
@@ -25,7 +26,7 @@ def user_status(request):
         'is_available': False
     }
     
-    if request.user.is_authenticated and hasattr(request.user, 'driver_profile'):
-        context['is_available'] = request.user.driver_profile.is_available
+    if request.user.is_authenticated and request.user.is_driver():
+        context['is_available'] = presence.is_online(request.user.id)
     
     return context 
\ No newline at end of file
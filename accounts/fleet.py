@@ -0,0 +1,349 @@
+import fcntl
+import logging
+import math
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Header of the segment: layout version, seqlock counter, driver count and
+# capacity, as int64s
+MAGIC = 0x464C4545540001
+HEADER = 4
+
+# One array per field, laid out back to back after the header
+FIELDS = (
+    ('driver_id', np.int64),
+    ('lat', np.float64),
+    ('lng', np.float64),
+    ('last_seen', np.float64),
+    ('available', np.uint8),
+    ('vehicle_type', np.uint8),
+)
+
+# Readers retry this many times while a write is in progress before
+# taking the write lock themselves
+READ_ATTEMPTS = 100
+
+
+def vehicle_types():
+    """Vehicle types by their code in the segment; 0 is unknown."""
+    return ('',) + tuple(sorted(settings.FARE_TARIFFS))
+
+
+class FleetView:
+    """
+    The fleet arrays, sliced to the drivers in use. The arrays are views of
+    the shared segment, not copies: only use them inside FleetState.read().
+    """
+
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+    def __init__(self, arrays, count):
+        for name, _ in FIELDS:
+            setattr(self, name, arrays[name][:count])
+
+
+class FleetState:
+    """
+    Driver positions and availability shared by every worker process on
+    the host, as parallel arrays in a shared memory segment.
+
+    Writes are serialized across processes with a lock file and bump a
+    sequence counter before and after (a seqlock). Readers take no lock:
+    they run their query on views of the arrays and retry if the counter
+    was odd or changed meanwhile, so a request never waits on another
+    process and never deserializes anything.
+
+    A driver keeps their slot once given one. Drivers count as online while
+    available and heard from within timeout seconds, so a worker that stops
+    hearing from a driver needn't be the one that takes them offline.
+    """
+
+    def __init__(self, name, capacity, timeout, lock_path):
+        self.name = name
+        self.capacity = capacity
+        self.timeout = timeout
+        self.lock_path = lock_path
+        self.codes = {vehicle_type: code for code, vehicle_type in enumerate(vehicle_types())}
+        self._shm = None
+        self._header = None
+        self._arrays = None
+        self._lock_file = None
+        self._slots = {}  # driver_id -> slot hint, checked before use
+        self._lock = threading.Lock()
+
+    # Segment
+
+    def _segment_size(self):
+        return HEADER * 8 + sum(np.dtype(dtype).itemsize * self.capacity for _, dtype in FIELDS)
+
+    def _attach(self):
+        if self._arrays is not None:
+            return
+        with self._lock:
+            if self._arrays is not None:
+                return
+            lock_file = open(self.lock_path, 'a+b')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    shm = shared_memory.SharedMemory(self.name)
+                    created = False
+                except FileNotFoundError:
+                    shm = shared_memory.SharedMemory(self.name, create=True, size=self._segment_size())
+                    created = True
+                # The segment outlives this process; don't let the resource
+                # tracker unlink it when the process exits
+                resource_tracker.unregister(shm._name, 'shared_memory')
+
+                header = np.ndarray(HEADER, dtype=np.int64, buffer=shm.buf)
+                if created:
+                    header[:] = (MAGIC, 0, 0, self.capacity)
+                elif header[0] != MAGIC:
+                    shm.close()
+                    raise RuntimeError(f'Shared memory segment {self.name} has an unknown layout')
+                capacity = int(header[3])
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            arrays = {}
+            offset = HEADER * 8
+            for name, dtype in FIELDS:
+                arrays[name] = np.ndarray(capacity, dtype=dtype, buffer=shm.buf, offset=offset)
+                offset += np.dtype(dtype).itemsize * capacity
+            self.capacity = capacity
+            self._shm, self._header, self._lock_file = shm, header, lock_file
+            self._arrays = arrays
+
+    def close(self):
+        """Detach from the segment; it stays for the other processes."""
+        with self._lock:
+            if self._shm is not None:
+                self._header = self._arrays = None
+                self._shm.close()
+                self._lock_file.close()
+                self._shm = self._lock_file = None
+                self._slots.clear()
+
+    def unlink(self):
+        """Remove the segment for every process; for tests and shutdown."""
+        self._attach()
+        # unlink() unregisters the segment from the resource tracker itself
+        resource_tracker.register(self._shm._name, 'shared_memory')
+        self._shm.unlink()
+        self.close()
+
+    # Writes
+
+    def _write(self, apply):
+        self._attach()
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._header[1] += 1
+                try:
+                    return apply()
+                finally:
+                    self._header[1] += 1
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _slot(self, driver_id, create):
+        """Slot of a driver, under the write lock; adds them if create."""
+        ids = self._arrays['driver_id']
+        count = int(self._header[2])
+        slot = self._slots.get(driver_id)
+        if slot is not None and slot < count and ids[slot] == driver_id:
+            return slot
+        found = np.flatnonzero(ids[:count] == driver_id)
+        if len(found):
+            slot = int(found[0])
+        elif not create:
+            return None
+        elif count < self.capacity:
+            slot = count
+            self._header[2] = count + 1
+            ids[slot] = driver_id
+            self._arrays['lat'][slot] = self._arrays['lng'][slot] = math.nan
+            self._arrays['available'][slot] = 0
+            self._arrays['vehicle_type'][slot] = 0
+        else:
+            # Full: reuse the slot of a driver who is offline
+            idle = np.flatnonzero(
+                (self._arrays['available'] == 0)
+                | (self._arrays['last_seen'] < time.time() - self.timeout)
+            )
+            if not len(idle):
+                logger.warning('Fleet state is full', extra={'capacity': self.capacity})
+                return None
+            slot = int(idle[0])
+            self._slots.pop(int(ids[slot]), None)
+            ids[slot] = driver_id
+            self._arrays['lat'][slot] = self._arrays['lng'][slot] = math.nan
+            self._arrays['available'][slot] = 0
+            self._arrays['vehicle_type'][slot] = 0
+        self._slots[driver_id] = slot
+        return slot
+
+    def update(self, driver_id, lat=None, lng=None, available=None, vehicle_type=None, seen=True):
+        """
+        Record a driver's position, availability or vehicle type; fields
+        left as None keep their value. seen marks them as heard from now.
+        """
+        def apply():
+            slot = self._slot(driver_id, create=True)
+            if slot is None:
+                return
+            if lat is not None and lng is not None:
+                self._arrays['lat'][slot] = float(lat)
+                self._arrays['lng'][slot] = float(lng)
+            if available is not None:
+                self._arrays['available'][slot] = 1 if available else 0
+            if vehicle_type is not None:
+                self._arrays['vehicle_type'][slot] = self.codes.get(vehicle_type, 0)
+            if seen:
+                self._arrays['last_seen'][slot] = time.time()
+        self._write(apply)
+
+    def seed(self, drivers):
+        """
+        Add available drivers as (driver_id, lat, lng, vehicle_type), leaving
+        alone any driver already present: another worker knows better.
+        """
+        def apply():
+            now = time.time()
+            for driver_id, lat, lng, vehicle_type in drivers:
+                if self._slot(driver_id, create=False) is not None:
+                    continue
+                slot = self._slot(driver_id, create=True)
+                if slot is None:
+                    return
+                if lat is not None and lng is not None:
+                    self._arrays['lat'][slot] = float(lat)
+                    self._arrays['lng'][slot] = float(lng)
+                self._arrays['available'][slot] = 1
+                self._arrays['vehicle_type'][slot] = self.codes.get(vehicle_type, 0)
+                self._arrays['last_seen'][slot] = now
+        self._write(apply)
+
+    def clear(self):
+        """Forget every driver, in every process."""
+        def apply():
+            self._header[2] = 0
+            self._slots.clear()
+        self._write(apply)
+
+    # Reads
+
+    def read(self, query):
+        """
+        Run query(view) on a consistent view of the arrays and return its
+        result, which must not hold on to the view.
+        """
+        self._attach()
+        header = self._header
+        for _ in range(READ_ATTEMPTS):
+            version = int(header[1])
+            if version & 1:
+                continue
+            result = query(FleetView(self._arrays, int(header[2])))
+            if int(header[1]) == version:
+                return result
+        # A writer kept us out; wait our turn instead
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+            try:
+                return query(FleetView(self._arrays, int(header[2])))
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _online(self, view, now):
+        return (view.available == 1) & (view.last_seen >= now - self.timeout)
+
+    def online_drivers(self, vehicle_type=None):
+        """(driver_id, lat, lng) for every online driver with a known position."""
+        now = time.time()
+        code = self.codes.get(vehicle_type) if vehicle_type else None
+
+        def query(view):
+            mask = self._online(view, now) & ~np.isnan(view.lat)
+            if code is not None:
+                mask &= view.vehicle_type == code
+            return view.driver_id[mask], view.lat[mask], view.lng[mask]
+        ids, lats, lngs = self.read(query)
+        return list(zip(ids.tolist(), lats.tolist(), lngs.tolist()))
+
+    def within(self, lat, lng, radius_km, vehicle_type=None):
+        """
+        (driver_id, lat, lng) for online drivers in the box around a point
+        covering radius_km. Callers rank by exact distance.
+        """
+        now = time.time()
+        lat, lng = float(lat), float(lng)
+        lat_span = radius_km / 110.574
+        lng_span = radius_km / (111.320 * max(math.cos(math.radians(lat)), 0.01))
+        code = self.codes.get(vehicle_type) if vehicle_type else None
+
+        def query(view):
+            # NaN positions compare False, so drivers without one drop out
+            mask = (
+                self._online(view, now)
+                & (np.abs(view.lat - lat) <= lat_span)
+                & (np.abs(view.lng - lng) <= lng_span)
+            )
+            if code is not None:
+                mask &= view.vehicle_type == code
+            return view.driver_id[mask], view.lat[mask], view.lng[mask]
+        ids, lats, lngs = self.read(query)
+        return list(zip(ids.tolist(), lats.tolist(), lngs.tolist()))
+
+    def driver(self, driver_id):
+        """
+        (online, position) of a driver; position is (lat, lng) or None when
+        unknown.
+        """
+        now = time.time()
+
+        def query(view):
+            slot = self._slots.get(driver_id)
+            if slot is None or slot >= len(view.driver_id) or view.driver_id[slot] != driver_id:
+                found = np.flatnonzero(view.driver_id == driver_id)
+                if not len(found):
+                    return False, None
+                slot = int(found[0])
+            online = bool(view.available[slot]) and view.last_seen[slot] >= now - self.timeout
+            lat, lng = float(view.lat[slot]), float(view.lng[slot])
+            return online, None if math.isnan(lat) else (lat, lng)
+        return self.read(query)
+
+    def is_online(self, driver_id):
+        return self.driver(driver_id)[0]
+
+    def position(self, driver_id):
+        """Last known (lat, lng) of an online driver, or None."""
+        online, position = self.driver(driver_id)
+        return position if online else None
+
+    def snapshot(self):
+        """
+        A consistent copy of the online drivers as a dict of arrays, for
+        callers that keep the data past one query.
+        """
+        now = time.time()
+
+        def query(view):
+            mask = self._online(view, now)
+            return {name: getattr(view, name)[mask] for name, _ in FIELDS}
+        return self.read(query)
+
+
+fleet = FleetState(
+    settings.FLEET_SHM_NAME,
+    capacity=settings.FLEET_CAPACITY,
+    timeout=settings.PRESENCE_TIMEOUT_SECONDS,
+    lock_path=settings.FLEET_LOCK_PATH,
+) if settings.FLEET_SHM_NAME else None
@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from cabby.db_routers import lag_monitor
+
+class Command(BaseCommand):
+    help = 'Measure read-replica lag with a heartbeat so lagging replicas stop receiving reads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.REPLICA_LAG_CHECK_SECONDS,
+            help='Seconds between checks',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single check and exit',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No read replicas configured (set DB_REPLICAS)')
+        if not settings.SHARED_CACHE:
+            raise CommandError('Lag is reported to the servers through the cache (set CACHE_URL)')
+
+        while True:
+            for alias, lag in lag_monitor.check().items():
+                if lag is None:
+                    self.stdout.write(self.style.ERROR(f'{alias}: unreachable or not replicating'))
+                elif lag > settings.REPLICA_MAX_LAG_SECONDS:
+                    self.stdout.write(self.style.WARNING(f'{alias}: lag {lag:.2f}s, removed from reads'))
+                else:
+                    self.stdout.write(f'{alias}: lag {lag:.2f}s')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,47 @@
+import sqlite3
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database into SQLite replica files, standing in for replication locally'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Seconds between copies; the replicas lag the primary by up to this much',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Copy once and exit',
+        )
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('syncreplicas only works with SQLite; use database replication otherwise')
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No read replicas configured (set DB_REPLICAS)')
+
+        while True:
+            self.sync()
+            if options['once']:
+                return
+            time.sleep(options['interval'])
+
+    def sync(self):
+        primary = sqlite3.connect(settings.DATABASES['default']['NAME'])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                replica = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+                try:
+                    # Online backup gives the replica a consistent snapshot
+                    primary.backup(replica)
+                finally:
+                    replica.close()
+                self.stdout.write(f'Copied primary to {alias}')
+        finally:
+            primary.close()
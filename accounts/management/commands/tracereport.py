@@ -0,0 +1,54 @@
+import json
+from collections import defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from cabby.tracing import summarize
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Command(BaseCommand):
+    help = 'Summarize end-to-end latency of the traces in the JSON-lines trace file'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            default=settings.TRACE_FILE,
+            help='JSON-lines file the spans were exported to',
+        )
+        parser.add_argument(
+            '--name',
+            default='',
+            help='Only traces whose root span name contains this, e.g. "accept-ajax"',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['file']) as spans:
+                summaries = summarize(json.loads(line) for line in spans if line.strip())
+        except FileNotFoundError:
+            raise CommandError(f"No trace file at {options['file']}")
+
+        by_name = defaultdict(list)
+        for summary in summaries:
+            if options['name'] in summary['name']:
+                by_name[summary['name']].append(summary)
+
+        for name, traces in sorted(by_name.items()):
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name} ({len(traces)} traces)'))
+            self.report('server total', [trace['total_ms'] for trace in traces])
+            self.report('delivered', [trace['delivered_ms'] for trace in traces if trace['delivered_ms'] is not None])
+            span_names = sorted({span_name for trace in traces for span_name in trace['spans_ms']})
+            for span_name in span_names:
+                self.report(f'  {span_name}', [trace['spans_ms'][span_name] for trace in traces if span_name in trace['spans_ms']])
+
+    def report(self, label, values):
+        if not values:
+            return
+        self.stdout.write(
+            f'{label:<36} p50 {percentile(values, 0.5):9.1f} ms   '
+            f'p95 {percentile(values, 0.95):9.1f} ms   max {max(values):9.1f} ms'
+        )
@@ -0,0 +1,102 @@
+import hashlib
+from channels.auth import AuthMiddleware, get_user
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from .models import User
+
+# Columns kept in the cached user snapshot, in model order as from_db()
+# expects; anything else is loaded on first access, like a deferred field
+SNAPSHOT_FIELDS = tuple(
+    field.attname for field in User._meta.concrete_fields
+    if field.attname in ('id', 'username', 'role', 'first_name', 'last_name',
+                         'is_active', 'is_staff', 'is_superuser')
+)
+# User fields whose change makes cached snapshots stale
+INVALIDATING_FIELDS = frozenset(SNAPSHOT_FIELDS) | {'password'}
+
+
+def session_cache_key(session_key):
+    # Session keys are credentials; keep them out of the cache's key space
+    return f'ws_auth:{hashlib.sha256(session_key.encode()).hexdigest()}'
+
+
+def user_version_key(user_id):
+    return f'ws_auth_version:{user_id}'
+
+
+def invalidate_session(session_key):
+    """Drop the cached user for a session, e.g. on logout."""
+    if session_key:
+        cache.delete(session_cache_key(session_key))
+
+
+def invalidate_user(user_id):
+    """Make every cached snapshot of a user stale, whichever session holds it."""
+    key = user_version_key(user_id)
+    cache.add(key, 0, None)
+    cache.incr(key)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """
+    Channels AuthMiddleware that resolves the session to a cached user.
+
+    On a hit the user is rebuilt from a snapshot of SNAPSHOT_FIELDS as a
+    User instance with its other fields deferred, so the connect makes no
+    session or user queries. Entries expire after WS_AUTH_CACHE_TTL (or
+    when the session does), on logout, and when any snapshot field or the
+    password changes.
+
+    Logouts and user changes happen in the HTTP workers, so the snapshot is
+    only used with SHARED_CACHE; otherwise every connect loads the user.
+    """
+
+    async def resolve_scope(self, scope):
+        scope['user']._wrapped = await self.get_cached_user(scope)
+
+    async def get_cached_user(self, scope):
+        if not settings.SHARED_CACHE:
+            return await get_user(scope)
+        session_key = scope['session'].session_key
+        if not session_key:
+            return AnonymousUser()
+
+        key = session_cache_key(session_key)
+        entry = await cache.aget(key)
+        if entry is not None:
+            version = await cache.aget(user_version_key(entry['id']), 0)
+            if version == entry['version']:
+                return User.from_db('default', SNAPSHOT_FIELDS, entry['values'])
+
+        # Read the version before the user so a change made while we load
+        # leaves the entry stale rather than current
+        user_id = await self.get_session_user_id(scope)
+        if user_id is None:
+            return AnonymousUser()
+        version = await cache.aget(user_version_key(user_id), 0)
+        user = await get_user(scope)
+        if not user.is_authenticated or user.id != user_id:
+            return user
+        timeout = min(settings.WS_AUTH_CACHE_TTL, scope['session'].get_expiry_age())
+        await cache.aset(key, {
+            'id': user.id,
+            'version': version,
+            'values': [getattr(user, field) for field in SNAPSHOT_FIELDS],
+        }, timeout)
+        return user
+
+    @staticmethod
+    @database_sync_to_async
+    def get_session_user_id(scope):
+        try:
+            return User._meta.pk.to_python(scope['session'][SESSION_KEY])
+        except KeyError:
+            return None
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
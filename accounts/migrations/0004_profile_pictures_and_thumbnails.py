@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-19 19:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_replicaheartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driverprofile',
+            name='insurance_thumbnail',
+            field=models.ImageField(blank=True, upload_to='thumbnails/'),
+        ),
+        migrations.AddField(
+            model_name='driverprofile',
+            name='license_thumbnail',
+            field=models.ImageField(blank=True, upload_to='thumbnails/'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='profile_picture',
+            field=models.ImageField(blank=True, upload_to='avatars/'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='profile_picture_thumbnail',
+            field=models.ImageField(blank=True, upload_to='thumbnails/'),
+        ),
+    ]
@@ -1,6 +1,8 @@
+import os
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.core.validators import RegexValidator
+from django.urls import reverse
 
 class User(AbstractUser):
     ROLE_CHOICES = (
@@ -16,6 +18,9 @@ class User(AbstractUser):
     )
     phone_number = models.CharField(validators=[phone_regex], max_length=17, blank=True)
     is_verified = models.BooleanField(default=False)
+    profile_picture = models.ImageField(upload_to='avatars/', blank=True)
+    # Filled in by the thumbnail worker once the picture has been resized
+    profile_picture_thumbnail = models.ImageField(upload_to='thumbnails/', blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -37,6 +42,12 @@ class User(AbstractUser):
         elif self.username:
             return f"{self.username[0]}".upper()
         return "?"
+    
+    def get_avatar_url(self):
+        """Return the profile picture thumbnail URL, or None until one exists"""
+        if self.profile_picture_thumbnail:
+            return reverse('thumbnail', args=[os.path.basename(self.profile_picture_thumbnail.name)])
+        return None
 
 class DriverProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='driver_profile')
@@ -45,6 +56,8 @@ class DriverProfile(models.Model):
     license_number = models.CharField(max_length=50)
     license_document = models.FileField(upload_to='documents/licenses/')
     insurance_document = models.FileField(upload_to='documents/insurance/')
+    license_thumbnail = models.ImageField(upload_to='thumbnails/', blank=True)
+    insurance_thumbnail = models.ImageField(upload_to='thumbnails/', blank=True)
     is_available = models.BooleanField(default=False)
     current_latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     current_longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
@@ -90,3 +103,10 @@ class Notification(models.Model):
     
     def __str__(self):
         return f"{self.user.get_full_name()} - {self.title}"
+
+class ReplicaHeartbeat(models.Model):
+    """Single row stamped on the primary to measure read-replica lag."""
+    beat_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f"Heartbeat at {self.beat_at}"
@@ -0,0 +1,294 @@
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from .fleet import fleet
+from .models import DriverProfile
+
+logger = logging.getLogger(__name__)
+
+
+def _cell(lat, lng, size):
+    return (math.floor(lat / size), math.floor(lng / size))
+
+
+class DriverPresence:
+    """
+    In-memory registry of online drivers, expired when they go silent.
+
+    A driver is online from toggling availability on until they toggle it
+    off or nothing has been heard from them for timeout seconds. Location
+    pings and notification socket heartbeats both count as a sign of life.
+
+    Deadlines live in a timer wheel of tick-second slots, so a heartbeat is
+    an O(1) move between slots and each tick only looks at the drivers due
+    in that slot. Positions are indexed by grid cell, so a radius lookup
+    only visits the cells the radius covers, however many drivers are
+    online. Availability changes are queued and written to DriverProfile in
+    one batch per tick, including expiries.
+
+    With a fleet (accounts.fleet.FleetState), every change is mirrored into
+    state shared by all worker processes and lookups read from there, so a
+    driver can ping one worker and be found by another. Without one the
+    registry is per process: run a single ASGI worker, or route each driver
+    to the same worker, when relying on it.
+
+    Expiry and persistence run on a background thread, started by the first
+    toggle or heartbeat a process receives, so processes that only look
+    drivers up (the dispatcher, the forecaster) never take anyone offline.
+    With background off, callers run expire() and flush() themselves.
+    """
+
+    def __init__(self, timeout=90, tick=5, cell_degrees=0.01, fleet=None, background=True):
+        self.timeout = timeout
+        self.tick = tick
+        self.cell_degrees = cell_degrees
+        self.fleet = fleet
+        self.background = background
+        self.slots = [set() for _ in range(math.ceil(timeout / tick) + 2)]
+
+        self._drivers = {}  # driver_id -> [lat, lng, deadline, slot]
+        self._cells = defaultdict(set)
+        self._changes = {}  # driver_id -> is_available to persist
+        self._last_tick = None
+        self._lock = threading.RLock()
+        self._warmed = False
+        self._thread = None
+
+    # Registry updates
+
+    def warm(self):
+        """
+        Load the drivers the database says are available, once per process,
+        giving each a full timeout to check in after a restart.
+        """
+        if self._warmed:
+            return
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+            available = list(DriverProfile.objects.filter(is_available=True).values_list(
+                'user_id', 'current_latitude', 'current_longitude', 'vehicle_type'
+            ))
+            for driver_id, lat, lng, _ in available:
+                self._place(driver_id, lat, lng, time.monotonic())
+            if self.fleet is not None:
+                self.fleet.seed(available)
+
+    def go_online(self, driver_id, lat=None, lng=None, vehicle_type=None):
+        self.warm()
+        self._start()
+        with self._lock:
+            self._place(driver_id, lat, lng, time.monotonic())
+            self._changes[driver_id] = True
+        if self.fleet is not None:
+            self.fleet.update(driver_id, lat, lng, available=True, vehicle_type=vehicle_type)
+
+    def go_offline(self, driver_id):
+        self.warm()
+        self._start()
+        with self._lock:
+            removed = self._remove(driver_id)
+            if removed:
+                self._changes[driver_id] = False
+        if self.fleet is not None:
+            self.fleet.update(driver_id, available=False, seen=False)
+
+    def touch(self, driver_id, lat=None, lng=None):
+        """
+        Record a sign of life, and the driver's position if given.
+        Returns False if the driver isn't online (they need to go online
+        again after expiring).
+        """
+        self.warm()
+        self._start()
+        with self._lock:
+            # A driver who went online through another worker is adopted
+            if driver_id not in self._drivers and not (self.fleet is not None and self.fleet.is_online(driver_id)):
+                return False
+            self._place(driver_id, lat, lng, time.monotonic())
+        if self.fleet is not None:
+            self.fleet.update(driver_id, lat, lng)
+        return True
+
+    def _place(self, driver_id, lat, lng, now):
+        entry = self._drivers.get(driver_id)
+        if entry is None:
+            entry = self._drivers[driver_id] = [None, None, None, None]
+        else:
+            self.slots[entry[3]].discard(driver_id)
+
+        if lat is not None and lng is not None:
+            lat, lng = float(lat), float(lng)
+            if entry[0] is not None:
+                self._cells[_cell(entry[0], entry[1], self.cell_degrees)].discard(driver_id)
+            entry[0], entry[1] = lat, lng
+        if entry[0] is not None:
+            self._cells[_cell(entry[0], entry[1], self.cell_degrees)].add(driver_id)
+
+        entry[2] = now + self.timeout
+        entry[3] = int(entry[2] // self.tick) % len(self.slots)
+        self.slots[entry[3]].add(driver_id)
+
+    def _remove(self, driver_id):
+        entry = self._drivers.pop(driver_id, None)
+        if entry is None:
+            return False
+        self.slots[entry[3]].discard(driver_id)
+        if entry[0] is not None:
+            cell = _cell(entry[0], entry[1], self.cell_degrees)
+            self._cells[cell].discard(driver_id)
+            if not self._cells[cell]:
+                del self._cells[cell]
+        return True
+
+    def reset(self):
+        """Forget every driver and queued change; the next use reloads."""
+        with self._lock:
+            for slot in self.slots:
+                slot.clear()
+            self._drivers.clear()
+            self._cells.clear()
+            self._changes.clear()
+            self._last_tick = None
+            self._warmed = False
+        if self.fleet is not None:
+            self.fleet.clear()
+
+    # Lookups
+
+    def is_online(self, driver_id):
+        self.warm()
+        if self.fleet is not None:
+            return self.fleet.is_online(driver_id)
+        return driver_id in self._drivers
+
+    def position(self, driver_id):
+        """Last known (lat, lng) of an online driver, or None."""
+        self.warm()
+        if self.fleet is not None:
+            return self.fleet.position(driver_id)
+        entry = self._drivers.get(driver_id)
+        if entry is None or entry[0] is None:
+            return None
+        return entry[0], entry[1]
+
+    def online_drivers(self):
+        """(driver_id, lat, lng) for every online driver with a known position."""
+        self.warm()
+        if self.fleet is not None:
+            return self.fleet.online_drivers()
+        with self._lock:
+            return [
+                (driver_id, entry[0], entry[1])
+                for driver_id, entry in self._drivers.items()
+                if entry[0] is not None
+            ]
+
+    def within(self, lat, lng, radius_km, vehicle_type=None):
+        """
+        (driver_id, lat, lng) for online drivers in the grid cells covering
+        radius_km around a point, optionally only those driving vehicle_type.
+        Callers rank by exact distance.
+        """
+        self.warm()
+        if self.fleet is not None:
+            return self.fleet.within(lat, lng, radius_km, vehicle_type)
+        size = self.cell_degrees
+        lat, lng = float(lat), float(lng)
+        lat_span = radius_km / 110.574
+        lng_span = radius_km / (111.320 * max(math.cos(math.radians(lat)), 0.01))
+        row_min, col_min = _cell(lat - lat_span, lng - lng_span, size)
+        row_max, col_max = _cell(lat + lat_span, lng + lng_span, size)
+
+        found = []
+        with self._lock:
+            for row in range(row_min, row_max + 1):
+                for col in range(col_min, col_max + 1):
+                    for driver_id in self._cells.get((row, col), ()):
+                        entry = self._drivers[driver_id]
+                        found.append((driver_id, entry[0], entry[1]))
+        return found
+
+    # Expiry and persistence
+
+    def expire(self, now=None):
+        """
+        Take offline every driver whose deadline has passed. Returns their
+        ids.
+        """
+        now = time.monotonic() if now is None else now
+        # Slots of ticks that have fully passed; the current tick's slot
+        # still holds deadlines later than now
+        done = int(now // self.tick) - 1
+        expired = []
+        with self._lock:
+            first = done - len(self.slots) + 1
+            if self._last_tick is not None:
+                # Never walk more than one revolution of the wheel
+                first = max(first, self._last_tick + 1)
+            for tick in range(first, done + 1):
+                slot = self.slots[tick % len(self.slots)]
+                for driver_id in [driver_id for driver_id in slot if self._drivers[driver_id][2] <= now]:
+                    if self.fleet is not None and self.fleet.is_online(driver_id):
+                        # Still heard from through another worker
+                        self._place(driver_id, None, None, now)
+                        continue
+                    self._remove(driver_id)
+                    self._changes[driver_id] = False
+                    expired.append(driver_id)
+            self._last_tick = done
+
+        if expired:
+            from rides.pricing import surge_engine
+            for driver_id in expired:
+                surge_engine.driver_unavailable(driver_id)
+        return expired
+
+    def flush(self):
+        """Persist queued availability changes in one transaction."""
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return 0
+
+        online = [driver_id for driver_id, available in changes.items() if available]
+        offline = [driver_id for driver_id, available in changes.items() if not available]
+        with transaction.atomic():
+            if online:
+                DriverProfile.objects.filter(user_id__in=online).update(is_available=True)
+            if offline:
+                DriverProfile.objects.filter(user_id__in=offline).update(is_available=False)
+        return len(changes)
+
+    def _start(self):
+        if not self.background or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='driver-presence', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            close_old_connections()
+            try:
+                self.expire()
+                self.flush()
+            except Exception:
+                logger.exception('Presence tick failed')
+            finally:
+                close_old_connections()
+
+
+presence = DriverPresence(
+    timeout=settings.PRESENCE_TIMEOUT_SECONDS,
+    tick=settings.PRESENCE_TICK_SECONDS,
+    cell_degrees=settings.GEO_CELL_DEGREES,
+    fleet=fleet,
+)
@@ -0,0 +1,163 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from django.conf import settings
+from django.core.cache import cache
+
+
+class ReplayBuffer:
+    """
+    Per-user ring buffer of recently sent notification events.
+
+    Every event pushed to a user's notification group is stamped with a
+    per-user, monotonically increasing sequence number and kept in a bounded
+    deque, so a reconnecting socket can be sent exactly the events it missed
+    instead of re-querying the database.
+
+    The buffer lives in the memory of the process that stamps the events, so
+    it only replays when that process also serves the sockets; see
+    SharedReplayBuffer for deployments with separate processes.
+    """
+
+    def __init__(self, size=100, max_users=10000):
+        self.size = size
+        self.max_users = max_users
+        # Sequence numbers restart when the process restarts, so every event
+        # also carries the epoch it was numbered in
+        self.epoch = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()
+        self._sequences = {}
+
+    def append(self, user_id, event):
+        """
+        Stamp an event with the user's next sequence number and buffer it.
+        The event dict is updated in place and returned.
+        """
+        with self._lock:
+            seq = self._sequences.get(user_id, 0) + 1
+            self._sequences[user_id] = seq
+            event['seq'] = seq
+            event['epoch'] = self.epoch
+
+            buffer = self._buffers.get(user_id)
+            if buffer is None:
+                buffer = self._buffers[user_id] = deque(maxlen=self.size)
+                # Drop the least recently used buffers; their owners fall
+                # back to the database on their next reconnect
+                while len(self._buffers) > self.max_users:
+                    self._buffers.popitem(last=False)
+            else:
+                self._buffers.move_to_end(user_id)
+            buffer.append(dict(event))
+        return event
+
+    def current_seq(self, user_id):
+        """Return the last sequence number issued to the user."""
+        with self._lock:
+            return self._sequences.get(user_id, 0)
+
+    def since(self, user_id, last_seq, epoch=None):
+        """
+        Return the buffered events newer than last_seq.
+
+        Returns None when the missed events can no longer be replayed from
+        memory: the buffer has been overrun, or last_seq was issued by a
+        different process epoch.
+        """
+        if epoch is not None and epoch != self.epoch:
+            return None
+
+        with self._lock:
+            current = self._sequences.get(user_id, 0)
+            if last_seq > current:
+                return None
+            if last_seq == current:
+                return []
+
+            buffer = self._buffers.get(user_id)
+            if not buffer or buffer[0]['seq'] > last_seq + 1:
+                return None
+            return [dict(event) for event in buffer if event['seq'] > last_seq]
+
+
+
+class SharedReplayBuffer:
+    """
+    ReplayBuffer kept in the shared cache, for when events are stamped by
+    HTTP workers and command processes but sockets are served by Daphne.
+
+    Sequence numbers come from an atomic cache.incr per user and each event
+    is stored under its own (user, seq) key for ttl seconds. A missed range
+    is replayed only if every event in it is still cached and there are at
+    most size of them; otherwise the socket falls back to the database.
+    """
+
+    def __init__(self, size=100, ttl=600):
+        self.size = size
+        self.ttl = ttl
+
+    @property
+    def epoch(self):
+        # Changes only if the cache loses it, along with the counters
+        return cache.get_or_set('notification_replay_epoch', lambda: uuid.uuid4().hex[:12], None)
+
+    def _seq_key(self, user_id):
+        return f'notification_replay_seq:{user_id}'
+
+    def _event_key(self, user_id, seq):
+        return f'notification_replay_event:{user_id}:{seq}'
+
+    def append(self, user_id, event):
+        """
+        Stamp an event with the user's next sequence number and buffer it.
+        The event dict is updated in place and returned.
+        """
+        key = self._seq_key(user_id)
+        try:
+            seq = cache.incr(key)
+        except ValueError:
+            # Seed missing counters from the clock, so one that was evicted
+            # never restarts below sequence numbers clients already hold
+            cache.add(key, time.time_ns() // 1000, None)
+            seq = cache.incr(key)
+        event['seq'] = seq
+        event['epoch'] = self.epoch
+        cache.set(self._event_key(user_id, seq), dict(event), self.ttl)
+        return event
+
+    def current_seq(self, user_id):
+        """Return the last sequence number issued to the user."""
+        return cache.get(self._seq_key(user_id), 0)
+
+    def since(self, user_id, last_seq, epoch=None):
+        """
+        Return the buffered events newer than last_seq, or None when they
+        can't all be replayed from the cache.
+        """
+        if epoch is not None and epoch != self.epoch:
+            return None
+        current = self.current_seq(user_id)
+        if last_seq > current or current - last_seq > self.size:
+            return None
+        if last_seq == current:
+            return []
+
+        keys = [self._event_key(user_id, seq) for seq in range(last_seq + 1, current + 1)]
+        events = cache.get_many(keys)
+        if len(events) < len(keys):
+            return None
+        return [events[key] for key in keys]
+
+
+if settings.SHARED_CACHE:
+    replay_buffer = SharedReplayBuffer(
+        size=settings.NOTIFICATION_REPLAY_BUFFER_SIZE,
+        ttl=settings.NOTIFICATION_REPLAY_TTL,
+    )
+else:
+    replay_buffer = ReplayBuffer(
+        size=settings.NOTIFICATION_REPLAY_BUFFER_SIZE,
+        max_users=settings.NOTIFICATION_REPLAY_MAX_USERS,
+    )
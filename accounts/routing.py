@@ -1,7 +1,8 @@
 from django.urls import re_path
+from cabby.metrics import track_connections
 from . import consumers
 
 websocket_urlpatterns = [
     # Fix the WebSocket URL pattern - no leading 'ws/' since it's added by the protocol router
-    re_path(r'notifications/$', consumers.NotificationConsumer.as_asgi()),
+    re_path(r'notifications/$', track_connections(consumers.NotificationConsumer.as_asgi(), 'NotificationConsumer')),
 ]
@@ -0,0 +1,38 @@
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .middleware import INVALIDATING_FIELDS, invalidate_session, invalidate_user
+from rides.models import Ride
+from .models import Notification, User
+from .utils import bump_notification_version, invalidate_active_rides, invalidate_unread_notifications
+
+
+@receiver(user_logged_out)
+def forget_logged_out_session(sender, request, user, **kwargs):
+    invalidate_session(request.session.session_key)
+
+
+@receiver(post_save, sender=User)
+def forget_changed_user(sender, instance, created, update_fields=None, **kwargs):
+    # Logins save last_login only; that doesn't affect the snapshot
+    if created or (update_fields is not None and not INVALIDATING_FIELDS & set(update_fields)):
+        return
+    invalidate_user(instance.id)
+
+
+@receiver(post_save, sender=Notification)
+@receiver(post_delete, sender=Notification)
+def forget_unread_notifications(sender, instance, **kwargs):
+    invalidate_unread_notifications([instance.user_id])
+
+
+@receiver(post_save, sender=Notification)
+def record_new_notification(sender, instance, created, **kwargs):
+    if created:
+        bump_notification_version(instance.user_id)
+
+
+@receiver(post_save, sender=Ride)
+@receiver(post_delete, sender=Ride)
+def forget_active_rides(sender, instance, **kwargs):
+    invalidate_active_rides([instance.rider_id, instance.driver_id])
@@ -1,3 +1,603 @@
-from django.test import TestCase
+import hashlib
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import MemoryFileUploadHandler
+from django.db import connection
+from django.http.multipartparser import MultiPartParser
+from django.test import TransactionTestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from .fleet import FleetState
+from .middleware import CachedAuthMiddlewareStack
+from rides import transitions
+from rides.models import Ride
+from .models import User, DriverProfile, Notification
+from .presence import DriverPresence, presence
+from .replay import ReplayBuffer, SharedReplayBuffer
+from .routing import websocket_urlpatterns
+from .uploads import LimitedUploadHandler, thumbnail_worker
+from .utils import bump_notification_version, get_notification_high_water, seed_notification_high_water, send_notification
 
-# Create your tests here.
+
+def jpeg_upload(name, size=(1600, 1200), noise=False):
+    if noise:
+        # Random pixels barely compress, for a large file from a small image
+        image = Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3))
+    else:
+        image = Image.new('RGB', size, (200, 80, 40))
+    output = io.BytesIO()
+    image.save(output, 'JPEG')
+    return SimpleUploadedFile(name, output.getvalue(), content_type='image/jpeg')
+
+
+class ProfileUploadTests(TransactionTestCase):
+    """Content-hashed uploads with thumbnails generated off the request thread."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root, UPLOAD_MAX_AVATAR_SIZE=200 * 1024))
+        # One worker runs jobs in order, so wait_for_thumbnails() sees them all done
+        thumbnail_worker._executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(thumbnail_worker._executor.shutdown)
+
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=self.driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        self.client.force_login(self.driver)
+
+    def wait_for_thumbnails(self):
+        thumbnail_worker.executor.submit(lambda: None).result()
+
+    def post_profile(self, **files):
+        return self.client.post('/profile/', {
+            'first_name': 'Ravi',
+            'last_name': 'Patil',
+            'phone_number': '',
+            'vehicle_number': 'MH12',
+            'vehicle_type': 'SEDAN',
+            'license_number': 'L1',
+            **files
+        }, secure=True)
+
+    def test_avatar_thumbnail_is_generated_and_cacheable(self):
+        self.post_profile(profile_picture=jpeg_upload('me.jpg'))
+        self.wait_for_thumbnails()
+
+        user = User.objects.get(id=self.driver.id)
+        self.assertRegex(user.profile_picture.name, r'^avatars/[0-9a-f]{32}\.jpg$')
+        with default_storage.open(user.profile_picture_thumbnail.name) as thumbnail:
+            self.assertEqual(max(Image.open(thumbnail).size), 256)
+
+        response = self.client.get(user.get_avatar_url(), secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_rejected_upload_leaves_profile_unchanged(self):
+        response = self.post_profile(profile_picture=jpeg_upload('big.jpg', size=(800, 600), noise=True))
+        self.assertEqual(response.status_code, 302)
+        response = self.post_profile(profile_picture=SimpleUploadedFile('fake.png', b'not an image'))
+
+        user = User.objects.get(id=self.driver.id)
+        self.assertFalse(user.profile_picture)
+        self.assertEqual(user.first_name, '')
+
+    def parse(self, handler, body, content_length=None):
+        """Parse a multipart body through handler; returns the bytes read."""
+        content = encode_multipart(BOUNDARY, body)
+        stream = io.BytesIO(content)
+        parser = MultiPartParser({
+            'CONTENT_TYPE': MULTIPART_CONTENT,
+            'CONTENT_LENGTH': content_length or len(content),
+        }, stream, [handler, MemoryFileUploadHandler()])
+        post, files = parser.parse()
+        return stream.tell(), post, files
+
+    def test_oversized_upload_stops_streaming(self):
+        picture = SimpleUploadedFile('big.jpg', os.urandom(4 * 1024 * 1024))
+        handler = LimitedUploadHandler({'profile_picture': 200 * 1024, 'license_document': 8 * 1024 * 1024})
+        read, _, files = self.parse(handler, {'first_name': 'Ravi', 'profile_picture': picture})
+        self.assertLess(read, 1024 * 1024)
+        self.assertNotIn('profile_picture', files)
+        self.assertIn('big.jpg: files must be under', str(handler.error))
+
+    def test_body_longer_than_every_limit_is_not_read(self):
+        handler = LimitedUploadHandler({'profile_picture': 200 * 1024})
+        body = {'profile_picture': SimpleUploadedFile('me.jpg', b'x')}
+        read, post, files = self.parse(handler, body, content_length=200 * 1024 + settings.DATA_UPLOAD_MAX_MEMORY_SIZE + 1)
+        self.assertEqual((read, dict(post), dict(files)), (0, {}, {}))
+        self.assertIsNotNone(handler.error)
+
+    def test_files_are_hashed_as_they_arrive(self):
+        content = jpeg_upload('me.jpg').read()
+        handler = LimitedUploadHandler({'profile_picture': 200 * 1024})
+        _, _, files = self.parse(handler, {'profile_picture': SimpleUploadedFile('me.jpg', content)})
+        self.assertIsNone(handler.error)
+        self.assertEqual(handler.digests['profile_picture'], hashlib.sha256(content).hexdigest())
+
+        # Unlisted file fields are refused outright
+        handler = LimitedUploadHandler({'profile_picture': 200 * 1024})
+        self.parse(handler, {'license_document': SimpleUploadedFile('license.pdf', b'%PDF')})
+        self.assertIsNotNone(handler.error)
+
+    def test_oversized_upload_through_the_view_leaves_profile_unchanged(self):
+        response = self.post_profile(profile_picture=SimpleUploadedFile('big.jpg', os.urandom(1024 * 1024)))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.objects.get(id=self.driver.id).first_name, '')
+
+    def test_document_thumbnail_is_private(self):
+        self.post_profile(license_document=jpeg_upload('license.jpg'))
+        self.wait_for_thumbnails()
+        profile = DriverProfile.objects.get(user=self.driver)
+        url = f"/thumbnails/{profile.license_thumbnail.name.split('/')[-1]}"
+
+        self.assertEqual(self.client.get(url, secure=True).status_code, 200)
+        self.client.force_login(User.objects.create_user('rider', password=None, role='RIDER'))
+        self.assertEqual(self.client.get(url, secure=True).status_code, 404)
+
+
+@override_settings(SHARED_CACHE=True)
+class CachedWebSocketAuthTests(TransactionTestCase):
+    """Notification socket connects served from the cached user snapshot."""
+
+    def setUp(self):
+        cache.clear()
+        router = URLRouter(websocket_urlpatterns)
+
+        async def application(scope, receive, send):
+            self.scope_user = scope['user']
+            return await router(scope, receive, send)
+        self.application = CachedAuthMiddlewareStack(application)
+        self.user = User.objects.create_user('rider', password=None, role='RIDER', first_name='Asha')
+        Notification.objects.create(user=self.user, type='SYSTEM', title='Welcome', message='Hello')
+        self.client.force_login(self.user)
+
+    def connect(self):
+        """Connect with the test client's session; returns the connect messages."""
+        async def run():
+            communicator = WebsocketCommunicator(self.application, '/notifications/', headers=[
+                (b'cookie', f'{settings.SESSION_COOKIE_NAME}={self.client.session.session_key}'.encode()),
+            ])
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            messages = [await communicator.receive_json_from()]
+            if messages[0]['status'] == 'connected':
+                messages.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return messages, self.scope_user
+        return async_to_sync(run)()
+
+    def test_warm_connect_makes_no_queries(self):
+        self.connect()
+        with CaptureQueriesContext(connection) as queries:
+            messages, user = self.connect()
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(messages[0]['status'], 'connected')
+        self.assertEqual(messages[1]['notifications'][0]['title'], 'Welcome')
+        self.assertEqual((user.id, user.role, user.first_name), (self.user.id, 'RIDER', 'Asha'))
+
+    def test_role_change_and_new_notifications_invalidate(self):
+        self.connect()
+        self.user.role = 'DRIVER'
+        self.user.save()
+        Notification.objects.create(user=self.user, type='SYSTEM', title='Approved', message='You can drive')
+
+        messages, user = self.connect()
+        self.assertEqual(user.role, 'DRIVER')
+        self.assertEqual([n['title'] for n in messages[1]['notifications']], ['Approved', 'Welcome'])
+
+    def test_logout_invalidates(self):
+        self.connect()
+        session_key = self.client.session.session_key
+        self.client.logout()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+
+        messages, user = self.connect()
+        self.assertFalse(user.is_authenticated)
+        self.assertEqual(messages[0]['status'], 'warning')
+
+    def test_private_cache_is_not_trusted(self):
+        # Another process's logout can't reach this process's cache
+        self.connect()
+        with override_settings(SHARED_CACHE=False):
+            Session.objects.all().delete()
+            messages, user = self.connect()
+        self.assertFalse(user.is_authenticated)
+        self.assertEqual(messages[0]['status'], 'warning')
+
+
+class NotificationReplayTests(TransactionTestCase):
+    """Missed notification events replayed to reconnecting sockets."""
+
+    def setUp(self):
+        self.buffer = ReplayBuffer(size=3, max_users=2)
+        for target in ('accounts.utils.replay_buffer', 'accounts.consumers.replay_buffer'):
+            patcher = mock.patch(target, self.buffer)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.application = CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+        self.user = User.objects.create_user('rider', password=None, role='RIDER')
+        self.client.force_login(self.user)
+
+    def send(self, title):
+        return send_notification(self.user, title, title)
+
+    def connect(self, query=''):
+        """Connect with the test client's session; returns the connect messages."""
+        async def run():
+            communicator = WebsocketCommunicator(self.application, f'/notifications/{query}', headers=[
+                (b'cookie', f'{settings.SESSION_COOKIE_NAME}={self.client.session.session_key}'.encode()),
+            ])
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            messages = [await communicator.receive_json_from()]
+            while not await communicator.receive_nothing():
+                messages.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return messages
+        return async_to_sync(run)()
+
+    def test_buffer_replays_only_missed_events(self):
+        for i in range(3):
+            self.buffer.append(7, {'type': 'notification', 'n': i})
+        self.assertEqual([event['n'] for event in self.buffer.since(7, 1, self.buffer.epoch)], [1, 2])
+        self.assertEqual(self.buffer.since(7, 3, self.buffer.epoch), [])
+        self.assertEqual(self.buffer.current_seq(7), 3)
+
+    def test_overrun_epoch_mismatch_and_evicted_users_fall_back(self):
+        for i in range(5):
+            self.buffer.append(7, {'type': 'notification', 'n': i})
+        # Seq 2 was pushed out of the three-event buffer
+        self.assertIsNone(self.buffer.since(7, 1))
+        self.assertEqual(len(self.buffer.since(7, 2)), 3)
+        self.assertIsNone(self.buffer.since(7, 2, 'another-process'))
+        self.assertIsNone(self.buffer.since(7, 6))
+
+        self.buffer.append(8, {'type': 'notification'})
+        self.buffer.append(9, {'type': 'notification'})
+        self.assertIsNone(self.buffer.since(7, 4))
+
+    def test_reconnect_replays_missed_notifications(self):
+        self.send('Welcome')
+        status = self.connect()[0]
+        self.assertEqual((status['seq'], status['epoch'], status['replay']), (1, self.buffer.epoch, False))
+
+        self.send('One')
+        self.send('Two')
+        messages = self.connect(f'?last_seq=1&epoch={self.buffer.epoch}')
+        self.assertTrue(messages[0]['replay'])
+        self.assertEqual([(m['seq'], m['title']) for m in messages[1:]], [(2, 'One'), (3, 'Two')])
+
+    def test_shared_buffer_replays_events_stamped_by_another_process(self):
+        cache.clear()
+        # Separate in-memory buffers can't replay each other's events
+        elsewhere = ReplayBuffer()
+        elsewhere.append(self.user.id, {'type': 'notification'})
+        self.assertIsNone(self.buffer.since(self.user.id, 0, elsewhere.epoch))
+
+        # HTTP workers stamp, Daphne replays, through the one cache
+        stamping, serving = SharedReplayBuffer(size=3), SharedReplayBuffer(size=3)
+        with mock.patch('accounts.utils.replay_buffer', stamping), \
+                mock.patch('accounts.consumers.replay_buffer', serving):
+            self.send('Welcome')
+            status = self.connect()[0]
+            self.send('One')
+            self.send('Two')
+            messages = self.connect(f"?last_seq={status['seq']}&epoch={status['epoch']}")
+        self.assertEqual(status['epoch'], stamping.epoch)
+        self.assertTrue(messages[0]['replay'])
+        self.assertEqual([m['title'] for m in messages[1:]], ['One', 'Two'])
+        self.assertEqual(messages[-1]['seq'], status['seq'] + 2)
+
+    def test_shared_buffer_falls_back_when_events_are_gone(self):
+        cache.clear()
+        stamping, serving = SharedReplayBuffer(size=3), SharedReplayBuffer(size=3)
+        for i in range(5):
+            stamping.append(7, {'type': 'notification', 'n': i})
+        current = serving.current_seq(7)
+        self.assertEqual([event['n'] for event in serving.since(7, current - 2, serving.epoch)], [3, 4])
+        self.assertIsNone(serving.since(7, current - 4))
+        self.assertIsNone(serving.since(7, current - 2, 'another-epoch'))
+        self.assertIsNone(serving.since(7, current + 1))
+        cache.delete(f'notification_replay_event:7:{current - 1}')
+        self.assertIsNone(serving.since(7, current - 2))
+        # An evicted counter resumes above the sequence numbers handed out
+        cache.delete('notification_replay_seq:7')
+        self.assertGreater(stamping.append(7, {'type': 'notification'})['seq'], current)
+
+    def test_reconnect_after_overrun_or_restart_reads_the_database(self):
+        for title in ('One', 'Two', 'Three', 'Four', 'Five'):
+            self.send(title)
+        for query in ('?last_seq=1&epoch=' + self.buffer.epoch, '?last_seq=4&epoch=another-process'):
+            messages = self.connect(query)
+            self.assertFalse(messages[0]['replay'])
+            self.assertEqual(messages[0]['seq'], 5)
+            self.assertEqual(messages[1]['type'], 'unread_notifications')
+            self.assertEqual(len(messages[1]['notifications']), 5)
+
+
+class DriverPresenceTests(TransactionTestCase):
+    """Online drivers held in memory, expired on silence and persisted in batches."""
+
+    def setUp(self):
+        presence.reset()
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=self.driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        self.client.force_login(self.driver)
+
+    def test_silent_driver_expires(self):
+        registry = DriverPresence(timeout=10, tick=1, background=False)
+        now = time.monotonic()
+        registry.go_online(self.driver.id, 18.52, 73.85)
+
+        self.assertTrue(registry.touch(self.driver.id))
+        self.assertEqual(registry.expire(now=now + 5), [])
+        self.assertEqual(registry.expire(now=now + 12), [self.driver.id])
+        self.assertFalse(registry.is_online(self.driver.id))
+        self.assertFalse(registry.touch(self.driver.id, 18.53, 73.85))
+
+    def test_only_processes_taking_heartbeats_expire_drivers(self):
+        with mock.patch('accounts.presence.threading.Thread') as thread:
+            registry = DriverPresence(timeout=10, tick=1)
+            registry.online_drivers()
+            registry.is_online(self.driver.id)
+            thread.assert_not_called()
+            registry.go_online(self.driver.id, 18.52, 73.85)
+            thread.assert_called_once()
+        self.assertFalse(presence.background)
+
+    def test_within_only_returns_nearby_drivers(self):
+        registry = DriverPresence(timeout=10, tick=1, background=False)
+        registry.go_online(1, 18.520, 73.850)
+        registry.go_online(2, 18.530, 73.860)
+        registry.go_online(3, 19.076, 72.877)
+        registry.go_online(4)
+
+        self.assertEqual(sorted(driver[0] for driver in registry.within(18.52, 73.85, 3)), [1, 2])
+        registry.touch(2, 19.07, 72.87)
+        self.assertEqual([driver[0] for driver in registry.within(18.52, 73.85, 3)], [1])
+
+    def test_availability_is_written_in_batches(self):
+        self.client.post('/toggle-availability/', secure=True)
+        self.assertTrue(presence.is_online(self.driver.id))
+        self.assertFalse(DriverProfile.objects.get(user=self.driver).is_available)
+
+        response = self.client.post('/rides/update-location/', {'latitude': 18.52, 'longitude': 73.85},
+                                    content_type='application/json', secure=True)
+        self.assertTrue(response.json()['is_available'])
+        self.assertEqual(presence.position(self.driver.id), (18.52, 73.85))
+
+        presence.flush()
+        self.assertTrue(DriverProfile.objects.get(user=self.driver).is_available)
+        presence.go_offline(self.driver.id)
+        presence.flush()
+        self.assertFalse(DriverProfile.objects.get(user=self.driver).is_available)
+
+
+class RequestProfilingTests(TransactionTestCase):
+    """Opt-in profiling of a request for staff."""
+
+    def setUp(self):
+        profile_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_root)
+        self.enterContext(override_settings(PROFILE_ROOT=profile_root, PROFILE_SAMPLE_INTERVAL_MS=1))
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=self.driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        self.client.force_login(self.driver)
+
+    def test_only_staff_can_profile(self):
+        response = self.client.get('/dashboard/?_profile=cprofile', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(os.listdir(settings.PROFILE_ROOT), [])
+
+    def test_cprofile_summary_and_download(self):
+        User.objects.filter(id=self.driver.id).update(is_staff=True)
+        response = self.client.get('/dashboard/', secure=True, headers={'X-Profile': 'cprofile'})
+        self.assertEqual(response.status_code, 200)
+
+        summary = self.client.get(response['X-Profile-Summary'], secure=True).json()
+        self.assertEqual((summary['mode'], summary['path'], summary['status']), ('cprofile', '/dashboard/', 200))
+        self.assertGreater(summary['sql']['count'], 0)
+        self.assertGreater(summary['template_time'], 0)
+        self.assertLessEqual(summary['template_time'], summary['wall_time'])
+        self.assertTrue(summary['top_functions'][0]['calls'])
+
+        download = self.client.get(f"/profiles/{response['X-Profile-Id']}/download/", secure=True)
+        self.assertEqual(download['Content-Disposition'], f'attachment; filename="{response["X-Profile-Id"]}.prof"')
+
+    def test_sampling_profile_is_listed(self):
+        User.objects.filter(id=self.driver.id).update(is_staff=True)
+        response = self.client.get('/dashboard/?_profile=sample', secure=True)
+
+        listed = self.client.get('/profiles/', secure=True).json()['profiles']
+        self.assertEqual([profile['id'] for profile in listed], [response['X-Profile-Id']])
+        summary = self.client.get(listed[0]['summary'], secure=True).json()
+        self.assertEqual(summary['mode'], 'sample')
+        self.assertIn('samples', summary)
+
+
+@override_settings(SHARED_CACHE=True)
+class NotificationPollingTests(TransactionTestCase):
+    """Id-cursor notification polling answered from cached state."""
+
+    def setUp(self):
+        cache.clear()
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        self.old = Notification.objects.create(user=self.rider, type='SYSTEM', title='Welcome', message='Hello')
+        self.client.force_login(self.rider)
+
+    def poll(self, after_id=None):
+        query = '' if after_id is None else f'?after_id={after_id}'
+        return self.client.get(f'/api/notifications/{query}', secure=True).json()
+
+    def test_cursor_returns_each_new_notification_once(self):
+        first = self.poll()
+        self.assertEqual(first['last_id'], self.old.id)
+        self.assertEqual([n['title'] for n in first['notifications']], ['Welcome'])
+
+        # Created in the same instant; a timestamp cursor could miss one
+        Notification.objects.create(user=self.rider, type='SYSTEM', title='One', message='1')
+        Notification.objects.create(user=self.rider, type='SYSTEM', title='Two', message='2')
+        second = self.poll(first['last_id'])
+        self.assertEqual([n['title'] for n in second['notifications']], ['One', 'Two'])
+        self.assertEqual(self.poll(second['last_id'])['notifications'], [])
+
+    def test_nothing_new_is_answered_from_cache(self):
+        Ride.objects.create(
+            rider=self.rider, pickup_address='A', dropoff_address='B',
+            pickup_latitude=18.52, pickup_longitude=73.85,
+            dropoff_latitude=18.55, dropoff_longitude=73.90,
+            status='REQUESTED', fare=100
+        )
+        last_id = self.poll()['last_id']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.poll(last_id)
+        tables = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('accounts_notification', tables)
+        self.assertNotIn('rides_ride', tables)
+        self.assertEqual((response['last_id'], response['notifications']), (last_id, []))
+        self.assertEqual(response['ride_updates'][0]['status_message'], 'Waiting for driver')
+
+    def test_ride_transition_refreshes_active_rides(self):
+        ride = Ride.objects.create(
+            rider=self.rider, pickup_address='A', dropoff_address='B',
+            pickup_latitude=18.52, pickup_longitude=73.85,
+            dropoff_latitude=18.55, dropoff_longitude=73.90,
+            status='REQUESTED', fare=100
+        )
+        last_id = self.poll()['last_id']
+        self.assertEqual(self.poll(last_id)['ride_updates'][0]['status'], 'REQUESTED')
+
+        self.assertTrue(transitions.accept_ride(ride, self.driver))
+        self.assertEqual(self.poll(last_id)['ride_updates'][0]['status'], 'ACCEPTED')
+        transitions.cancel_ride(ride, self.rider)
+        self.assertEqual(self.poll(last_id)['ride_updates'], [])
+
+    def test_interleaved_creates_never_hide_the_newest(self):
+        last_id = self.poll()['last_id']
+        with mock.patch('accounts.signals.bump_notification_version'):
+            created = [
+                Notification.objects.create(user=self.rider, type='SYSTEM', title=title, message=title)
+                for title in ('One', 'Two')
+            ]
+        # Both creates record themselves at once, the newer one first
+        barrier = threading.Barrier(2)
+
+        def record():
+            barrier.wait()
+            bump_notification_version(self.rider.id)
+        threads = [threading.Thread(target=record) for _ in created]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([n['title'] for n in self.poll(last_id)['notifications']], ['One', 'Two'])
+
+    def test_mark_read_before_a_create_is_never_used(self):
+        last_id = self.poll()['last_id']
+        # A poll reads the version, then a notification lands before the
+        # poll's database read and the poll seeds the mark it read
+        version, _ = get_notification_high_water(self.rider.id)
+        Notification.objects.create(user=self.rider, type='SYSTEM', title='One', message='1')
+        seed_notification_high_water(self.rider.id, version, last_id)
+        self.assertEqual([n['title'] for n in self.poll(last_id)['notifications']], ['One'])
+
+    def test_private_cache_is_not_trusted(self):
+        # Notifications and rides written by another process never touch
+        # this process's cache, so every poll goes to the database
+        last_id = self.poll()['last_id']
+        with override_settings(SHARED_CACHE=False):
+            self.poll(last_id)
+            with mock.patch('accounts.signals.bump_notification_version'), \
+                    mock.patch('accounts.signals.invalidate_active_rides'):
+                Notification.objects.create(user=self.rider, type='SYSTEM', title='Elsewhere', message='1')
+                Ride.objects.create(
+                    rider=self.rider, pickup_address='A', dropoff_address='B',
+                    pickup_latitude=18.52, pickup_longitude=73.85,
+                    dropoff_latitude=18.55, dropoff_longitude=73.90,
+                    status='REQUESTED', fare=100
+                )
+            response = self.poll(last_id)
+        self.assertEqual([n['title'] for n in response['notifications']], ['Elsewhere'])
+        self.assertEqual(response['ride_updates'][0]['status'], 'REQUESTED')
+
+
+def fleet_worker(name, lock_path, driver_id):
+    """Another worker process going online and moving."""
+    state = FleetState(name, capacity=16, timeout=60, lock_path=lock_path)
+    state.update(driver_id, 18.52, 73.85, available=True, vehicle_type='SUV')
+    state.update(driver_id, 18.53, 73.86)
+    state.close()
+
+
+class FleetStateTests(TransactionTestCase):
+    """Driver state shared between worker processes through shared memory."""
+
+    def setUp(self):
+        self.name = f'cabby_fleet_unit_{os.getpid()}'
+        self.lock_path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'fleet.lock')
+
+    def state(self, **kwargs):
+        state = FleetState(self.name, **{'capacity': 16, 'timeout': 60, 'lock_path': self.lock_path, **kwargs})
+        self.addCleanup(state.close)
+        return state
+
+    def test_reads_see_another_process_writes(self):
+        reader = self.state()
+        self.addCleanup(reader.unlink)
+        process = multiprocessing.get_context('fork').Process(target=fleet_worker, args=(self.name, self.lock_path, 7))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+        self.assertEqual(reader.position(7), (18.53, 73.86))
+        self.assertEqual(reader.within(18.535, 73.865, 2), [(7, 18.53, 73.86)])
+        self.assertEqual(reader.within(18.535, 73.865, 2, vehicle_type='SEDAN'), [])
+        self.assertEqual(reader.snapshot()['vehicle_type'].tolist(), [reader.codes['SUV']])
+
+    def test_silent_and_offline_drivers_drop_out(self):
+        writer, reader = self.state(), self.state()
+        self.addCleanup(reader.unlink)
+        writer.update(1, 18.52, 73.85, available=True)
+        writer.update(2, 18.52, 73.85, available=True)
+        writer.update(2, available=False, seen=False)
+        self.assertEqual(reader.online_drivers(), [(1, 18.52, 73.85)])
+
+        with mock.patch('accounts.fleet.time.time', return_value=time.time() + 61):
+            self.assertFalse(reader.is_online(1))
+
+    def test_drivers_move_between_workers(self):
+        first, second = self.state(), self.state()
+        self.addCleanup(first.unlink)
+        driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        worker_a = DriverPresence(timeout=10, tick=1, background=False, fleet=first)
+        worker_b = DriverPresence(timeout=10, tick=1, background=False, fleet=second)
+
+        worker_a.go_online(driver.id, 18.52, 73.85)
+        # Worker B never saw the toggle but takes the driver's pings
+        self.assertTrue(worker_b.touch(driver.id, 18.6, 73.9))
+        self.assertEqual(worker_a.position(driver.id), (18.6, 73.9))
+        # Worker A's deadline passing doesn't take them offline
+        self.assertEqual(worker_a.expire(now=time.monotonic() + 11), [])
+
+        worker_b.go_offline(driver.id)
+        self.assertFalse(worker_a.is_online(driver.id))
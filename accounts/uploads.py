@@ -0,0 +1,207 @@
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.db import close_old_connections
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+DOCUMENT_EXTENSIONS = ('.pdf',) + IMAGE_EXTENSIONS
+IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+# Bump when thumbnail settings change so old thumbnails are regenerated
+THUMBNAIL_VERSION = 1
+
+
+class UploadError(ValueError):
+    """An upload was rejected; the message is safe to show to the user."""
+
+
+def too_large(file_name, max_size):
+    return UploadError(f'{file_name}: files must be under {max_size // (1024 * 1024)} MB.')
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    """
+    Enforce per-field upload size limits and hash files while the request
+    body streams in.
+
+    A request whose Content-Length can't fit within the limits isn't read
+    at all, and a file that grows past its field's limit stops the upload
+    there, so an oversized body never costs the full transfer. Files in
+    fields without a limit are refused. Must come first in
+    request.upload_handlers so it sees every chunk; the next handler still
+    builds the UploadedFile.
+
+    After parsing, error holds the UploadError to report, if any, and
+    digests maps field names to the SHA-256 of each file.
+    """
+
+    def __init__(self, limits, request=None):
+        super().__init__(request)
+        self.limits = limits
+        self.error = None
+        self.digests = {}
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Non-file fields are bounded by DATA_UPLOAD_MAX_MEMORY_SIZE as usual
+        if content_length > sum(self.limits.values()) + (settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 0):
+            self.error = UploadError('The upload is too large.')
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.limit = self.limits.get(field_name, 0)
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > self.limit:
+            self.error = too_large(self.file_name, self.limit)
+            raise StopUpload(connection_reset=True)
+        self.digest.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name] = self.digest.hexdigest()
+        return None
+
+
+def store_upload(uploaded_file, directory, max_size, extensions, digest=None):
+    """
+    Store an upload under a content-hashed name.
+
+    Storage moves uploads Django already spooled to disk instead of copying
+    them, and identical files map to the same name and are stored once.
+    Pass the digest LimitedUploadHandler computed as the file arrived;
+    without one the file is read here to hash it.
+
+    Args:
+        uploaded_file: An UploadedFile from request.FILES
+        directory: Storage directory, e.g. 'documents/licenses'
+        max_size: Largest accepted size in bytes
+        extensions: Accepted lowercase file extensions; image extensions
+            are also checked to really be images
+        digest: Optional SHA-256 hex digest of the file
+
+    Returns the storage name. Raises UploadError if the file is rejected.
+    """
+    extension = os.path.splitext(uploaded_file.name)[1].lower()
+    if extension not in extensions:
+        raise UploadError(f'{uploaded_file.name}: unsupported file type.')
+    if uploaded_file.size > max_size:
+        raise too_large(uploaded_file.name, max_size)
+
+    if digest is None:
+        sha256 = hashlib.sha256()
+        for chunk in uploaded_file.chunks():
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+    if extension in IMAGE_EXTENSIONS:
+        # Only reads the header; the full decode happens in the thumbnail worker
+        try:
+            uploaded_file.seek(0)
+            with Image.open(uploaded_file) as image:
+                image_format = image.format
+        except (UnidentifiedImageError, OSError):
+            image_format = None
+        if image_format not in IMAGE_FORMATS:
+            raise UploadError(f'{uploaded_file.name}: not a valid image.')
+
+    name = f'{directory}/{digest[:32]}{extension}'
+    if not default_storage.exists(name):
+        uploaded_file.seek(0)
+        name = default_storage.save(name, uploaded_file)
+    return name
+
+
+def thumbnail_name(source_name, size):
+    """Content-hashed thumbnail name for a stored image, per size and version."""
+    stem = os.path.splitext(os.path.basename(source_name))[0]
+    return f'thumbnails/{stem}-{size}-v{THUMBNAIL_VERSION}.jpg'
+
+
+def render_thumbnail(source_name, size):
+    """
+    Store a JPEG thumbnail of a stored image, no larger than size pixels on
+    either side. Returns the thumbnail's storage name.
+    """
+    name = thumbnail_name(source_name, size)
+    if default_storage.exists(name):
+        return name
+
+    with default_storage.open(source_name, 'rb') as source:
+        with Image.open(source) as image:
+            # JPEG scans decode straight to a reduced scale, which is much
+            # cheaper than decoding at full size and shrinking
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.LANCZOS)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+
+    return default_storage.save(name, ContentFile(output.getvalue()))
+
+
+class ThumbnailWorker:
+    """
+    Generate thumbnails in a pool of background threads.
+
+    Pillow releases the GIL while decoding and resizing, so a few threads
+    keep large scans off the request thread without a separate process.
+    Once a thumbnail exists its name is written to the model's thumbnail
+    field, but only while the source field still holds the same file, so a
+    slow job can't overwrite the thumbnail of a newer upload.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='thumbnails'
+                )
+            return self._executor
+
+    def submit(self, instance, field, thumbnail_field, size):
+        """
+        Queue a thumbnail of instance.<field> to be stored in
+        instance.<thumbnail_field>. Returns the Future, or None if the
+        field holds no image.
+        """
+        source_name = getattr(instance, field).name
+        if not source_name or not source_name.lower().endswith(IMAGE_EXTENSIONS):
+            return None
+        return self.executor.submit(
+            self._run, instance._meta.model, instance.pk, field, thumbnail_field, source_name, size
+        )
+
+    def _run(self, model, pk, field, thumbnail_field, source_name, size):
+        close_old_connections()
+        try:
+            name = render_thumbnail(source_name, size)
+            model.objects.filter(pk=pk, **{field: source_name}).update(**{thumbnail_field: name})
+            return name
+        finally:
+            close_old_connections()
+
+
+thumbnail_worker = ThumbnailWorker(workers=settings.UPLOAD_WORKERS)
@@ -1,10 +1,28 @@
+import asyncio
 import json
+import time
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.urls import reverse
 from django.utils import timezone
+from cabby.metrics import group_send
 from .models import Notification
+from .replay import replay_buffer
+from rides.models import Ride
 
-def send_notification(user, title, message, related_to=None, action_url=None):
+# Shown for each active ride in the notification polling API
+RIDE_STATUS_MESSAGES = {
+    'REQUESTED': 'Waiting for driver',
+    'ACCEPTED': 'Driver is on the way',
+    'STARTED': 'Ride in progress',
+    'COMPLETED': 'Ride completed',
+    'CANCELLED': 'Ride cancelled'
+}
+
+def send_notification(user, title, message, related_to=None, action_url=None, notification_type=''):
     """
     Create a notification in the database and send it via WebSocket
     
@@ -14,10 +32,12 @@ def send_notification(user, title, message, related_to=None, action_url=None):
         message: Notification message content
         related_to: Optional model instance related to this notification (e.g., a Ride)
         action_url: Optional URL to redirect to when clicking the notification
+        notification_type: Optional Notification.NOTIFICATION_TYPES value
     """
     # Create notification in database
     notification = Notification.objects.create(
         user=user,
+        type=notification_type,
         title=title,
         message=message,
         related_to_type=related_to.__class__.__name__ if related_to else None,
@@ -28,22 +48,81 @@ def send_notification(user, title, message, related_to=None, action_url=None):
     # Get channel layer
     channel_layer = get_channel_layer()
     
+    # Stamp with a sequence number so reconnecting sockets can replay it
+    event = replay_buffer.append(user.id, notification_event(notification))
+    
     # Send notification to user's personal group
-    async_to_sync(channel_layer.group_send)(
+    async_to_sync(group_send)(
+        channel_layer,
         f'user_{user.id}_notifications',
-        {
-            'type': 'notification_message',
-            'notification_id': notification.id,
-            'title': title,
-            'message': message,
-            'created_at': notification.created_at.isoformat(),
-            'related_to': f"{related_to.__class__.__name__}_{related_to.id}" if related_to else None,
-            'action_url': action_url
-        }
+        event
     )
     
     return notification
 
+def notification_event(notification):
+    """
+    Build the WebSocket event for a saved notification
+    
+    Args:
+        notification: The Notification instance
+    """
+    return {
+        'type': 'notification_message',
+        'notification_id': notification.id,
+        'notification_type': notification.type,
+        'title': notification.title,
+        'message': notification.message,
+        'created_at': notification.created_at.isoformat(),
+        'related_to': f"{notification.related_to_type}_{notification.related_to_id}" if notification.related_to_type else None,
+        'action_url': notification.action_url
+    }
+
+def send_notifications_bulk(notifications, extra_events=()):
+    """
+    Create many notifications with one INSERT and push them in one batch
+    
+    Args:
+        notifications: Unsaved Notification instances
+        extra_events: Optional (user_id, event) pairs sent in the same batch,
+            e.g. ride status updates
+    """
+    # bulk_create sets created_at and, on SQLite and PostgreSQL, the ids
+    notifications = Notification.objects.bulk_create(notifications)
+    # bulk_create doesn't send post_save, so drop the cached unread lists and
+    # bump the notification versions here
+    user_ids = {notification.user_id for notification in notifications}
+    invalidate_unread_notifications(user_ids)
+    for user_id in user_ids:
+        bump_notification_version(user_id)
+    
+    events = [(notification.user_id, notification_event(notification)) for notification in notifications]
+    events.extend(extra_events)
+    broadcast([
+        (f'user_{user_id}_notifications', replay_buffer.append(user_id, event))
+        for user_id, event in events
+    ])
+    
+    return notifications
+
+def broadcast(messages):
+    """
+    Send many group messages concurrently from sync code
+    
+    Args:
+        messages: (group_name, event) pairs
+    """
+    if not messages:
+        return
+    channel_layer = get_channel_layer()
+    
+    async def send_all():
+        await asyncio.gather(*(
+            group_send(channel_layer, group, event) for group, event in messages
+        ))
+    
+    async_to_sync(send_all)()
+
 def send_ride_status_update(user, ride, status, message, driver=None, redirect_url=None):
     """
     Send a real-time ride status update via WebSocket
@@ -59,18 +138,22 @@ def send_ride_status_update(user, ride, status, message, driver=None, redirect_u
     # Get channel layer
     channel_layer = get_channel_layer()
     
+    # Stamp with a sequence number so reconnecting sockets can replay it
+    event = replay_buffer.append(user.id, {
+        'type': 'ride_status_update',
+        'ride_id': ride.id,
+        'status': status,
+        'driver_id': driver.id if driver else None,
+        'driver_name': f"{driver.first_name} {driver.last_name}" if driver else None,
+        'message': message,
+        'redirect_url': redirect_url
+    })
+    
     # Send ride update to user's personal group
-    async_to_sync(channel_layer.group_send)(
+    async_to_sync(group_send)(
+        channel_layer,
         f'user_{user.id}_notifications',
-        {
-            'type': 'ride_status_update',
-            'ride_id': ride.id,
-            'status': status,
-            'driver_id': driver.id if driver else None,
-            'driver_name': f"{driver.first_name} {driver.last_name}" if driver else None,
-            'message': message,
-            'redirect_url': redirect_url
-        }
+        event
     )
     
     # Also create a notification in DB for this update
@@ -84,3 +167,159 @@ def send_ride_status_update(user, ride, status, message, driver=None, redirect_u
     )
     
     return notification
+
+def unread_cache_key(user_id):
+    return f'unread_notifications:{user_id}'
+
+def get_unread_notifications(user_id, limit=5):
+    """
+    Get a user's latest unread notifications as plain dicts, from the cache
+    when possible. The notification socket sends these on every connect.
+    They're only cached with SHARED_CACHE, since notifications created in
+    other processes must be able to invalidate them.
+    
+    Args:
+        user_id: The user's id
+        limit: How many notifications to return
+    """
+    key = unread_cache_key(user_id)
+    unread = cache.get(key) if settings.SHARED_CACHE else None
+    if unread is None:
+        unread = [
+            {
+                'id': notification.id,
+                'title': notification.title,
+                'message': notification.message,
+                'created_at': notification.created_at.isoformat(),
+                'is_read': notification.is_read
+            }
+            for notification in Notification.objects.filter(
+                user_id=user_id,
+                is_read=False
+            ).order_by('-created_at')[:limit]
+        ]
+        if settings.SHARED_CACHE:
+            cache.set(key, unread, settings.WS_AUTH_CACHE_TTL)
+    return unread
+
+def invalidate_unread_notifications(user_ids):
+    """
+    Drop cached unread notifications. Saves and deletes do this through
+    signals; call it after bulk_create() or update() on notifications.
+    
+    Args:
+        user_ids: Ids of the users whose notifications changed
+    """
+    cache.delete_many([unread_cache_key(user_id) for user_id in user_ids])
+
+def notifications_version_key(user_id):
+    return f'notifications_version:{user_id}'
+
+def high_water_key(user_id, version):
+    return f'notifications_high_water:{user_id}:{version}'
+
+def bump_notification_version(user_id):
+    """
+    Record that a user has a new notification by bumping their version
+    counter. Saves do this through signals; call it after bulk_create().
+    
+    The counter is raised with an atomic incr, so concurrent creates can't
+    undo each other the way a read-compare-write of the newest id could.
+    High-water marks are cached per version, so every bump retires the
+    current one. The bump waits for the transaction to commit, so a poll
+    that reseeds the mark from the database sees the new row.
+    
+    Args:
+        user_id: The user's id
+    """
+    if not settings.SHARED_CACHE:
+        return
+    
+    def bump():
+        key = notifications_version_key(user_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Seed missing counters from the clock so a counter that expired
+            # doesn't restart at a version whose old mark is still cached
+            cache.add(key, time.time_ns() // 1000, settings.NOTIFICATION_POLL_CACHE_TTL)
+            cache.incr(key)
+    transaction.on_commit(bump)
+
+def get_notification_high_water(user_id):
+    """
+    Get the user's notification version and the id of their newest
+    notification cached for it, or (None, None) without a shared cache:
+    a mark in this process's memory can't see notifications other
+    processes create. The mark is None when it isn't cached.
+    
+    Args:
+        user_id: The user's id
+    """
+    if not settings.SHARED_CACHE:
+        return None, None
+    key = notifications_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns() // 1000, settings.NOTIFICATION_POLL_CACHE_TTL)
+        version = cache.get(key)
+    return version, cache.get(high_water_key(user_id, version))
+
+def seed_notification_high_water(user_id, version, notification_id):
+    """
+    Cache a high-water mark read from the database for the version read
+    before the query. A notification created meanwhile has bumped the
+    version, so a mark that misses it is never read.
+    
+    Args:
+        user_id: The user's id
+        version: The version get_notification_high_water returned
+        notification_id: Id of the newest notification read, or 0
+    """
+    if version is None:
+        return
+    cache.add(high_water_key(user_id, version), notification_id, settings.NOTIFICATION_POLL_CACHE_TTL)
+
+def active_rides_key(user_id):
+    return f'active_rides:{user_id}'
+
+def get_active_rides(user):
+    """
+    Get a user's active rides as plain dicts, from the cache when it is
+    shared between processes. Rides a rider is waiting for count as active;
+    a driver's only once accepted.
+    
+    Args:
+        user: The rider or driver
+    """
+    key = active_rides_key(user.id)
+    rides = cache.get(key) if settings.SHARED_CACHE else None
+    if rides is None:
+        if user.is_rider():
+            active = Ride.objects.filter(rider=user, status__in=['REQUESTED', 'ACCEPTED', 'STARTED'])
+        else:
+            active = Ride.objects.filter(driver=user, status__in=['ACCEPTED', 'STARTED'])
+        rides = [
+            {
+                'id': ride_id,
+                'status': status,
+                'is_active': True,
+                'status_message': RIDE_STATUS_MESSAGES.get(status, status),
+                'detail_url': reverse('ride_detail', args=[ride_id])
+            }
+            for ride_id, status in active.order_by('-created_at').values_list('id', 'status')
+        ]
+        if settings.SHARED_CACHE:
+            cache.set(key, rides, settings.NOTIFICATION_POLL_CACHE_TTL)
+    return rides
+
+def invalidate_active_rides(user_ids):
+    """
+    Drop cached active rides. Ride saves do this through signals; ride
+    transitions and other update() calls on rides must call it.
+    
+    Args:
+        user_ids: Ids of the riders and drivers whose rides changed; None
+            entries (rides without a driver) are skipped
+    """
+    cache.delete_many([active_rides_key(user_id) for user_id in user_ids if user_id is not None])
@@ -4,6 +4,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from .models import User, DriverProfile, RiderProfile, Notification
 from rides.models import Ride
+from rides.pricing import surge_engine
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db.models import Count, Sum
 from django.db.models.functions import TruncDate
@@ -12,9 +13,18 @@ from datetime import timedelta
 import json
 from django.core.mail import send_mail
 from django.urls import reverse
-from django.http import JsonResponse
+from django.http import JsonResponse, FileResponse, Http404
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils.cache import patch_cache_control
+from cabby.db_routers import use_read_replica, lag_monitor
+from .utils import invalidate_unread_notifications
+from .presence import presence
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from .uploads import store_upload, thumbnail_worker, LimitedUploadHandler, UploadError, IMAGE_EXTENSIONS, DOCUMENT_EXTENSIONS
 
 def home(request):
     return render(request, 'accounts/home.html')
@@ -70,28 +80,85 @@ def register(request):
     
     return render(request, 'accounts/register.html')
 
+def _profile_upload_fields(user):
+    """(field, storage directory, max size, extensions) of a user's profile uploads."""
+    upload_fields = [('profile_picture', 'avatars', settings.UPLOAD_MAX_AVATAR_SIZE, IMAGE_EXTENSIONS)]
+    if user.is_driver():
+        upload_fields += [
+            ('license_document', 'documents/licenses', settings.UPLOAD_MAX_DOCUMENT_SIZE, DOCUMENT_EXTENSIONS),
+            ('insurance_document', 'documents/insurance', settings.UPLOAD_MAX_DOCUMENT_SIZE, DOCUMENT_EXTENSIONS),
+        ]
+    return upload_fields
+
 @login_required
+@csrf_exempt
 def profile(request):
+    # The size limits are enforced while the body streams in, so the upload
+    # handler has to be in place before anything reads request.POST; the
+    # CSRF check runs afterwards, in _profile
+    upload_handler = None
+    if request.method == 'POST':
+        upload_handler = LimitedUploadHandler({
+            field: max_size for field, _, max_size, _ in _profile_upload_fields(request.user)
+        }, request)
+        request.upload_handlers.insert(0, upload_handler)
+    return _profile(request, upload_handler)
+
+@csrf_protect
+def _profile(request, upload_handler):
     if request.method == 'POST':
         user = request.user
+
+        # Store uploads first so a rejected file leaves the profile untouched;
+        # thumbnails are generated in the background once the save commits
+        uploads = {}
+        # Reading FILES parses the body, which fills in the handler's error
+        files = request.FILES
+        try:
+            if upload_handler.error is not None:
+                raise upload_handler.error
+            for field, directory, max_size, extensions in _profile_upload_fields(user):
+                if field in files:
+                    uploads[field] = store_upload(
+                        files[field], directory, max_size, extensions,
+                        digest=upload_handler.digests.get(field)
+                    )
+        except UploadError as e:
+            messages.error(request, str(e))
+            return redirect('profile')
+
         user.first_name = request.POST.get('first_name')
         user.last_name = request.POST.get('last_name')
         user.phone_number = request.POST.get('phone_number')
-        
-        user.save()
-        
+        user_fields = ['first_name', 'last_name', 'phone_number', 'updated_at']
+        if 'profile_picture' in uploads:
+            user.profile_picture = uploads['profile_picture']
+            user.profile_picture_thumbnail = ''
+            user_fields += ['profile_picture', 'profile_picture_thumbnail']
+            transaction.on_commit(lambda: thumbnail_worker.submit(
+                user, 'profile_picture', 'profile_picture_thumbnail', settings.AVATAR_THUMBNAIL_SIZE
+            ))
+
+        user.save(update_fields=user_fields)
+
         if user.is_driver():
             profile = user.driver_profile
             profile.vehicle_number = request.POST.get('vehicle_number')
             profile.vehicle_type = request.POST.get('vehicle_type')
             profile.license_number = request.POST.get('license_number')
-            
-            if 'license_document' in request.FILES:
-                profile.license_document = request.FILES['license_document']
-            if 'insurance_document' in request.FILES:
-                profile.insurance_document = request.FILES['insurance_document']
-                
-            profile.save()
+            profile_fields = ['vehicle_number', 'vehicle_type', 'license_number']
+
+            for field, thumbnail_field in (('license_document', 'license_thumbnail'),
+                                           ('insurance_document', 'insurance_thumbnail')):
+                if field in uploads:
+                    setattr(profile, field, uploads[field])
+                    setattr(profile, thumbnail_field, '')
+                    profile_fields += [field, thumbnail_field]
+                    transaction.on_commit(lambda field=field, thumbnail_field=thumbnail_field: thumbnail_worker.submit(
+                        profile, field, thumbnail_field, settings.DOCUMENT_THUMBNAIL_SIZE
+                    ))
+
+            profile.save(update_fields=profile_fields)
         elif user.is_rider():
             profile = user.rider_profile
             profile.home_address = request.POST.get('home_address')
@@ -103,6 +170,26 @@ def profile(request):
     
     return render(request, 'accounts/profile.html')
 
+@login_required
+def thumbnail(request, name):
+    """
+    Serve a generated thumbnail. Names are content hashes, so a given URL
+    never changes and browsers may cache it for good. Profile pictures are
+    visible to any signed-in user; document scans only to their driver and
+    staff.
+    """
+    name = f'thumbnails/{name}'
+    if not User.objects.filter(profile_picture_thumbnail=name).exists():
+        documents = DriverProfile.objects.filter(Q(license_thumbnail=name) | Q(insurance_thumbnail=name))
+        if not request.user.is_staff:
+            documents = documents.filter(user=request.user)
+        if not documents.exists():
+            raise Http404
+
+    response = FileResponse(default_storage.open(name, 'rb'), content_type='image/jpeg')
+    patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    return response
+
 @login_required
 def dashboard(request):
     if request.user.is_driver():
@@ -171,6 +258,7 @@ def dashboard(request):
         return render(request, 'accounts/admin_dashboard.html')
 
 @staff_member_required
+@use_read_replica
 def admin_dashboard(request):
     # Get current date range
     today = timezone.now().date()
@@ -221,6 +309,7 @@ def admin_dashboard(request):
     return render(request, 'accounts/admin_dashboard.html', context)
 
 @staff_member_required
+@use_read_replica
 def admin_revenue_data(request):
     period = request.GET.get('period', 'week')
     today = timezone.now().date()
@@ -263,12 +352,12 @@ def admin_revenue_data(request):
 
 @staff_member_required
 def admin_map_data(request):
-    # Get active drivers
-    active_drivers = DriverProfile.objects.filter(
-        is_approved=True,
-        is_active=True,
-        last_location_update__gte=timezone.now() - timedelta(minutes=5)
-    ).select_related('user')
+    # Online drivers with a known position, from the presence registry
+    active_drivers = presence.online_drivers()
+    names = {
+        user.id: user.get_full_name()
+        for user in User.objects.filter(id__in=[driver[0] for driver in active_drivers]).only('id', 'first_name', 'last_name')
+    }
     
     # Get active rides
     active_rides = Ride.objects.filter(
@@ -277,11 +366,11 @@ def admin_map_data(request):
     
     # Format driver data
     drivers_data = [{
-        'id': driver.id,
-        'name': driver.user.get_full_name(),
-        'lat': driver.current_latitude,
-        'lng': driver.current_longitude
-    } for driver in active_drivers]
+        'id': driver_id,
+        'name': names.get(driver_id, ''),
+        'lat': lat,
+        'lng': lng
+    } for driver_id, lat, lng in active_drivers]
     
     # Format ride data
     rides_data = [{
@@ -297,6 +386,25 @@ def admin_map_data(request):
         'rides': rides_data
     })
 
+@staff_member_required
+def admin_replica_status(request):
+    """
+    Report the last measured lag of each read replica.
+    """
+    replicas = {}
+    for alias in settings.DATABASE_REPLICAS:
+        status = lag_monitor.status(alias)
+        replicas[alias] = {
+            'lag_seconds': status['lag'] if status else None,
+            'checked_at': status['checked_at'] if status else None,
+            'healthy': lag_monitor.is_healthy(alias)
+        }
+    
+    return JsonResponse({
+        'replicas': replicas,
+        'max_lag_seconds': settings.REPLICA_MAX_LAG_SECONDS
+    })
+
 @staff_member_required
 def approve_driver(request, user_id):
     if request.method == 'POST':
@@ -337,6 +445,7 @@ def notifications(request):
     # Mark all as read
     if request.method == 'POST':
         unread_notifications.update(is_read=True)
+        invalidate_unread_notifications([request.user.id])
         messages.success(request, 'All notifications marked as read.')
         return redirect('notifications')
     
@@ -353,9 +462,18 @@ def toggle_availability(request):
         return redirect('dashboard')
         
     driver_profile = request.user.driver_profile
-    driver_profile.is_available = not driver_profile.is_available
-    driver_profile.save()
+    is_available = not presence.is_online(request.user.id)
+    
+    # The registry writes the change to the profile with its next batch
+    if is_available:
+        position = presence.position(request.user.id) or (
+            driver_profile.current_latitude, driver_profile.current_longitude)
+        presence.go_online(request.user.id, *position, vehicle_type=driver_profile.vehicle_type)
+        surge_engine.driver_available(request.user.id, *position)
+    else:
+        presence.go_offline(request.user.id)
+        surge_engine.driver_unavailable(request.user.id)
     
     messages.success(request, 
-        'You are now {}line'.format('on' if driver_profile.is_available else 'off'))
+        'You are now {}line'.format('on' if is_available else 'off'))
     return redirect('dashboard')
@@ -19,17 +19,17 @@ django.setup()
 # Then import Django and other modules
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 
 # Import routing modules after Django settings are configured
 from chat.routing import websocket_urlpatterns as chat_websocket_urlpatterns
 from accounts.routing import websocket_urlpatterns as notification_websocket_urlpatterns
+from accounts.middleware import CachedAuthMiddlewareStack
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        CachedAuthMiddlewareStack(
             URLRouter(
                 chat_websocket_urlpatterns + notification_websocket_urlpatterns
             )
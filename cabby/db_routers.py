@@ -0,0 +1,174 @@
+import random
+import time
+from contextvars import ContextVar
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils import timezone
+
+# Apps that always stay on the primary: session reads right after a login
+# must not race replication
+PRIMARY_ONLY_APPS = {'sessions'}
+
+# A lag reading older than this many check intervals means the monitor has
+# stopped, and no longer counts
+STALE_CHECKS = 5
+
+
+class RoutingState:
+    """Per-request routing flags."""
+
+    def __init__(self):
+        self.use_replica = False
+        self.wrote = False
+
+
+_routing_state = ContextVar('db_routing_state', default=None)
+
+
+def sticky_key(user_id):
+    return f'db_sticky_{user_id}'
+
+
+def use_read_replica(view_func):
+    """
+    Serve a read-only view from a read replica.
+
+    Reads stay on the primary for users who wrote within the last
+    REPLICA_STICKY_SECONDS, and for the rest of a request once it writes.
+    Apply it below login_required/staff_member_required so authentication
+    is checked against the primary.
+
+    The stickiness markers and replica lag are shared through the cache, so
+    without SHARED_CACHE every read stays on the primary.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        state = _routing_state.get()
+        if state is None or not settings.DATABASE_REPLICAS or not settings.SHARED_CACHE:
+            return view_func(request, *args, **kwargs)
+
+        user = getattr(request, 'user', None)
+        sticky = user is not None and user.is_authenticated and cache.get(sticky_key(user.id))
+        previous = state.use_replica
+        state.use_replica = not sticky
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            state.use_replica = previous
+    return wrapper
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Track writes made while handling a request and pin the user to the
+    primary for REPLICA_STICKY_SECONDS afterwards (read-your-writes).
+    The stickiness marker lives in the cache, which is why replicas are
+    only used with SHARED_CACHE.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RoutingState()
+        token = _routing_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing_state.reset(token)
+
+        if state.wrote and settings.DATABASE_REPLICAS:
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                cache.set(sticky_key(user.id), True, settings.REPLICA_STICKY_SECONDS)
+        return response
+
+
+class ReplicaLagMonitor:
+    """
+    Measure replication lag with a heartbeat row.
+
+    check() stamps the heartbeat on the primary and reads it back from each
+    replica; the difference is that replica's lag. Results are kept in the
+    cache so every process routes on the same numbers. Replicas lagging by
+    more than REPLICA_MAX_LAG_SECONDS, or unreachable, stop receiving reads,
+    and so do replicas without a check in the last few
+    REPLICA_LAG_CHECK_SECONDS: nothing vouches for them until
+    monitorreplicas runs.
+    """
+
+    def __init__(self, memo_seconds=1.0):
+        self.memo_seconds = memo_seconds
+        self._memo = {}
+
+    def check(self):
+        """Measure every replica now. Returns {alias: lag seconds or None}."""
+        from accounts.models import ReplicaHeartbeat
+
+        now = timezone.now()
+        ReplicaHeartbeat.objects.using('default').update_or_create(pk=1, defaults={'beat_at': now})
+
+        lags = {}
+        for alias in settings.DATABASE_REPLICAS:
+            try:
+                beat_at = ReplicaHeartbeat.objects.using(alias).values_list('beat_at', flat=True).get(pk=1)
+                lag = max(0.0, (now - beat_at).total_seconds())
+            except Exception:
+                # Missing heartbeat or unreachable replica
+                lag = None
+                connections[alias].close()
+            lags[alias] = lag
+            cache.set(f'replica_lag_{alias}', {'lag': lag, 'checked_at': time.time()}, None)
+        self._memo.clear()
+        return lags
+
+    def status(self, alias):
+        """Return the last {'lag', 'checked_at'} recorded for a replica, or None."""
+        memo = self._memo.get(alias)
+        if memo is not None and memo[0] > time.monotonic():
+            return memo[1]
+        status = cache.get(f'replica_lag_{alias}')
+        self._memo[alias] = (time.monotonic() + self.memo_seconds, status)
+        return status
+
+    def is_healthy(self, alias):
+        status = self.status(alias)
+        if status is None or time.time() - status['checked_at'] > STALE_CHECKS * settings.REPLICA_LAG_CHECK_SECONDS:
+            return False
+        return status['lag'] is not None and status['lag'] <= settings.REPLICA_MAX_LAG_SECONDS
+
+
+lag_monitor = ReplicaLagMonitor()
+
+
+class PrimaryReplicaRouter:
+    """
+    Send reads made inside use_read_replica views to a healthy replica and
+    everything else, including every write, to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _routing_state.get()
+        if state is None or not state.use_replica or state.wrote:
+            return None
+        if model._meta.app_label in PRIMARY_ONLY_APPS:
+            return None
+
+        replicas = [alias for alias in settings.DATABASE_REPLICAS if lag_monitor.is_healthy(alias)]
+        return random.choice(replicas) if replicas else None
+
+    def db_for_write(self, model, **hints):
+        state = _routing_state.get()
+        if state is not None and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Primary and replicas hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema through replication
+        return db not in settings.DATABASE_REPLICAS
@@ -0,0 +1,144 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else was passed in extra= and
+# goes into the structured output as a field
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def plain(value):
+    """
+    Copy an extra= value as JSON-ready data: containers are copied and any
+    other object becomes its str(), so nothing the caller holds is read
+    later on the writer thread.
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(key): plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [plain(item) for item in value]
+    return str(value)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with extra= fields as keys."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a share of the records from high-volume loggers.
+
+    rates maps a logger name to the share of its records kept, and applies
+    to its children too (the longest matching name wins). Warnings and
+    errors are always kept.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._cache = {}
+
+    def rate(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            logger_name = name
+            while logger_name:
+                if logger_name in self.rates:
+                    rate = self.rates[logger_name]
+                    break
+                logger_name = logger_name.rpartition('.')[0]
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Hand records to a thread that formats and writes them, so logging from
+    a view or the event loop never waits on stdout.
+
+    Like the stdlib QueueHandler, the message, traceback and extra= values
+    are rendered to strings before a record is queued, so the writer thread
+    never touches the caller's objects; it only builds the line and writes
+    it. When the queue is full, records are dropped and counted rather than
+    blocking the caller.
+    """
+
+    def __init__(self, output='json', stream=None, queue_size=10000):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        target = logging.StreamHandler(stream or sys.stdout)
+        if output == 'json':
+            target.setFormatter(JsonFormatter())
+        else:
+            target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        self.target = target
+        self.listener = QueueListener(self.queue, target)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def prepare(self, record):
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        for key, value in list(vars(record).items()):
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                setattr(record, key, plain(value))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            from cabby.metrics import log_records_dropped
+            log_records_dropped.inc(record.name)
+
+    def stop(self):
+        """Write out everything queued and stop the writer thread."""
+        if self.listener._thread is not None:
+            self.listener.stop()
+            self.target.flush()
+
+    def flush(self):
+        """Wait until every queued record has been written."""
+        if self.listener._thread is not None:
+            self.stop()
+            self.listener.start()
+
+    def close(self):
+        self.stop()
+        super().close()
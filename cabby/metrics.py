@@ -0,0 +1,339 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from .tracing import tracer
+
+# Seconds; upper bounds of the histogram buckets
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named metric with one series per combination of label values.
+
+    Recording holds the metric's lock only for a dict lookup and an add or
+    two, so it is cheap enough to leave on for every request and query.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _check(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {labels}')
+
+    def snapshot(self):
+        with self._lock:
+            return [(labels, list(values)) for labels, values in self._series.items()]
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+        ]
+        for labels, values in sorted(self.snapshot()):
+            lines.extend(self.render_series(labels, values))
+        return lines
+
+    def render_series(self, labels, values):
+        return [f'{self.name}{_labels(self.labelnames, labels)} {_number(values[0])}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._check(labels)
+        with self._lock:
+            values = self._series.get(labels)
+            if values is None:
+                values = self._series[labels] = [0]
+            values[0] += amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With function, the value is read when
+    the metrics are rendered instead of being recorded.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def inc(self, *labels, amount=1):
+        self._check(labels)
+        with self._lock:
+            values = self._series.get(labels)
+            if values is None:
+                values = self._series[labels] = [0]
+            values[0] += amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        self._check(labels)
+        with self._lock:
+            self._series[labels] = [value]
+
+    def snapshot(self):
+        if self.function is not None:
+            return [((), [self.function()])]
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    """
+    Observations counted into buckets by upper bound. Each series holds a
+    count per bucket (not cumulative; summed when rendered), then the sum
+    and count of all observations.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=REQUEST_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        self._check(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._series.get(labels)
+            if values is None:
+                values = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def render_series(self, labels, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, values):
+            cumulative += count
+            lines.append(
+                f'{self.name}_bucket{_labels(self.labelnames, labels, [("le", _number(bound))])} {cumulative}'
+            )
+        lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(values[-2])}')
+        lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {values[-1]}')
+        return lines
+
+
+class Registry:
+    """
+    The metrics of this process, rendered in the Prometheus text format.
+
+    Each worker process keeps its own registry; scrape every worker (or run
+    one) and let Prometheus aggregate.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=REQUEST_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        """Drop every recorded series; for tests."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+
+def count_requested_rides():
+    from rides.models import Ride
+    return Ride.objects.filter(status='REQUESTED').count()
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    'cabby_http_request_duration_seconds',
+    'Time to produce an HTTP response, by URL name.',
+    ('view', 'method', 'status'),
+)
+db_query_duration = registry.histogram(
+    'cabby_db_query_duration_seconds',
+    'Time spent executing database queries.',
+    ('database',),
+    buckets=FAST_BUCKETS,
+)
+websocket_connections = registry.gauge(
+    'cabby_websocket_connections',
+    'Open WebSocket connections, by consumer.',
+    ('consumer',),
+)
+group_sends = registry.counter(
+    'cabby_channel_group_sends_total',
+    'Messages sent to channel layer groups, by event type.',
+    ('event',),
+)
+group_send_duration = registry.histogram(
+    'cabby_channel_group_send_duration_seconds',
+    'Time for a channel layer group_send to complete, by event type.',
+    ('event',),
+    buckets=FAST_BUCKETS,
+)
+log_records_dropped = registry.counter(
+    'cabby_log_records_dropped_total',
+    'Log records dropped because the logging queue was full, by logger.',
+    ('logger',),
+)
+geocode_lookups = registry.counter(
+    'cabby_geocode_lookups_total',
+    'Reverse geocoding lookups, by where the address came from.',
+    ('source',),
+)
+requested_rides = registry.gauge(
+    'cabby_requested_rides',
+    'Rides waiting for a driver.',
+    function=count_requested_rides,
+)
+
+
+class MetricsMiddleware:
+    """
+    Record how long each request takes, labelled by URL name. Goes first
+    in MIDDLEWARE so the time includes the rest of the stack. Streaming
+    responses are timed to their first byte.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        http_request_duration.observe(
+            time.perf_counter() - start,
+            match.view_name if match is not None else 'unmatched',
+            request.method,
+            str(response.status_code),
+        )
+        return response
+
+
+def time_queries(alias):
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            db_query_duration.observe(time.perf_counter() - start, alias)
+    return wrapper
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """Time every query on each new connection, whichever thread opens it."""
+    if not any(getattr(wrapper, 'times_queries', False) for wrapper in connection.execute_wrappers):
+        wrapper = time_queries(connection.alias)
+        wrapper.times_queries = True
+        connection.execute_wrappers.append(wrapper)
+
+
+connection_created.connect(install_query_timer, dispatch_uid='cabby.metrics.install_query_timer')
+
+
+async def group_send(channel_layer, group, event):
+    """
+    channel_layer.group_send, counted and timed by event type. Inside a
+    trace the event carries the trace context to the consumers.
+    """
+    event_type = event.get('type', 'unknown')
+    start = time.perf_counter()
+    try:
+        with tracer.span('channel.group_send', group=group, event=event_type):
+            await channel_layer.group_send(group, tracer.inject(event))
+    finally:
+        group_sends.inc(event_type)
+        group_send_duration.observe(time.perf_counter() - start, event_type)
+
+
+def track_connections(application, consumer):
+    """
+    Wrap a consumer's ASGI application to count its open sockets. The
+    application returns when its socket closes, accepted or not.
+    """
+    async def app(scope, receive, send):
+        websocket_connections.inc(consumer)
+        try:
+            return await application(scope, receive, send)
+        finally:
+            websocket_connections.dec(consumer)
+    return app
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of this process's metrics. Scrapers send
+    METRICS_TOKEN as a bearer token; without one configured only staff can
+    read it.
+    """
+    token = settings.METRICS_TOKEN
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            raise PermissionDenied
+    elif not (request.user.is_authenticated and request.user.is_staff):
+        raise PermissionDenied
+
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,274 @@
+import cProfile
+import inspect
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.http import FileResponse, Http404, JsonResponse
+from django.template.base import Template
+from django.urls import reverse
+
+PROFILE_MODES = ('cprofile', 'sample')
+PROFILE_ID = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+
+# Template.render is the entry point for each template, including included
+# and extended ones; time under it is template rendering
+TEMPLATE_RENDER = (
+    inspect.getsourcefile(Template.render),
+    inspect.getsourcelines(Template.render)[1],
+    'render',
+)
+
+
+def requested_mode(request):
+    """The profiler asked for with X-Profile or ?_profile=, or None."""
+    mode = request.headers.get('X-Profile') or request.GET.get('_profile')
+    if not mode:
+        return None
+    mode = mode.lower()
+    return mode if mode in PROFILE_MODES else 'cprofile'
+
+
+class QueryTimer:
+    """Execute wrapper recording the time and SQL of each query."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - start, sql))
+
+    def summary(self, slowest=5):
+        return {
+            'count': len(self.queries),
+            'time': round(sum(duration for duration, _ in self.queries), 6),
+            'slowest': [
+                {'time': round(duration, 6), 'sql': sql}
+                for duration, sql in sorted(self.queries, key=lambda query: query[0], reverse=True)[:slowest]
+            ],
+        }
+
+
+class StackSampler:
+    """
+    Sample one thread's stack every interval seconds from a helper thread.
+
+    Much cheaper than cProfile on deep call stacks, at the cost of only
+    seeing where time is spent, not call counts.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope."""
+        return ''.join(
+            ';'.join(f'{name} ({os.path.basename(filename)}:{line})' for filename, line, name in stack)
+            + f' {count}\n'
+            for stack, count in self.stacks.most_common()
+        )
+
+    def summary(self, wall_time, limit):
+        total = sum(self.stacks.values()) or 1
+        own, cumulative = Counter(), Counter()
+        template_samples = 0
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                cumulative[function] += count
+            if TEMPLATE_RENDER in stack:
+                template_samples += count
+
+        def seconds(samples):
+            return round(wall_time * samples / total, 6)
+
+        return {
+            'samples': sum(self.stacks.values()),
+            'template_time': seconds(template_samples),
+            'top_functions': [{
+                'function': '{}:{}({})'.format(*function),
+                'self_time': seconds(own[function]),
+                'cumulative_time': seconds(count),
+            } for function, count in cumulative.most_common(limit)],
+        }
+
+
+def cprofile_summary(profiler, limit):
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    entries = sorted(stats.stats.items(), key=lambda entry: entry[1][3], reverse=True)
+    template = stats.stats.get(TEMPLATE_RENDER)
+    return {
+        'template_time': round(template[3], 6) if template else 0,
+        'top_functions': [{
+            'function': f'{filename}:{line}({name})',
+            'calls': calls,
+            'self_time': round(own_time, 6),
+            'cumulative_time': round(cumulative_time, 6),
+        } for (filename, line, name), (_, calls, own_time, cumulative_time, _) in entries[:limit]],
+    }
+
+
+class ProfilingMiddleware:
+    """
+    Profile a request on demand for staff, with cProfile or a stack sampler.
+
+    Send X-Profile: cprofile (or sample), or add ?_profile=cprofile, while
+    logged in as staff. The profile and a JSON summary of the slowest
+    functions, SQL time and template render time are written to
+    PROFILE_ROOT, and the response carries an X-Profile-Id header naming
+    them. Other requests only pay for the header check. One request per
+    process is profiled at a time; others run normally with
+    X-Profile-Status: busy. Streaming responses are profiled up to their
+    first byte.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = requested_mode(request)
+        if mode is None or not (request.user.is_authenticated and request.user.is_staff):
+            return self.get_response(request)
+        if not self._lock.acquire(blocking=False):
+            response = self.get_response(request)
+            response['X-Profile-Status'] = 'busy'
+            return response
+        try:
+            return self.profile(request, mode)
+        finally:
+            self._lock.release()
+
+    def profile(self, request, mode):
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        queries = QueryTimer()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(queries))
+            if mode == 'sample':
+                profiler = stack.enter_context(
+                    StackSampler(threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL_MS / 1000)
+                )
+            else:
+                profiler = cProfile.Profile()
+                stack.callback(profiler.disable)
+                profiler.enable()
+            start = time.perf_counter()
+            response = self.get_response(request)
+        wall_time = time.perf_counter() - start
+
+        limit = settings.PROFILE_TOP_FUNCTIONS
+        if mode == 'sample':
+            summary = profiler.summary(wall_time, limit)
+        else:
+            summary = cprofile_summary(profiler, limit)
+        summary.update({
+            'id': profile_id,
+            'mode': mode,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'wall_time': round(wall_time, 6),
+            'sql': queries.summary(),
+        })
+
+        os.makedirs(settings.PROFILE_ROOT, exist_ok=True)
+        if mode == 'sample':
+            with open(profile_path(profile_id, 'sample'), 'w') as output:
+                output.write(profiler.collapsed())
+        else:
+            profiler.dump_stats(profile_path(profile_id, 'cprofile'))
+        with open(profile_path(profile_id, 'summary'), 'w') as output:
+            json.dump(summary, output, indent=2)
+
+        response['X-Profile-Id'] = profile_id
+        response['X-Profile-Summary'] = reverse('profile_summary', args=[profile_id])
+        return response
+
+
+PROFILE_FILES = {
+    'summary': '.json',
+    'cprofile': '.prof',
+    'sample': '.folded',
+}
+
+
+def profile_path(profile_id, kind):
+    return os.path.join(settings.PROFILE_ROOT, profile_id + PROFILE_FILES[kind])
+
+
+@staff_member_required
+def profile_list(request):
+    """The stored profiles, newest first."""
+    if not os.path.isdir(settings.PROFILE_ROOT):
+        return JsonResponse({'profiles': []})
+    ids = sorted(
+        (name[:-len('.json')] for name in os.listdir(settings.PROFILE_ROOT) if name.endswith('.json')),
+        reverse=True
+    )
+    return JsonResponse({'profiles': [{
+        'id': profile_id,
+        'summary': reverse('profile_summary', args=[profile_id]),
+        'download': reverse('profile_download', args=[profile_id]),
+    } for profile_id in ids]})
+
+
+@staff_member_required
+def profile_summary(request, profile_id):
+    if not PROFILE_ID.match(profile_id):
+        raise Http404
+    try:
+        with open(profile_path(profile_id, 'summary')) as summary:
+            return JsonResponse(json.load(summary))
+    except FileNotFoundError:
+        raise Http404
+
+
+@staff_member_required
+def profile_download(request, profile_id):
+    """The raw profile: a pstats dump, or collapsed stacks from the sampler."""
+    if not PROFILE_ID.match(profile_id):
+        raise Http404
+    for kind in ('cprofile', 'sample'):
+        path = profile_path(profile_id, kind)
+        if os.path.exists(path):
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=os.path.basename(path))
+    raise Http404
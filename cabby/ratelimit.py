@@ -0,0 +1,125 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+
+class LocalBuckets:
+    """
+    Token buckets held in this process. The least recently used buckets are
+    dropped past max_keys; a dropped bucket simply starts full again.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheBuckets:
+    """
+    Token buckets in the Django cache, shared by every worker using the same
+    cache backend. The read-modify-write isn't atomic, so concurrent
+    requests from one user can occasionally get a token or two extra.
+    """
+
+    def take(self, key, rate, burst):
+        # Wall-clock time, since the buckets are shared between processes
+        now = time.time()
+        cache_key = f'ratelimit:{key}'
+        tokens, updated_at = cache.get(cache_key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Kept until the bucket would have refilled anyway
+        cache.set(cache_key, (tokens, now), math.ceil(burst / rate) + 1)
+        return allowed, tokens
+
+    def clear(self):
+        pass
+
+
+class RateLimiter:
+    """
+    Per-user token-bucket limits for classes of endpoints.
+
+    RATE_LIMITS maps a class ('location', 'polling', 'chat') to
+    (tokens per second, burst). Each user gets a bucket per class, shared by
+    every HTTP view and socket in that class.
+    """
+
+    def __init__(self, backend='local'):
+        self.buckets = CacheBuckets() if backend == 'cache' else LocalBuckets()
+
+    def hit(self, limit_class, identity):
+        """
+        Take a token for identity (usually a user id) from limit_class.
+        Returns (allowed, retry_after) where retry_after is the number of
+        seconds until the next token when the call is not allowed.
+        """
+        limit = settings.RATE_LIMITS.get(limit_class)
+        if limit is None:
+            return True, 0
+        rate, burst = limit
+        allowed, tokens = self.buckets.take(f'{limit_class}:{identity}', rate, burst)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def reset(self):
+        self.buckets.clear()
+
+
+rate_limiter = RateLimiter(backend=settings.RATE_LIMIT_BACKEND)
+
+
+def request_identity(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.id}'
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def too_many_requests(retry_after):
+    response = JsonResponse({
+        'error': 'Too many requests. Please slow down.',
+        'retry_after': round(retry_after, 1)
+    }, status=429)
+    response['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+
+def rate_limit(limit_class):
+    """
+    Answer 429 with Retry-After once the caller runs out of tokens for
+    limit_class. Apply it below login_required so the bucket is per user.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            allowed, retry_after = rate_limiter.hit(limit_class, request_identity(request))
+            if not allowed:
+                return too_many_requests(retry_after)
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -59,11 +60,15 @@ INSTALLED_APPS = [
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 MIDDLEWARE = [
+    'cabby.metrics.MetricsMiddleware',
+    'cabby.tracing.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'cabby.profiling.ProfilingMiddleware',
+    'cabby.db_routers.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -96,14 +101,86 @@ ASGI_APPLICATION = 'cabby.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Size of the thread pool that runs sync code (views, database_sync_to_async)
+# under Daphne; asgiref reads the same ASGI_THREADS variable
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', min(32, (os.cpu_count() or 1) + 4)))
+
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgres':
+    # Pooled connections sized to the ASGI thread pool (psycopg 3 with
+    # psycopg-pool); pooling and persistent connections are exclusive
+    DB_POOL = os.getenv('DB_POOL', 'True') == 'True'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'cabby'),
+            'USER': os.getenv('DB_USER', 'cabby'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', ASGI_THREADS)),
+                    'timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+                },
+            } if DB_POOL else {},
+        }
+    }
+else:
+    # SQLite in WAL mode so readers don't block the writer, with writes
+    # taking the lock up front instead of failing on upgrade
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+            'OPTIONS': {
+                # Seconds to wait on a locked database (busy_timeout)
+                'timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 20)),
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE};'
+                    f'PRAGMA synchronous={SQLITE_SYNCHRONOUS};'
+                    f'PRAGMA mmap_size={SQLITE_MMAP_SIZE};'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+        }
     }
-}
 
 
+# Read replicas for read-heavy views: SQLite file paths, or PostgreSQL hosts
+# with DB_ENGINE=postgres, e.g. DB_REPLICAS=replica1.internal,replica2.internal.
+# Replicas get reads only with a shared cache (CACHE_URL) and while
+# `manage.py monitorreplicas` reports them caught up
+DB_REPLICAS = [replica.strip() for replica in os.getenv('DB_REPLICAS', '').split(',') if replica.strip()]
+DATABASE_REPLICAS = []
+for number, replica in enumerate(DB_REPLICAS, start=1):
+    alias = f'replica_{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        'HOST' if DB_ENGINE == 'postgres' else 'NAME': replica,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['cabby.db_routers.PrimaryReplicaRouter']
+
+# Reads stay on the primary this long after a user's own write
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+# Replicas lagging more than this, or not checked for five check intervals,
+# stop receiving reads
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv('REPLICA_LAG_CHECK_SECONDS', 2))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -166,10 +243,286 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 # WebSocket settings
 WEBSOCKET_PORT = 8001
 
-# Channel layers for WebSocket support
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# Channel layers for WebSocket support. The in-memory layer only reaches
+# sockets served by the same process; set CHANNEL_LAYER_URL to a Redis URL
+# such as redis://localhost:6379/0 to share it between the HTTP server,
+# Daphne and the command loops (rundispatch, expirerides, runforecast),
+# which need it to push anything to sockets
+CHANNEL_LAYER_URL = os.getenv('CHANNEL_LAYER_URL', '')
+if CHANNEL_LAYER_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [CHANNEL_LAYER_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+SHARED_CHANNEL_LAYER = bool(CHANNEL_LAYER_URL)
+
+# Cache shared by every process: web workers, Daphne and the management
+# command loops. CACHE_URL is a Redis URL such as redis://localhost:6379/1.
+# Without it each process has a private in-memory cache, and the caches
+# below that other processes must be able to invalidate are turned off
+CACHE_URL = os.getenv('CACHE_URL', '')
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+SHARED_CACHE = bool(CACHE_URL)
+
+# With a shared cache, WebSocket connects resolve the session to a cached
+# user snapshot, and the unread notifications sent on connect are cached
+# too, for this many seconds
+WS_AUTH_CACHE_TTL = int(os.getenv('WS_AUTH_CACHE_TTL', 300))
+
+# The notification polling API answers from cached per-user high-water
+# marks and active-ride snapshots, kept for this many seconds. Only used
+# with a shared cache; a per-process one would miss other processes' writes
+NOTIFICATION_POLL_CACHE_TTL = int(os.getenv('NOTIFICATION_POLL_CACHE_TTL', 300))
+
+# Drivers count as online until they toggle off or send no location ping or
+# socket heartbeat for PRESENCE_TIMEOUT_SECONDS; expiries are checked and
+# availability changes written to the database every PRESENCE_TICK_SECONDS
+PRESENCE_TIMEOUT_SECONDS = int(os.getenv('PRESENCE_TIMEOUT_SECONDS', 90))
+PRESENCE_TICK_SECONDS = int(os.getenv('PRESENCE_TICK_SECONDS', 5))
+
+# Online drivers' positions and availability are shared between the worker
+# processes on a host through the shared memory segment FLEET_SHM_NAME
+# (unset to keep them per process), with room for FLEET_CAPACITY drivers;
+# writers take turns through the lock file FLEET_LOCK_PATH
+FLEET_SHM_NAME = os.getenv('FLEET_SHM_NAME', 'cabby_fleet')
+FLEET_CAPACITY = int(os.getenv('FLEET_CAPACITY', 50000))
+FLEET_LOCK_PATH = os.getenv('FLEET_LOCK_PATH', os.path.join(tempfile.gettempdir(), f'{FLEET_SHM_NAME}.lock'))
+
+# Runs tests against a fleet segment of their own (see cabby.test_runner)
+TEST_RUNNER = 'cabby.test_runner.TestRunner'
+
+# Per-user token buckets, as (tokens per second, burst), for each class of
+# endpoint. 'local' keeps buckets in each process; 'cache' shares them
+# through the cache backend between workers. Location pings over the limit
+# are coalesced and flushed every LOCATION_FLUSH_INTERVAL_SECONDS.
+RATE_LIMITS = {
+    'location': (1, 5),
+    'polling': (0.5, 10),
+    'chat': (2, 10),
+    'geocode': (2, 20),
+}
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'local')
+LOCATION_FLUSH_INTERVAL_SECONDS = float(os.getenv('LOCATION_FLUSH_INTERVAL_SECONDS', 1))
+
+# Per-user replay buffer for notification sockets; reconnecting clients
+# receive the events they missed from here instead of from the database.
+# With a shared cache the events are kept there for NOTIFICATION_REPLAY_TTL
+# seconds, so sockets replay events stamped by other processes; otherwise
+# each process keeps its own buffers for up to NOTIFICATION_REPLAY_MAX_USERS
+NOTIFICATION_REPLAY_BUFFER_SIZE = int(os.getenv('NOTIFICATION_REPLAY_BUFFER_SIZE', 100))
+NOTIFICATION_REPLAY_MAX_USERS = int(os.getenv('NOTIFICATION_REPLAY_MAX_USERS', 10000))
+NOTIFICATION_REPLAY_TTL = int(os.getenv('NOTIFICATION_REPLAY_TTL', 600))
+
+# Batched dispatch: when enabled, `manage.py rundispatch` assigns drivers to
+# requested rides every window and drivers only see rides offered to them
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', 'False') == 'True'
+DISPATCH_WINDOW_SECONDS = float(os.getenv('DISPATCH_WINDOW_SECONDS', 2))
+DISPATCH_MAX_PICKUP_KM = float(os.getenv('DISPATCH_MAX_PICKUP_KM', 20))
+DISPATCH_OFFER_TIMEOUT = int(os.getenv('DISPATCH_OFFER_TIMEOUT', 15))  # seconds
+
+# Side of the square grid cells used for geographic aggregation, in degrees
+GEO_CELL_DEGREES = float(os.getenv('GEO_CELL_DEGREES', 0.01))
+
+# Surge pricing from sliding-window demand and supply counts per cell. The
+# counts live in each process's memory, fed by the requests that process
+# serves (and seeded from the database when it starts), so with several
+# workers the same pickup can be quoted a different multiplier by each
+SURGE_WINDOW_SECONDS = int(os.getenv('SURGE_WINDOW_SECONDS', 600))
+SURGE_BUCKET_SECONDS = int(os.getenv('SURGE_BUCKET_SECONDS', 30))
+SURGE_SENSITIVITY = float(os.getenv('SURGE_SENSITIVITY', 0.5))
+SURGE_MAX_MULTIPLIER = float(os.getenv('SURGE_MAX_MULTIPLIER', 3))
+
+# Demand heatmap: ride requests, completions and cancellations counted per
+# pickup cell of HEATMAP_CELL_DEGREES in buckets of HEATMAP_BUCKET_SECONDS;
+# the admin heatmap covers at most HEATMAP_MAX_WINDOW_HOURS at once
+HEATMAP_CELL_DEGREES = float(os.getenv('HEATMAP_CELL_DEGREES', 0.01))
+HEATMAP_BUCKET_SECONDS = int(os.getenv('HEATMAP_BUCKET_SECONDS', 300))
+HEATMAP_MAX_WINDOW_HOURS = int(os.getenv('HEATMAP_MAX_WINDOW_HOURS', 168))
+
+# Demand forecasting (`manage.py runforecast`): requests per heatmap cell
+# and bucket are smoothed into a time-of-week profile and a short-term
+# level that decays by FORECAST_DAMPING per bucket ahead, learned from
+# FORECAST_HISTORY_DAYS of heatmap history. Every FORECAST_INTERVAL_SECONDS,
+# idle drivers within FORECAST_HINT_RADIUS_KM of a cell expecting at least
+# FORECAST_HINT_MIN_SHORTFALL more requests than it has drivers over the
+# next FORECAST_HORIZON_MINUTES are sent a hint, at most once per
+# FORECAST_HINT_COOLDOWN_SECONDS for the same cell
+FORECAST_HORIZON_MINUTES = int(os.getenv('FORECAST_HORIZON_MINUTES', 30))
+FORECAST_HISTORY_DAYS = int(os.getenv('FORECAST_HISTORY_DAYS', 28))
+FORECAST_SEASON_ALPHA = float(os.getenv('FORECAST_SEASON_ALPHA', 0.3))
+FORECAST_LEVEL_ALPHA = float(os.getenv('FORECAST_LEVEL_ALPHA', 0.5))
+FORECAST_DAMPING = float(os.getenv('FORECAST_DAMPING', 0.8))
+FORECAST_INTERVAL_SECONDS = float(os.getenv('FORECAST_INTERVAL_SECONDS', 60))
+FORECAST_HINT_RADIUS_KM = float(os.getenv('FORECAST_HINT_RADIUS_KM', 3))
+FORECAST_HINT_MIN_SHORTFALL = float(os.getenv('FORECAST_HINT_MIN_SHORTFALL', 2))
+FORECAST_HINT_COOLDOWN_SECONDS = float(os.getenv('FORECAST_HINT_COOLDOWN_SECONDS', 600))
+
+# Server-side fare quotes
+FARE_TARIFFS = {
+    'SEDAN': {'base': 50, 'per_km': 15, 'per_minute': 5, 'minimum': 80},
+    'SUV': {'base': 50, 'per_km': 20, 'per_minute': 5, 'minimum': 100},
+    'VAN': {'base': 50, 'per_km': 25, 'per_minute': 5, 'minimum': 120},
+}
+DEFAULT_VEHICLE_TYPE = 'SEDAN'
+# (start_hour, end_hour, multiplier, label) in local time
+FARE_TIME_OF_DAY_TARIFFS = [
+    (22, 6, 1.25, 'night'),
+    (8, 11, 1.1, 'morning_peak'),
+    (17, 20, 1.1, 'evening_peak'),
+]
+# Route estimates are memoized per pair of cells of this size (~200 m)
+FARE_QUOTE_CELL_DEGREES = float(os.getenv('FARE_QUOTE_CELL_DEGREES', 0.002))
+FARE_ROUTE_CACHE_SIZE = int(os.getenv('FARE_ROUTE_CACHE_SIZE', 10000))
+FARE_ROUTE_CACHE_TTL = int(os.getenv('FARE_ROUTE_CACHE_TTL', 600))  # seconds
+# Road distance is estimated from the straight-line distance
+ROUTE_DETOUR_FACTOR = float(os.getenv('ROUTE_DETOUR_FACTOR', 1.3))
+ROUTE_AVERAGE_SPEED_KMH = float(os.getenv('ROUTE_AVERAGE_SPEED_KMH', 25))
+# Road graph (.npz built with `manage.py buildroadgraph`) used for road
+# distances and ETAs; straight-line estimates are used when unset
+ROAD_GRAPH_PATH = os.getenv('ROAD_GRAPH_PATH', '')
+
+# ETA matrix: cell size for quantizing points, cached rows and their TTL,
+# and the nearest-K driver lookup used by rider and driver screens. Matrix
+# requests are capped per side as well as in total
+ETA_CELL_DEGREES = float(os.getenv('ETA_CELL_DEGREES', 0.002))
+ETA_ROW_CACHE_SIZE = int(os.getenv('ETA_ROW_CACHE_SIZE', 5000))
+ETA_ROW_CACHE_TTL = int(os.getenv('ETA_ROW_CACHE_TTL', 60))
+ETA_NEAREST_DRIVERS = int(os.getenv('ETA_NEAREST_DRIVERS', 50))
+ETA_NEAREST_RADIUS_KM = float(os.getenv('ETA_NEAREST_RADIUS_KM', 5))
+ETA_MATRIX_MAX_CELLS = int(os.getenv('ETA_MATRIX_MAX_CELLS', 10000))
+ETA_MATRIX_MAX_PICKUPS = int(os.getenv('ETA_MATRIX_MAX_PICKUPS', 100))
+ETA_MATRIX_MAX_DRIVERS = int(os.getenv('ETA_MATRIX_MAX_DRIVERS', 1000))
+
+# Reverse geocoding: 'offline' names points from the bundled gazetteer in
+# GEOCODER_PLACES_PATH, 'nominatim' asks the server at GEOCODER_URL.
+# Addresses are cached per cell of GEOCODE_CELL_DEGREES (~55 m), in memory
+# and in the SQLite file GEOCODE_CACHE_PATH (unset to keep them in memory)
+GEOCODER_PROVIDER = os.getenv('GEOCODER_PROVIDER', 'offline')
+GEOCODER_PLACES_PATH = os.getenv('GEOCODER_PLACES_PATH', os.path.join(BASE_DIR, 'rides', 'data', 'places.csv'))
+GEOCODER_URL = os.getenv('GEOCODER_URL', 'https://nominatim.openstreetmap.org/reverse')
+GEOCODER_USER_AGENT = os.getenv('GEOCODER_USER_AGENT', 'cabby')
+GEOCODER_TIMEOUT = float(os.getenv('GEOCODER_TIMEOUT', 5))  # seconds
+GEOCODE_CELL_DEGREES = float(os.getenv('GEOCODE_CELL_DEGREES', 0.0005))
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', 50000))
+GEOCODE_CACHE_PATH = os.getenv('GEOCODE_CACHE_PATH', os.path.join(BASE_DIR, 'geocode.sqlite3'))
+
+# Ride requests nobody accepts are cancelled after this long by the
+# expirerides sweeper, which runs every RIDE_SWEEP_INTERVAL_SECONDS
+RIDE_REQUEST_TTL_SECONDS = int(os.getenv('RIDE_REQUEST_TTL_SECONDS', 600))
+RIDE_SWEEP_INTERVAL_SECONDS = float(os.getenv('RIDE_SWEEP_INTERVAL_SECONDS', 30))
+RIDE_SWEEP_BATCH_SIZE = int(os.getenv('RIDE_SWEEP_BATCH_SIZE', 500))
+
+# Rows fetched per database round trip and written per chunk by the
+# streaming ride history and earnings exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+
+# Rendered PDF receipts and statements (served through views, not MEDIA_URL)
+# and the number of worker processes that render them
+DOCUMENTS_ROOT = os.getenv('DOCUMENTS_ROOT', os.path.join(BASE_DIR, 'documents'))
+DOCUMENT_WORKERS = int(os.getenv('DOCUMENT_WORKERS', 2))
+
+# Profile uploads: size limits in bytes, threads that generate thumbnails,
+# and the longest side of each thumbnail in pixels
+UPLOAD_MAX_DOCUMENT_SIZE = int(os.getenv('UPLOAD_MAX_DOCUMENT_SIZE', 10 * 1024 * 1024))
+UPLOAD_MAX_AVATAR_SIZE = int(os.getenv('UPLOAD_MAX_AVATAR_SIZE', 5 * 1024 * 1024))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2))
+AVATAR_THUMBNAIL_SIZE = int(os.getenv('AVATAR_THUMBNAIL_SIZE', 256))
+DOCUMENT_THUMBNAIL_SIZE = int(os.getenv('DOCUMENT_THUMBNAIL_SIZE', 480))
+
+# Staff can profile a request by sending X-Profile: cprofile (or sample);
+# profiles and their summaries are kept in PROFILE_ROOT
+PROFILE_ROOT = os.getenv('PROFILE_ROOT', os.path.join(BASE_DIR, 'profiles'))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 5))
+PROFILE_TOP_FUNCTIONS = int(os.getenv('PROFILE_TOP_FUNCTIONS', 30))
+
+# End-to-end tracing: the share of HTTP requests traced, and where finished
+# spans go: 'jsonl' appends them to TRACE_FILE, rotated at
+# TRACE_FILE_MAX_BYTES with TRACE_FILE_BACKUPS old files kept, 'memory'
+# keeps recent ones in process. A sampled traceparent header only forces a
+# trace with TRACE_TRUST_TRACEPARENT, for a proxy that sets the header itself
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+TRACE_TRUST_TRACEPARENT = os.getenv('TRACE_TRUST_TRACEPARENT', 'False') == 'True'
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'jsonl')
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(BASE_DIR, 'traces.jsonl'))
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', 64 * 1024 * 1024))
+TRACE_FILE_BACKUPS = int(os.getenv('TRACE_FILE_BACKUPS', 3))
+
+# Prometheus scrapers send this as a bearer token to /metrics; when unset
+# the endpoint is only readable by staff
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Logging goes through a queue to a writer thread (cabby.logconfig), as
+# JSON lines or plain text. LOG_LEVELS sets levels per logger, e.g.
+# LOG_LEVELS=rides.api=DEBUG,accounts.consumers=WARNING, and
+# LOG_SAMPLE_RATES keeps only a share of the records below WARNING from
+# high-volume loggers; a full queue drops records instead of blocking
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_LEVELS = {
+    name.strip(): level.strip().upper()
+    for name, _, level in (item.partition('=') for item in os.getenv('LOG_LEVELS', '').split(','))
+    if name.strip() and level.strip()
+}
+# The test runner raises the handler to this level so test runs only
+# print their results; set TEST_LOG_LEVEL=DEBUG to see every record
+TEST_LOG_LEVEL = os.getenv('TEST_LOG_LEVEL', 'CRITICAL')
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, _, rate in (item.partition('=') for item in os.getenv('LOG_SAMPLE_RATES', 'accounts.consumers=0.1').split(','))
+    if name.strip() and rate.strip()
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'cabby.logconfig.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
+        },
+    },
+    'handlers': {
+        'background': {
+            'class': 'cabby.logconfig.BackgroundHandler',
+            'filters': ['sampling'],
+            'output': LOG_FORMAT,
+            'queue_size': LOG_QUEUE_SIZE,
+        },
+    },
+    'root': {
+        'handlers': ['background'],
+        'level': LOG_LEVEL,
+    },
+    'loggers': {
+        'django': {
+            'handlers': ['background'],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+        **{name: {'level': level} for name, level in LOG_LEVELS.items()},
     },
 }
 
@@ -0,0 +1,46 @@
+import logging
+import os
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from accounts.fleet import fleet
+from accounts.presence import presence
+from cabby.logconfig import BackgroundHandler
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Django's test runner, with the host-wide fleet segment swapped for one
+    of the test run's own so tests never touch a running server's drivers,
+    presence expiry left to the tests instead of a background thread, and
+    the log output raised to TEST_LOG_LEVEL.
+    """
+
+    def log_handlers(self):
+        loggers = [logging.getLogger(), logging.getLogger('django')]
+        return {
+            handler for logger in loggers for handler in logger.handlers
+            if isinstance(handler, BackgroundHandler)
+        }
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        presence.background = False
+        self.log_levels = {handler: handler.level for handler in self.log_handlers()}
+        for handler in self.log_levels:
+            handler.setLevel(settings.TEST_LOG_LEVEL)
+        if fleet is not None:
+            fleet.close()
+            suffix = f'test_{os.getpid()}'
+            fleet.name = f'{fleet.name}_{suffix}'
+            fleet.lock_path = f'{fleet.lock_path}.{suffix}'
+
+    def teardown_test_environment(self, **kwargs):
+        if fleet is not None:
+            fleet.unlink()
+            try:
+                os.remove(fleet.lock_path)
+            except FileNotFoundError:
+                pass
+        for handler, level in self.log_levels.items():
+            handler.setLevel(level)
+        super().teardown_test_environment(**kwargs)
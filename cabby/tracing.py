@@ -0,0 +1,319 @@
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+TRACE_ID = re.compile(r'^[0-9a-f]{32}$')
+SPAN_ID = re.compile(r'^[0-9a-f]{16}$')
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+_current_span = ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    A timed operation in a trace. Times are wall-clock seconds, since one
+    trace crosses the HTTP worker, the channel layer and the socket server.
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'end', 'attributes')
+
+    def __init__(self, trace_id, parent_id, name, attributes, start=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes
+
+    def context(self):
+        """What a channel-layer event or socket message carries onwards."""
+        return {'trace_id': self.trace_id, 'span_id': self.span_id}
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'duration_ms': round((self.end - self.start) * 1000, 3),
+            'attributes': self.attributes,
+        }
+
+
+class MemoryCollector:
+    """Keep the most recent finished spans in this process."""
+
+    def __init__(self, max_spans=10000):
+        self._spans = deque(maxlen=max_spans)
+
+    def export(self, span):
+        self._spans.append(span.to_dict())
+
+    def spans(self, trace_id=None):
+        return [span for span in list(self._spans) if trace_id is None or span['trace_id'] == trace_id]
+
+    def clear(self):
+        self._spans.clear()
+
+
+class JsonLinesExporter:
+    """
+    Append finished spans to a JSON-lines file from a background thread,
+    so recording a span never waits on disk. Every process can append to
+    the same file.
+
+    Once the file reaches max_bytes it is renamed to path.1 (shifting older
+    ones up to path.<backups>) and a new one is started. Spans are dropped
+    while queue_size of them wait to be written.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backups=3, queue_size=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span.to_dict())
+        except queue.Full:
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            spans = [self._queue.get()]
+            while not self._queue.empty():
+                spans.append(self._queue.get())
+            try:
+                self._rotate()
+                with open(self.path, 'a') as output:
+                    output.write(''.join(json.dumps(span) + '\n' for span in spans))
+            except OSError:
+                logger.exception('Writing %d spans failed', len(spans))
+
+    def _rotate(self):
+        try:
+            if os.path.getsize(self.path) < self.max_bytes:
+                return
+        except FileNotFoundError:
+            return
+        # Renames are atomic, so another process rotating at the same time
+        # at worst shifts the backups one further
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{number}'):
+                os.replace(f'{self.path}.{number}', f'{self.path}.{number + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+
+class Tracer:
+    """
+    Create spans for sampled requests and carry their context across the
+    channel layer.
+
+    A trace starts in TracingMiddleware for a sampled HTTP request and is
+    passed along in the 'trace' key of channel-layer events and socket
+    messages. Outside a trace, span() does nothing, so unsampled requests
+    only pay for a context variable lookup.
+
+    Any client can send a traceparent header, so its sampled flag only
+    decides when trust_traceparent is set (a proxy in front rewrites the
+    header); otherwise the request is also subject to sample_rate.
+    """
+
+    def __init__(self, exporter, sample_rate=0.0, trust_traceparent=False):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.trust_traceparent = trust_traceparent
+
+    def _sample(self):
+        return bool(self.sample_rate) and random.random() < self.sample_rate
+
+    def current(self):
+        return _current_span.get()
+
+    @contextmanager
+    def _activate(self, span):
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+            span.end = time.time()
+            self.exporter.export(span)
+
+    @contextmanager
+    def start_trace(self, name, traceparent=None, **attributes):
+        """
+        Root span of a new trace, or a continuation of a W3C traceparent
+        the client sent. Yields None when the trace isn't sampled.
+        """
+        match = TRACEPARENT.match(traceparent or '')
+        if match:
+            trace_id, parent_id, flags = match.groups()
+            sampled = int(flags, 16) & 1 and (self.trust_traceparent or self._sample())
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = self._sample()
+        if not sampled:
+            yield None
+            return
+        with self._activate(Span(trace_id, parent_id, name, attributes)) as span:
+            yield span
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Child of the current span; does nothing outside a trace."""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        with self._activate(Span(parent.trace_id, parent.span_id, name, attributes)) as span:
+            yield span
+
+    @contextmanager
+    def continue_trace(self, carrier, name, **attributes):
+        """
+        Span continuing the trace context carried in an event or message
+        under 'trace'; does nothing when there is none.
+        """
+        context = extract(carrier)
+        if context is None:
+            yield None
+            return
+        with self._activate(Span(context['trace_id'], context['span_id'], name, attributes)) as span:
+            yield span
+
+    def record(self, carrier, name, start, **attributes):
+        """Record a span that began at start and ends now, e.g. a client ack."""
+        context = extract(carrier)
+        if context is None:
+            return None
+        span = Span(context['trace_id'], context['span_id'], name, attributes, start=start)
+        span.end = time.time()
+        self.exporter.export(span)
+        return span
+
+    def inject(self, event):
+        """A copy of event carrying the current span's context, if any."""
+        span = _current_span.get()
+        if span is None:
+            return event
+        return {**event, 'trace': span.context()}
+
+
+def extract(carrier):
+    """Valid trace context from carrier['trace'], or None."""
+    context = carrier.get('trace') if isinstance(carrier, dict) else None
+    if not isinstance(context, dict):
+        return None
+    if not TRACE_ID.match(str(context.get('trace_id'))) or not SPAN_ID.match(str(context.get('span_id'))):
+        return None
+    return context
+
+
+def summarize(spans):
+    """
+    Group spans into traces. For each trace with its root span, returns
+    the root's name, the time from the root's start to the last span's end,
+    the time until the client acknowledged delivery (None without an ack),
+    and the total time spent in each span name.
+    """
+    traces = {}
+    for span in spans:
+        traces.setdefault(span['trace_id'], []).append(span)
+
+    summaries = []
+    for trace_id, trace_spans in traces.items():
+        span_ids = {span['span_id'] for span in trace_spans}
+        roots = [span for span in trace_spans if span['parent_id'] not in span_ids]
+        root = min(roots, key=lambda span: span['start'])
+        acks = [span['end'] for span in trace_spans if span['name'] == 'client.ack']
+        by_name = {}
+        for span in trace_spans:
+            by_name[span['name']] = by_name.get(span['name'], 0) + span['duration_ms']
+        summaries.append({
+            'trace_id': trace_id,
+            'name': root['name'],
+            'total_ms': round((max(span['end'] for span in trace_spans) - root['start']) * 1000, 3),
+            'delivered_ms': round((max(acks) - root['start']) * 1000, 3) if acks else None,
+            'spans_ms': by_name,
+        })
+    return summaries
+
+
+def trace_writes(execute, sql, params, many, context):
+    """Execute wrapper giving each INSERT, UPDATE and DELETE its own span."""
+    if not sql.lstrip()[:6].upper().startswith(WRITE_STATEMENTS):
+        return execute(sql, params, many, context)
+    with tracer.span('db.write', database=context['connection'].alias, sql=sql[:200]):
+        return execute(sql, params, many, context)
+
+
+class TracingMiddleware:
+    """
+    Start a trace for a sampled request (TRACE_SAMPLE_RATE, or a sampled
+    traceparent header from a trusted proxy) and add a span for each
+    database write it makes.
+    The response names the trace in X-Trace-Id.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        name = f'http {request.method} {request.path}'
+        with tracer.start_trace(name, request.headers.get('traceparent')) as span:
+            if span is None:
+                return self.get_response(request)
+            with connections['default'].execute_wrapper(trace_writes):
+                response = self.get_response(request)
+            # Name the trace by URL name so traces of one endpoint group together
+            match = getattr(request, 'resolver_match', None)
+            if match is not None:
+                span.name = f'http {request.method} {match.view_name}'
+            span.attributes.update({'path': request.path, 'status': response.status_code})
+            response['X-Trace-Id'] = span.trace_id
+            return response
+
+
+def build_exporter():
+    if settings.TRACE_EXPORTER == 'jsonl':
+        return JsonLinesExporter(
+            settings.TRACE_FILE,
+            max_bytes=settings.TRACE_FILE_MAX_BYTES,
+            backups=settings.TRACE_FILE_BACKUPS,
+        )
+    return MemoryCollector()
+
+
+tracer = Tracer(
+    build_exporter(),
+    sample_rate=settings.TRACE_SAMPLE_RATE,
+    trust_traceparent=settings.TRACE_TRUST_TRACEPARENT,
+)
@@ -18,9 +18,15 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from cabby.metrics import metrics_view
+from cabby.profiling import profile_download, profile_list, profile_summary
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
+    path('profiles/', profile_list, name='profile_list'),
+    path('profiles/<str:profile_id>/', profile_summary, name='profile_summary'),
+    path('profiles/<str:profile_id>/download/', profile_download, name='profile_download'),
     path('', include('accounts.urls')),
     path('rides/', include('rides.urls')),
     path('chat/', include('chat.urls')),
@@ -6,6 +6,8 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from .models import Message
 from rides.models import Ride
+from cabby.metrics import group_send
+from cabby.ratelimit import rate_limiter
 from accounts.models import Notification
 
 User = get_user_model()
@@ -49,6 +51,19 @@ class ChatConsumer(WebsocketConsumer):
     
     # Receive message from WebSocket
     def receive(self, text_data):
+        # Shares the 'chat' bucket with the HTTP send_message view; frames
+        # over the limit are dropped and the client told to back off
+        user = self.scope.get('user', AnonymousUser())
+        identity = f'user:{user.id}' if user.is_authenticated else f"ip:{(self.scope.get('client') or [''])[0]}"
+        allowed, retry_after = rate_limiter.hit('chat', identity)
+        if not allowed:
+            self.send(text_data=json.dumps({
+                'type': 'throttled',
+                'error': 'You are sending messages too fast.',
+                'retry_after': round(retry_after, 1)
+            }))
+            return
+        
         text_data_json = json.loads(text_data)
         message = text_data_json.get('message', '')
         ride_id = text_data_json.get('ride_id', '')
@@ -85,7 +100,8 @@ class ChatConsumer(WebsocketConsumer):
             )
             
             # Send message to room group
-            async_to_sync(self.channel_layer.group_send)(
+            async_to_sync(group_send)(
+                self.channel_layer,
                 self.room_group_name,
                 {
                     'type': 'chat_message',
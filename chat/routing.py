@@ -1,7 +1,8 @@
 from django.urls import re_path
+from cabby.metrics import track_connections
 from . import consumers
 
 websocket_urlpatterns = [
     # Fix the WebSocket URL pattern - no leading 'ws/' since it's added by the protocol router
-    re_path(r'chat/(?P<ride_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'chat/(?P<ride_id>\w+)/$', track_connections(consumers.ChatConsumer.as_asgi(), 'ChatConsumer')),
 ]
\ No newline at end of file
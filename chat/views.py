@@ -3,6 +3,7 @@ from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 from django.db.models import Q
 from rides.models import Ride
+from cabby.ratelimit import rate_limit
 from .models import Message
 from django.utils import timezone
 import json
@@ -67,6 +68,7 @@ def get_messages(request, ride_id):
     return JsonResponse(messages_data, safe=False)
 
 @login_required
+@rate_limit('chat')
 def send_message(request, ride_id):
     ride = get_object_or_404(Ride, id=ride_id)
     
@@ -1,10 +1,15 @@
+import logging
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 from django.conf import settings
 from django.utils import timezone
 from .models import Ride
 from accounts.models import Notification
+from cabby.ratelimit import rate_limit
 
+logger = logging.getLogger(__name__)
+
+@rate_limit('polling')
 def ride_status(request, ride_id):
     """
     API endpoint to get the current status of a ride.
@@ -17,8 +22,12 @@ def ride_status(request, ride_id):
     # Get the ride
     ride = get_object_or_404(Ride, id=ride_id)
     
-    # Debug info
-    print(f"Ride status request: Ride #{ride_id}, User: {request.user.username}, Is rider: {ride.rider == request.user}, Is driver: {ride.driver == request.user if ride.driver else False}")
+    logger.debug('Ride status request', extra={
+        'ride_id': ride.id,
+        'user_id': request.user.id,
+        'is_rider': ride.rider_id == request.user.id,
+        'is_driver': ride.driver_id == request.user.id,
+    })
     
     # Fixed authorization check - use driver_profile instead of driverprofile
     if ride.rider != request.user and ride.driver != request.user:
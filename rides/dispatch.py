@@ -0,0 +1,211 @@
+import time
+from datetime import timedelta
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+from accounts.models import DriverProfile, Notification
+from accounts.presence import presence
+from accounts.utils import send_notification
+from .models import Ride
+
+# Kilometres per degree of latitude, and per degree of longitude at the equator
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LNG = 111.320
+
+# Cost given to driver/ride pairs outside the pickup radius. It has to stay
+# finite so the solver can always complete the assignment.
+UNREACHABLE_COST = 1e6
+
+
+def pickup_cost_matrix(driver_coords, pickup_coords):
+    """
+    Build the driver x ride cost matrix in one vectorized pass.
+
+    Args:
+        driver_coords: (n, 2) array of driver latitude/longitude in degrees
+        pickup_coords: (m, 2) array of pickup latitude/longitude in degrees
+
+    Returns an (n, m) float32 array of approximate pickup distances in km.
+    Points are projected onto a local equirectangular plane, which is
+    accurate to well under 1% at city scale and several times cheaper than
+    evaluating haversine for every pair.
+    """
+    driver_coords = np.asarray(driver_coords, dtype=np.float64)
+    pickup_coords = np.asarray(pickup_coords, dtype=np.float64)
+
+    origin_lat = np.radians(np.concatenate([driver_coords[:, 0], pickup_coords[:, 0]]).mean())
+    km_per_lng = KM_PER_DEGREE_LNG * np.cos(origin_lat)
+
+    driver_x = (driver_coords[:, 1] * km_per_lng).astype(np.float32)
+    driver_y = (driver_coords[:, 0] * KM_PER_DEGREE_LAT).astype(np.float32)
+    pickup_x = (pickup_coords[:, 1] * km_per_lng).astype(np.float32)
+    pickup_y = (pickup_coords[:, 0] * KM_PER_DEGREE_LAT).astype(np.float32)
+
+    dx = driver_x[:, None] - pickup_x[None, :]
+    dy = driver_y[:, None] - pickup_y[None, :]
+    return np.sqrt(dx * dx + dy * dy)
+
+
+def solve_assignment(cost, max_cost):
+    """
+    Solve the driver/ride assignment optimally.
+
+    Uses scipy's linear_sum_assignment (a shortest augmenting path variant
+    of the Hungarian method), which handles rectangular matrices. Pairs
+    costing more than max_cost are treated as unassigned.
+
+    Returns (driver_indices, ride_indices) of the matched pairs.
+    """
+    if cost.size == 0:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+
+    cost = np.where(cost > max_cost, UNREACHABLE_COST, cost)
+    rows, cols = linear_sum_assignment(cost)
+    matched = cost[rows, cols] <= max_cost
+    return rows[matched], cols[matched]
+
+
+def offered_ride_ids(driver):
+    """
+    Get the ids of rides currently offered to a driver by the dispatcher.
+    Offers are RIDE_REQUEST notifications younger than the offer timeout.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.DISPATCH_OFFER_TIMEOUT)
+    return set(Notification.objects.filter(
+        user=driver,
+        type='RIDE_REQUEST',
+        related_to_type='Ride',
+        created_at__gte=cutoff
+    ).values_list('related_to_id', flat=True))
+
+
+class Dispatcher:
+    """
+    Batched dispatcher that assigns available drivers to requested rides.
+
+    Each window collects every unoffered REQUESTED ride and every idle,
+    available driver, solves the global assignment on the pickup distance
+    matrix and pushes one offer per matched driver through the notification
+    channel. Unaccepted offers expire after DISPATCH_OFFER_TIMEOUT seconds
+    and the ride goes back into the pool, but is never offered again to a
+    driver who already let it expire.
+
+    Offers reach drivers' sockets through the channel layer, so when run
+    from its own process (rundispatch) the layer must be shared with the
+    servers; see CHANNEL_LAYER_URL.
+    """
+
+    def __init__(self, window=None, max_pickup_km=None, offer_timeout=None):
+        self.window = window or settings.DISPATCH_WINDOW_SECONDS
+        self.max_pickup_km = max_pickup_km or settings.DISPATCH_MAX_PICKUP_KM
+        self.offer_timeout = offer_timeout or settings.DISPATCH_OFFER_TIMEOUT
+
+    def live_offers(self):
+        """Return (driver_ids, ride_ids) tied up in offers that haven't expired."""
+        cutoff = timezone.now() - timedelta(seconds=self.offer_timeout)
+        offers = Notification.objects.filter(
+            type='RIDE_REQUEST',
+            related_to_type='Ride',
+            created_at__gte=cutoff
+        ).values_list('user_id', 'related_to_id')
+
+        driver_ids, ride_ids = set(), set()
+        for driver_id, ride_id in offers:
+            driver_ids.add(driver_id)
+            ride_ids.add(ride_id)
+        return driver_ids, ride_ids
+
+    def past_offers(self, ride_ids):
+        """Return the (driver_id, ride_id) pairs ever offered among these rides."""
+        return set(Notification.objects.filter(
+            type='RIDE_REQUEST',
+            related_to_type='Ride',
+            related_to_id__in=[int(ride_id) for ride_id in ride_ids]
+        ).values_list('user_id', 'related_to_id'))
+
+    def collect(self):
+        """
+        Collect the rides and drivers for this window as parallel arrays.
+        Returns (ride_ids, pickup_coords, driver_ids, driver_coords).
+        """
+        offered_drivers, offered_rides = self.live_offers()
+
+        rides = list(Ride.objects.filter(
+            status='REQUESTED',
+            driver__isnull=True
+        ).exclude(
+            id__in=offered_rides
+        ).values_list('id', 'pickup_latitude', 'pickup_longitude'))
+
+        busy_drivers = set(Ride.objects.filter(
+            status__in=['ACCEPTED', 'STARTED'],
+            driver__isnull=False
+        ).values_list('driver_id', flat=True))
+
+        drivers = [
+            driver for driver in presence.online_drivers()
+            if driver[0] not in busy_drivers and driver[0] not in offered_drivers
+        ]
+
+        ride_ids = np.array([ride[0] for ride in rides], dtype=np.int64)
+        pickup_coords = np.array([ride[1:] for ride in rides], dtype=np.float64).reshape(-1, 2)
+        driver_ids = np.array([driver[0] for driver in drivers], dtype=np.int64)
+        driver_coords = np.array([driver[1:] for driver in drivers], dtype=np.float64).reshape(-1, 2)
+        return ride_ids, pickup_coords, driver_ids, driver_coords
+
+    def run_once(self):
+        """
+        Run one dispatch window. Returns the list of (driver_id, ride_id)
+        offers that were sent.
+        """
+        ride_ids, pickup_coords, driver_ids, driver_coords = self.collect()
+        if not len(ride_ids) or not len(driver_ids):
+            return []
+
+        cost = pickup_cost_matrix(driver_coords, pickup_coords)
+        driver_positions = {driver_id: d for d, driver_id in enumerate(driver_ids.tolist())}
+        ride_positions = {ride_id: r for r, ride_id in enumerate(ride_ids.tolist())}
+        for driver_id, ride_id in self.past_offers(ride_ids):
+            if driver_id in driver_positions and ride_id in ride_positions:
+                cost[driver_positions[driver_id], ride_positions[ride_id]] = np.inf
+        driver_index, ride_index = solve_assignment(cost, self.max_pickup_km)
+
+        offers = []
+        for d, r in zip(driver_index, ride_index):
+            offers.append((int(driver_ids[d]), int(ride_ids[r]), float(cost[d, r])))
+        self.send_offers(offers)
+        return [(driver_id, ride_id) for driver_id, ride_id, _ in offers]
+
+    def send_offers(self, offers):
+        """Push ride offers to the matched drivers."""
+        rides = Ride.objects.in_bulk([ride_id for _, ride_id, _ in offers])
+        drivers = {
+            profile.user_id: profile.user
+            for profile in DriverProfile.objects.filter(
+                user_id__in=[driver_id for driver_id, _, _ in offers]
+            ).select_related('user')
+        }
+
+        for driver_id, ride_id, distance in offers:
+            ride = rides.get(ride_id)
+            if ride is None:
+                continue
+            send_notification(
+                user=drivers[driver_id],
+                title='New Ride Offer',
+                message=f"Pickup {distance:.1f} km away at {ride.pickup_address}. Fare: ₹{ride.fare}",
+                related_to=ride,
+                action_url=reverse('ride_detail', args=[ride_id]),
+                notification_type='RIDE_REQUEST'
+            )
+
+    def run_forever(self):
+        """Run dispatch windows back to back until interrupted."""
+        while True:
+            started = time.monotonic()
+            self.run_once()
+            elapsed = time.monotonic() - started
+            time.sleep(max(0, self.window - elapsed))
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Sum
+from django.urls import reverse
+from django.utils import timezone
+from accounts.models import User
+from accounts.utils import send_notification
+from . import pdf
+from .models import Ride
+
+# Bump when the PDF layout changes so cached documents are re-rendered
+LAYOUT_VERSION = 2
+
+
+def content_hash(data):
+    """Short hash of the document data and layout version."""
+    payload = json.dumps([LAYOUT_VERSION, data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def receipt_data(ride):
+    """Collect everything a receipt shows as plain, picklable data."""
+    profile = getattr(ride.driver, 'driver_profile', None)
+    return {
+        'ride_id': ride.id,
+        'completed_at': timezone.localtime(ride.completed_at).strftime('%d %b %Y, %H:%M'),
+        'rider': ride.rider.get_full_name() or ride.rider.username,
+        'driver': ride.driver.get_full_name() or ride.driver.username,
+        'vehicle': f'{profile.vehicle_type} {profile.vehicle_number}' if profile else '-',
+        'pickup_address': ride.pickup_address,
+        'dropoff_address': ride.dropoff_address,
+        'distance': str(ride.distance) if ride.distance is not None else None,
+        'duration': ride.duration,
+        'fare': str(ride.fare),
+    }
+
+
+def statement_data(driver, year, month):
+    """Collect a driver's completed rides for one month as plain data."""
+    rides = Ride.objects.filter(
+        driver=driver,
+        status='COMPLETED',
+        completed_at__year=year,
+        completed_at__month=month
+    ).order_by('completed_at')
+    total = rides.aggregate(total=Sum('fare'))['total'] or 0
+    profile = getattr(driver, 'driver_profile', None)
+
+    return {
+        'driver': driver.get_full_name() or driver.username,
+        'vehicle': f'{profile.vehicle_type} {profile.vehicle_number}' if profile else '-',
+        'period_label': date(year, month, 1).strftime('%B %Y'),
+        'total': str(total),
+        'rides': [{
+            'ride_id': ride_id,
+            'completed_at': timezone.localtime(completed_at).strftime('%d %b %Y'),
+            'pickup_address': pickup_address,
+            'dropoff_address': dropoff_address,
+            'distance': str(distance) if distance is not None else None,
+            'fare': str(fare),
+        } for ride_id, completed_at, pickup_address, dropoff_address, distance, fare in rides.values_list(
+            'id', 'completed_at', 'pickup_address', 'dropoff_address', 'distance', 'fare'
+        ).iterator()],
+    }
+
+
+class DocumentRenderer:
+    """
+    Render PDFs in a pool of worker processes with an on-disk cache.
+
+    Documents are named by what they cover (ride id, or driver and month)
+    plus a hash of their content, so a cached file is reused until the
+    underlying data changes. Rendering never runs on the request thread:
+    callers get the cached path straight away or a pending result, and the
+    requester is notified through send_notification once the file exists.
+    """
+
+    def __init__(self, root, workers=2):
+        self.root = root
+        self.workers = workers
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned workers don't inherit the server's threads or
+                # database connections
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def path_for(self, kind, name, data):
+        directory = os.path.join(self.root, kind)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f'{name}-{content_hash(data)}.pdf')
+
+    def _submit(self, render_func, path, data, notify):
+        """
+        Return path if the document is cached. Otherwise start rendering it
+        (once, however many times it is requested) and return None; notify
+        is a (user_id, title, message, action_url) tuple sent when done.
+        """
+        if os.path.exists(path):
+            return path
+
+        with self._lock:
+            waiters = self._pending.get(path)
+            if waiters is not None:
+                # Already rendering; just notify this requester too
+                if notify not in waiters:
+                    waiters.append(notify)
+                return None
+            self._pending[path] = [notify]
+
+        future = self.executor.submit(render_func, data, path)
+        future.add_done_callback(lambda future: self._finished(future, path))
+        return None
+
+    def _finished(self, future, path):
+        with self._lock:
+            waiters = self._pending.pop(path, [])
+
+        # Runs on the executor's callback thread, outside any request
+        close_old_connections()
+        try:
+            users = User.objects.in_bulk([user_id for user_id, _, _, _ in waiters])
+            for user_id, title, message, action_url in waiters:
+                user = users.get(user_id)
+                if user is None:
+                    # Deleted while the document was rendering
+                    continue
+                if future.exception() is not None:
+                    send_notification(
+                        user=user,
+                        title=f'{title} failed',
+                        message='We could not generate your document. Please try again later.',
+                        notification_type='SYSTEM'
+                    )
+                else:
+                    send_notification(
+                        user=user,
+                        title=f'{title} ready',
+                        message=message,
+                        action_url=action_url,
+                        notification_type='SYSTEM'
+                    )
+        finally:
+            close_old_connections()
+
+    def receipt(self, ride, requested_by):
+        """Get the cached receipt path for a completed ride, or start rendering it."""
+        data = receipt_data(ride)
+        path = self.path_for('receipts', f'ride-{ride.id}', data)
+        return self._submit(pdf.render_receipt, path, data, (
+            requested_by.id,
+            f'Receipt for ride #{ride.id}',
+            'Your ride receipt is ready to download.',
+            reverse('ride_receipt', args=[ride.id])
+        ))
+
+    def statement(self, driver, year, month):
+        """Get the cached monthly statement path for a driver, or start rendering it."""
+        data = statement_data(driver, year, month)
+        path = self.path_for('statements', f'driver-{driver.id}-{year}-{month:02d}', data)
+        return self._submit(pdf.render_statement, path, data, (
+            driver.id,
+            f"Statement for {data['period_label']}",
+            'Your monthly earnings statement is ready to download.',
+            f"{reverse('earnings_statement')}?month={year}-{month:02d}"
+        ))
+
+
+document_renderer = DocumentRenderer(
+    root=settings.DOCUMENTS_ROOT,
+    workers=settings.DOCUMENT_WORKERS,
+)
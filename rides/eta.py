@@ -0,0 +1,153 @@
+import numpy as np
+from django.conf import settings
+from accounts.presence import presence
+from .fares import RouteEstimateCache
+from .geo import cell_for, cell_center
+from .road_network import get_road_network
+
+EARTH_RADIUS_KM = 6371
+
+
+def haversine_matrix(origins, destinations):
+    """
+    Great-circle distances between every origin and every destination.
+
+    Args:
+        origins: (n, 2) sequence of latitude/longitude in degrees
+        destinations: (m, 2) sequence of latitude/longitude in degrees
+
+    Returns an (n, m) float64 array of distances in km, computed in one
+    vectorized pass.
+    """
+    origins = np.radians(np.asarray(origins, dtype=np.float64).reshape(-1, 2))
+    destinations = np.radians(np.asarray(destinations, dtype=np.float64).reshape(-1, 2))
+
+    dlat = destinations[None, :, 0] - origins[:, None, 0]
+    dlng = destinations[None, :, 1] - origins[:, None, 1]
+    a = (
+        np.sin(dlat / 2) ** 2
+        + np.cos(origins[:, 0])[:, None] * np.cos(destinations[:, 0])[None, :] * np.sin(dlng / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def nearest_drivers(lat, lng, k=None, radius_km=None):
+    """
+    Find the online drivers closest to a point.
+
+    Candidates come from the presence registry's grid cells around the point
+    and are ranked with one vectorized distance pass. Returns a list of
+    (driver_id, latitude, longitude, distance_km), nearest first.
+    """
+    k = settings.ETA_NEAREST_DRIVERS if k is None else k
+    radius_km = radius_km or settings.ETA_NEAREST_RADIUS_KM
+    lat, lng = float(lat), float(lng)
+
+    candidates = presence.within(lat, lng, radius_km)
+    if not candidates:
+        return []
+
+    coords = np.array([candidate[1:] for candidate in candidates], dtype=np.float64)
+    distances = haversine_matrix(coords, [(lat, lng)])[:, 0]
+    order = np.argsort(distances)[:k]
+    return [
+        (candidates[i][0], candidates[i][1], candidates[i][2], float(distances[i]))
+        for i in order
+        if distances[i] <= radius_km
+    ]
+
+
+class ETAMatrixService:
+    """
+    Many-to-many travel distance and time between origins and destinations.
+
+    Every origin/destination is quantized to an ETA_CELL_DEGREES cell and
+    all rows missing from the cache are computed together: a vectorized
+    haversine matrix scaled by the detour factor, refined with one graph
+    search per destination when a road graph is configured. Rows are cached
+    per (origin cell, destination cells), so a driver who hasn't left their
+    cell keeps hitting the same entry while the pickup set is unchanged.
+    """
+
+    def __init__(self, cell_degrees=0.002, cache_size=5000, ttl=60):
+        self.cell_degrees = cell_degrees
+        self.row_cache = RouteEstimateCache(max_size=cache_size, ttl=ttl)
+
+    def _compute(self, origin_cells, destination_cells):
+        origins = np.array([cell_center(cell, self.cell_degrees) for cell in origin_cells])
+        destinations = np.array([cell_center(cell, self.cell_degrees) for cell in destination_cells])
+
+        distance = haversine_matrix(origins, destinations) * settings.ROUTE_DETOUR_FACTOR
+        minutes = distance / settings.ROUTE_AVERAGE_SPEED_KMH * 60
+
+        network = get_road_network()
+        if network is not None:
+            # One reverse search per destination covers every origin
+            for j, (lat, lng) in enumerate(destinations):
+                for i, result in enumerate(network.routes(lat, lng, origins, reverse=True)):
+                    if result is not None:
+                        distance[i, j], minutes[i, j] = result
+        return distance, minutes
+
+    def matrix(self, origins, destinations, use_cache=True):
+        """
+        Compute the travel matrix between origins and destinations.
+
+        Args:
+            origins: Sequence of (lat, lng) the trips start from, e.g. drivers
+            destinations: Sequence of (lat, lng) the trips end at, e.g. pickups
+            use_cache: Reuse and store rows in the row cache
+
+        Returns (distance_km, minutes) as (n, m) float64 arrays.
+        """
+        size = self.cell_degrees
+        destination_cells = tuple(cell_for(lat, lng, size) for lat, lng in destinations)
+        distance = np.zeros((len(origins), len(destination_cells)))
+        minutes = np.zeros((len(origins), len(destination_cells)))
+        if not len(origins) or not destination_cells:
+            return distance, minutes
+
+        # Fill cached rows, and group the rest by origin cell
+        missing = {}
+        for i, (lat, lng) in enumerate(origins):
+            key = (cell_for(lat, lng, size), destination_cells)
+            row = self.row_cache.get(key) if use_cache else None
+            if row is None:
+                missing.setdefault(key[0], []).append(i)
+            else:
+                distance[i], minutes[i] = row
+
+        if missing:
+            origin_cells = list(missing)
+            computed_distance, computed_minutes = self._compute(origin_cells, destination_cells)
+            for k, cell in enumerate(origin_cells):
+                if use_cache:
+                    self.row_cache.set(
+                        (cell, destination_cells),
+                        (computed_distance[k].copy(), computed_minutes[k].copy())
+                    )
+                for i in missing[cell]:
+                    distance[i] = computed_distance[k]
+                    minutes[i] = computed_minutes[k]
+
+        return distance, minutes
+
+    def for_drivers(self, driver_ids, destinations):
+        """
+        Compute the travel matrix from online drivers' current positions.
+
+        Drivers who are offline or without a known position are left out.
+        Returns (driver_ids, distance_km, minutes) with one row per returned
+        driver.
+        """
+        positions = {driver_id: presence.position(driver_id) for driver_id in driver_ids}
+        found = [driver_id for driver_id in driver_ids if positions[driver_id] is not None]
+        distance, minutes = self.matrix([positions[driver_id] for driver_id in found], destinations)
+        return found, distance, minutes
+
+
+eta_service = ETAMatrixService(
+    cell_degrees=settings.ETA_CELL_DEGREES,
+    cache_size=settings.ETA_ROW_CACHE_SIZE,
+    ttl=settings.ETA_ROW_CACHE_TTL,
+)
@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, ROUND_CEILING
+from django.conf import settings
+from django.utils import timezone
+from .geo import cell_for, cell_center
+from .pricing import surge_engine
+from .road_network import route_estimate
+
+
+class RouteEstimateCache:
+    """
+    LRU cache with a TTL for route estimates.
+
+    Keys are pairs of quantized pickup/dropoff cells, so a rider dragging a
+    map pin around the same spot keeps hitting the same entry. Hits and
+    misses are counted so the hit ratio can be monitored.
+    """
+
+    def __init__(self, max_size=10000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Store value under key, evicting the least recently used entry."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return hit/miss counters and the hit ratio."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+        }
+
+
+route_cache = RouteEstimateCache(
+    max_size=settings.FARE_ROUTE_CACHE_SIZE,
+    ttl=settings.FARE_ROUTE_CACHE_TTL,
+)
+
+
+def estimate_route(pickup_lat, pickup_lng, dropoff_lat, dropoff_lng):
+    """
+    Estimate the road distance (km) and duration (minutes) of a trip.
+
+    The estimate is routed over the road graph (falling back to a detoured
+    straight line) between the centres of the quantized pickup and dropoff
+    cells, so every point inside the same pair of cells shares one cache
+    entry. Returns (distance_km, duration_minutes, cached).
+    """
+    size = settings.FARE_QUOTE_CELL_DEGREES
+    key = (cell_for(pickup_lat, pickup_lng, size), cell_for(dropoff_lat, dropoff_lng, size))
+
+    estimate = route_cache.get(key)
+    if estimate is not None:
+        return estimate + (True,)
+
+    origin = cell_center(key[0], size)
+    destination = cell_center(key[1], size)
+    distance, duration = route_estimate(origin[0], origin[1], destination[0], destination[1])
+
+    estimate = (round(distance, 2), max(1, round(duration)))
+    route_cache.set(key, estimate)
+    return estimate + (False,)
+
+
+def time_of_day_tariff(when=None):
+    """
+    Return the (multiplier, label) of the time-of-day tariff in force.
+    Tariff windows are [start_hour, end_hour) in local time and may wrap
+    past midnight.
+    """
+    hour = timezone.localtime(when).hour
+    for start, end, multiplier, label in settings.FARE_TIME_OF_DAY_TARIFFS:
+        if start <= end:
+            in_window = start <= hour < end
+        else:
+            in_window = hour >= start or hour < end
+        if in_window:
+            return Decimal(str(multiplier)), label
+    return Decimal('1.0'), 'standard'
+
+
+def quote_fare(vehicle_type, pickup_lat, pickup_lng, dropoff_lat, dropoff_lng, when=None):
+    """
+    Quote a fare for a trip.
+
+    Args:
+        vehicle_type: Key of FARE_TARIFFS; unknown types use DEFAULT_VEHICLE_TYPE
+        pickup_lat, pickup_lng: Pickup coordinates
+        dropoff_lat, dropoff_lng: Dropoff coordinates
+        when: Optional datetime for the time-of-day tariff (defaults to now)
+
+    Returns a dict with the route estimate, the fare breakdown and the total
+    as Decimals, rounded up to a whole rupee.
+    """
+    if vehicle_type not in settings.FARE_TARIFFS:
+        vehicle_type = settings.DEFAULT_VEHICLE_TYPE
+    tariff = settings.FARE_TARIFFS[vehicle_type]
+
+    distance, duration, cached = estimate_route(pickup_lat, pickup_lng, dropoff_lat, dropoff_lng)
+    time_multiplier, time_label = time_of_day_tariff(when)
+    surge_multiplier = surge_engine.multiplier(pickup_lat, pickup_lng)
+
+    base_fare = Decimal(str(tariff['base']))
+    distance_fare = Decimal(str(tariff['per_km'])) * Decimal(str(distance))
+    time_fare = Decimal(str(tariff['per_minute'])) * duration
+    subtotal = max(base_fare + distance_fare + time_fare, Decimal(str(tariff['minimum'])))
+    total = (subtotal * time_multiplier * surge_multiplier).quantize(Decimal('1'), rounding=ROUND_CEILING)
+
+    return {
+        'vehicle_type': vehicle_type,
+        'distance': distance,
+        'duration': duration,
+        'base_fare': base_fare.quantize(Decimal('0.01')),
+        'distance_fare': distance_fare.quantize(Decimal('0.01')),
+        'time_fare': time_fare.quantize(Decimal('0.01')),
+        'time_of_day': time_label,
+        'time_of_day_multiplier': time_multiplier,
+        'surge_multiplier': surge_multiplier,
+        'total': total,
+        'cached': cached,
+    }
@@ -0,0 +1,260 @@
+import logging
+import math
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections
+from accounts.presence import presence
+from accounts.utils import broadcast
+from .eta import haversine_matrix
+from .geo import cell_center, cell_for
+from .models import DemandBucket, Ride
+
+logger = logging.getLogger(__name__)
+
+WEEK_SECONDS = 7 * 24 * 3600
+
+
+class DemandForecaster:
+    """
+    Short-term ride request forecasts for every heatmap cell at once.
+
+    Requests are counted per cell in the heatmap's time buckets. Each cell
+    keeps a time-of-week profile (the smoothed count for every bucket of
+    the week) and a level (the smoothed difference between recent buckets
+    and the profile). The forecast for k buckets ahead is the profile for
+    that bucket plus the level damped by damping ** k. State is held in
+    numpy arrays with one row per cell, so closing a bucket or forecasting
+    the whole city is a handful of vectorized operations.
+
+    Counts come from DemandBucket, which bookings update as they happen on
+    any worker; sync() picks up what changed since the last call.
+    """
+
+    def __init__(self, bucket_seconds, season_alpha=0.3, level_alpha=0.5, damping=0.8):
+        self.bucket_seconds = bucket_seconds
+        self.season_alpha = season_alpha
+        self.level_alpha = level_alpha
+        self.damping = damping
+        self.slots = WEEK_SECONDS // bucket_seconds
+
+        self.cells = {}
+        self.cell_list = []
+        self.season = np.zeros((0, self.slots), dtype=np.float32)
+        self.level = np.zeros(0, dtype=np.float32)
+        self.current = np.zeros(0, dtype=np.float32)
+        # Weeks of history behind each slot of the profile
+        self.weeks_seen = np.zeros(self.slots, dtype=np.int32)
+        self.bucket = None
+
+    def _index(self, cell):
+        index = self.cells.get(cell)
+        if index is None:
+            index = self.cells[cell] = len(self.cell_list)
+            self.cell_list.append(cell)
+            if index == len(self.level):
+                capacity = max(64, 2 * index)
+                self.season = np.resize(self.season, (capacity, self.slots))
+                self.season[index:] = 0
+                self.level = np.concatenate([self.level, np.zeros(capacity - index, dtype=np.float32)])
+                self.current = np.concatenate([self.current, np.zeros(capacity - index, dtype=np.float32)])
+        return index
+
+    def bucket_for(self, moment):
+        return int(moment.timestamp() // self.bucket_seconds)
+
+    def advance(self, bucket):
+        """Close every bucket before bucket, folding its counts into the state."""
+        if self.bucket is None:
+            self.bucket = bucket
+            return
+        # Beyond a week without data, only the last week's buckets matter
+        self.bucket = max(self.bucket, bucket - self.slots)
+        count = len(self.cell_list)
+        season, level, current = self.season[:count], self.level[:count], self.current[:count]
+        while self.bucket < bucket:
+            slot = self.bucket % self.slots
+            # The first weeks set the profile outright, later ones blend in
+            alpha = max(self.season_alpha, 1 / (self.weeks_seen[slot] + 1))
+            if self.weeks_seen[slot]:
+                level *= self.damping
+                level += self.level_alpha * (current - season[:, slot] - level)
+            season[:, slot] += alpha * (current - level - season[:, slot])
+            self.weeks_seen[slot] += 1
+            current[:] = 0
+            self.bucket += 1
+
+    def observe(self, bucket, counts):
+        """
+        Set the request counts of an open bucket, as {cell: count}. Buckets
+        already closed are ignored.
+        """
+        if self.bucket is not None and bucket < self.bucket:
+            return
+        for cell in counts:
+            self._index(cell)
+        self.advance(bucket)
+        for cell, count in counts.items():
+            self.current[self.cells[cell]] = count
+
+    def sync(self, now=None):
+        """
+        Fold in the DemandBucket rows from the open bucket onwards and close
+        the buckets that ended before now.
+        """
+        now = now or datetime.now(dt_timezone.utc)
+        if self.bucket is None:
+            self.bucket = self.bucket_for(now - timedelta(days=settings.FORECAST_HISTORY_DAYS))
+        since = datetime.fromtimestamp(self.bucket * self.bucket_seconds, dt_timezone.utc)
+        rows = DemandBucket.objects.filter(
+            period_start__gte=since,
+            requested__gt=0
+        ).order_by('period_start').values_list('period_start', 'cell_row', 'cell_col', 'requested')
+
+        counts, bucket = {}, None
+        for period_start, row, col, requested in rows.iterator():
+            row_bucket = self.bucket_for(period_start)
+            if row_bucket != bucket:
+                if counts:
+                    self.observe(bucket, counts)
+                counts, bucket = {}, row_bucket
+            counts[(row, col)] = requested
+        if counts:
+            self.observe(bucket, counts)
+        self.advance(self.bucket_for(now))
+
+    def predict(self, horizon_minutes):
+        """
+        Expected requests per cell over the buckets after the open one,
+        covering horizon_minutes. Returns (cells, counts): an (n, 2) array of
+        (row, col) and an (n,) array of expected requests.
+        """
+        count = len(self.cell_list)
+        steps = max(1, math.ceil(horizon_minutes * 60 / self.bucket_seconds))
+        if not count or self.bucket is None:
+            return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.float32)
+        slots = (self.bucket + 1 + np.arange(steps)) % self.slots
+        decay = (self.damping ** np.arange(1, steps + 1)).astype(np.float32)
+        expected = self.season[:count][:, slots] + self.level[:count, None] * decay[None, :]
+        return (
+            np.array(self.cell_list, dtype=np.int64).reshape(-1, 2),
+            np.maximum(expected, 0).sum(axis=1),
+        )
+
+
+class RepositioningHints:
+    """
+    Tell idle drivers about nearby cells expected to need more drivers than
+    they have.
+
+    For each cell, the shortfall is the forecast requests over the horizon
+    minus the idle drivers already in it. Every idle driver outside a cell
+    short of at least min_shortfall drivers, and within radius_km of one,
+    is sent the nearest such cell. A driver isn't sent the same cell again
+    within cooldown seconds. Hints reach drivers through the channel layer,
+    so runforecast only delivers them when it is shared with the servers
+    (CHANNEL_LAYER_URL).
+    """
+
+    def __init__(self, forecaster, horizon_minutes, radius_km, min_shortfall, cooldown):
+        self.forecaster = forecaster
+        self.horizon_minutes = horizon_minutes
+        self.radius_km = radius_km
+        self.min_shortfall = min_shortfall
+        self.cooldown = cooldown
+        self._sent = {}  # driver_id -> (cell, monotonic time)
+
+    def idle_drivers(self):
+        busy = set(Ride.objects.filter(
+            status__in=['ACCEPTED', 'STARTED'],
+            driver__isnull=False
+        ).values_list('driver_id', flat=True))
+        return [driver for driver in presence.online_drivers() if driver[0] not in busy]
+
+    def run_once(self, now=None):
+        """Refresh the forecast and push hints. Returns the (driver_id, cell) pairs sent."""
+        now_monotonic = time.monotonic()
+        # Forget hints past their cooldown, so drivers who went offline
+        # don't stay here for the life of the process
+        self._sent = {
+            driver_id: last for driver_id, last in self._sent.items()
+            if now_monotonic - last[1] < self.cooldown
+        }
+        self.forecaster.sync(now)
+        cells, expected = self.forecaster.predict(self.horizon_minutes)
+        drivers = self.idle_drivers()
+        if not len(cells) or not drivers:
+            return []
+
+        size = settings.HEATMAP_CELL_DEGREES
+        driver_cells = [cell_for(lat, lng, size) for _, lat, lng in drivers]
+        supply = {}
+        for cell in driver_cells:
+            supply[cell] = supply.get(cell, 0) + 1
+        shortfall = expected - np.array([supply.get(tuple(cell), 0) for cell in cells.tolist()], dtype=np.float32)
+        hot = np.flatnonzero(shortfall >= self.min_shortfall)
+        if not len(hot):
+            return []
+
+        centers = np.array([cell_center(cell, size) for cell in cells[hot].tolist()], dtype=np.float64)
+        distances = haversine_matrix([driver[1:] for driver in drivers], centers)
+        # A driver already in a hot cell stays put
+        hot_cells = {tuple(cell) for cell in cells[hot].tolist()}
+
+        messages, sent = [], []
+        for i, (driver_id, _, _) in enumerate(drivers):
+            if driver_cells[i] in hot_cells:
+                continue
+            nearest = int(np.argmin(distances[i]))
+            if distances[i, nearest] > self.radius_km:
+                continue
+            index = hot[nearest]
+            cell = tuple(cells[index].tolist())
+            last = self._sent.get(driver_id)
+            if last is not None and last[0] == cell:
+                continue
+            self._sent[driver_id] = (cell, now_monotonic)
+            lat, lng = cell_center(cell, size)
+            messages.append((f'user_{driver_id}_notifications', {
+                'type': 'demand_hint',
+                'lat': round(lat, 6),
+                'lng': round(lng, 6),
+                'distance_km': round(float(distances[i, nearest]), 2),
+                'expected_requests': round(float(expected[index]), 1),
+                'horizon_minutes': self.horizon_minutes,
+                'message': f'High demand expected {distances[i, nearest]:.1f} km away in the next {self.horizon_minutes} minutes',
+            }))
+            sent.append((driver_id, cell))
+
+        broadcast(messages)
+        logger.info('Sent %d demand hints', len(sent), extra={'hot_cells': len(hot)})
+        return sent
+
+    def run_forever(self, interval):
+        while True:
+            started = time.monotonic()
+            close_old_connections()
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Demand forecast failed')
+            finally:
+                close_old_connections()
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+def build_hints():
+    forecaster = DemandForecaster(
+        settings.HEATMAP_BUCKET_SECONDS,
+        season_alpha=settings.FORECAST_SEASON_ALPHA,
+        level_alpha=settings.FORECAST_LEVEL_ALPHA,
+        damping=settings.FORECAST_DAMPING,
+    )
+    return RepositioningHints(
+        forecaster,
+        horizon_minutes=settings.FORECAST_HORIZON_MINUTES,
+        radius_km=settings.FORECAST_HINT_RADIUS_KM,
+        min_shortfall=settings.FORECAST_HINT_MIN_SHORTFALL,
+        cooldown=settings.FORECAST_HINT_COOLDOWN_SECONDS,
+    )
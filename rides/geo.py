@@ -0,0 +1,33 @@
+from math import floor, sin, cos, sqrt, atan2, radians
+from django.conf import settings
+
+
+def cell_for(lat, lng, size=None):
+    """
+    Return the (row, col) of the square grid cell containing a point.
+    Cells are GEO_CELL_DEGREES on a side (0.01 degrees is roughly 1.1 km).
+    """
+    size = size or settings.GEO_CELL_DEGREES
+    return (floor(float(lat) / size), floor(float(lng) / size))
+
+
+def cell_center(cell, size=None):
+    """Return the (lat, lng) at the centre of a grid cell."""
+    size = size or settings.GEO_CELL_DEGREES
+    row, col = cell
+    return ((row + 0.5) * size, (col + 0.5) * size)
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    R = 6371  # Earth's radius in kilometers
+    
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1-a))
+    distance = R * c
+    
+    return distance
@@ -0,0 +1,239 @@
+import csv
+import json
+import logging
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from django.conf import settings
+from cabby.metrics import geocode_lookups
+from .geo import calculate_distance, cell_center, cell_for
+
+logger = logging.getLogger(__name__)
+
+# Grid used to index the offline gazetteer's landmarks; a 3x3 block of
+# cells around a point covers LANDMARK_RADIUS_KM
+PLACE_CELL_DEGREES = 0.02
+LANDMARK_RADIUS_KM = 1.5
+CITY_RADIUS_KM = 40
+
+
+class GeocodingProvider:
+    """
+    Turns coordinates into an address. reverse() returns the address text,
+    or None when the provider has no answer or can't be reached.
+    """
+
+    name = None
+
+    def reverse(self, lat, lng):
+        raise NotImplementedError
+
+
+class OfflineProvider(GeocodingProvider):
+    """
+    Names points from a bundled gazetteer of cities and landmarks, without
+    any network access. A point near a landmark (an airport, a station) is
+    named after it; elsewhere the coordinates are given with the nearest
+    city.
+    """
+
+    name = 'offline'
+
+    def __init__(self, places):
+        self.cities = []
+        self.landmarks = {}
+        for place in places:
+            if place['kind'] == 'city':
+                self.cities.append(place)
+            else:
+                cell = cell_for(place['lat'], place['lng'], PLACE_CELL_DEGREES)
+                self.landmarks.setdefault(cell, []).append(place)
+
+    @classmethod
+    def from_csv(cls, path):
+        """Load a gazetteer with name, city, kind, lat and lng columns."""
+        with open(path, newline='') as places:
+            return cls([
+                {**row, 'lat': float(row['lat']), 'lng': float(row['lng'])}
+                for row in csv.DictReader(places)
+            ])
+
+    def _nearest(self, places, lat, lng, radius_km):
+        nearest, nearest_distance = None, radius_km
+        for place in places:
+            distance = calculate_distance(lat, lng, place['lat'], place['lng'])
+            if distance <= nearest_distance:
+                nearest, nearest_distance = place, distance
+        return nearest
+
+    def reverse(self, lat, lng):
+        row, col = cell_for(lat, lng, PLACE_CELL_DEGREES)
+        nearby = [
+            place
+            for dr in (-1, 0, 1)
+            for dc in (-1, 0, 1)
+            for place in self.landmarks.get((row + dr, col + dc), ())
+        ]
+        landmark = self._nearest(nearby, lat, lng, LANDMARK_RADIUS_KM)
+        if landmark is not None:
+            return f"Near {landmark['name']}, {landmark['city']}"
+        city = self._nearest(self.cities, lat, lng, CITY_RADIUS_KM)
+        if city is not None:
+            return f"{lat:.5f}, {lng:.5f}, {city['name']}"
+        return f'{lat:.5f}, {lng:.5f}'
+
+
+class NominatimProvider(GeocodingProvider):
+    """Reverse geocoding with a Nominatim server (OpenStreetMap's by default)."""
+
+    name = 'nominatim'
+
+    def __init__(self, url, user_agent, timeout=5):
+        self.url = url
+        self.user_agent = user_agent
+        self.timeout = timeout
+
+    def reverse(self, lat, lng):
+        query = urllib.parse.urlencode({'format': 'jsonv2', 'lat': lat, 'lon': lng})
+        request = urllib.request.Request(f'{self.url}?{query}', headers={'User-Agent': self.user_agent})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response).get('display_name')
+        except (OSError, ValueError) as e:
+            logger.warning('Reverse geocoding failed', extra={'lat': lat, 'lng': lng, 'error': str(e)})
+            return None
+
+
+class DiskCache:
+    """
+    Addresses kept in a SQLite file, so they survive restarts and are
+    shared by every worker process on the host.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS geocode ('
+                'provider TEXT, cell_degrees REAL, cell_row INTEGER, cell_col INTEGER, '
+                'address TEXT, created REAL, '
+                'PRIMARY KEY (provider, cell_degrees, cell_row, cell_col))'
+            )
+            self._connection = connection
+        return self._connection
+
+    def get(self, key):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT address FROM geocode '
+                'WHERE provider = ? AND cell_degrees = ? AND cell_row = ? AND cell_col = ?',
+                key
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, address):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?)', (*key, address, time.time()))
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class Geocoder:
+    """
+    Reverse geocoding through a provider, cached per grid cell.
+
+    Points are quantized to cells of cell_degrees (0.0005 degrees is about
+    55 m), and every point in a cell gets the address of the cell's centre.
+    Lookups try an in-memory LRU of cache_size cells first, then the disk
+    cache, and only then the provider; pickups cluster around stations and
+    airports, so most are answered from memory without I/O. Provider
+    failures aren't cached.
+    """
+
+    def __init__(self, provider, cell_degrees, cache_size=50000, disk=None):
+        self.provider = provider
+        self.cell_degrees = cell_degrees
+        self.cache_size = cache_size
+        self.disk = disk
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reverse(self, lat, lng):
+        """Return (address, source), source being memory, disk or provider."""
+        cell = cell_for(lat, lng, self.cell_degrees)
+        with self._lock:
+            address = self._entries.get(cell)
+            if address is not None:
+                self._entries.move_to_end(cell)
+        if address is not None:
+            geocode_lookups.inc('memory')
+            return address, 'memory'
+
+        key = (self.provider.name, self.cell_degrees, *cell)
+        source = 'disk'
+        address = self.disk.get(key) if self.disk is not None else None
+        if address is None:
+            source = 'provider'
+            address = self.provider.reverse(*cell_center(cell, self.cell_degrees))
+            if address is None:
+                geocode_lookups.inc('failed')
+                return None, None
+            if self.disk is not None:
+                self.disk.set(key, address)
+        geocode_lookups.inc(source)
+
+        with self._lock:
+            self._entries[cell] = address
+            self._entries.move_to_end(cell)
+            while len(self._entries) > self.cache_size:
+                self._entries.popitem(last=False)
+        return address, source
+
+    def address(self, lat, lng):
+        """The address of a point, or its coordinates if none is found."""
+        address, _ = self.reverse(lat, lng)
+        return address or f'{float(lat):.5f}, {float(lng):.5f}'
+
+    def stats(self):
+        return {
+            'provider': self.provider.name,
+            'cell_degrees': self.cell_degrees,
+            'size': len(self._entries),
+            'max_size': self.cache_size,
+        }
+
+    def clear(self):
+        """Drop the in-memory entries; for tests."""
+        with self._lock:
+            self._entries.clear()
+
+
+def build_provider():
+    if settings.GEOCODER_PROVIDER == 'nominatim':
+        return NominatimProvider(settings.GEOCODER_URL, settings.GEOCODER_USER_AGENT, settings.GEOCODER_TIMEOUT)
+    return OfflineProvider.from_csv(settings.GEOCODER_PLACES_PATH)
+
+
+geocoder = Geocoder(
+    build_provider(),
+    cell_degrees=settings.GEOCODE_CELL_DEGREES,
+    cache_size=settings.GEOCODE_CACHE_SIZE,
+    disk=DiskCache(settings.GEOCODE_CACHE_PATH) if settings.GEOCODE_CACHE_PATH else None,
+)
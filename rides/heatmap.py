@@ -0,0 +1,90 @@
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F, Sum
+from .geo import cell_for
+from .models import DemandBucket
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('requested', 'completed', 'cancelled')
+
+
+def period_start(moment, bucket_seconds=None):
+    """Start of the time bucket holding moment, as an aware UTC datetime."""
+    bucket_seconds = bucket_seconds or settings.HEATMAP_BUCKET_SECONDS
+    timestamp = moment.timestamp()
+    return datetime.fromtimestamp(timestamp - timestamp % bucket_seconds, dt_timezone.utc)
+
+
+def record(event, rides, at):
+    """
+    Count rides under event in the bucket of their pickup cell.
+
+    Args:
+        event: 'requested', 'completed' or 'cancelled'
+        rides: Rides with their pickup coordinates loaded
+        at: When the event happened
+
+    Each (bucket, cell) row is incremented in place, so a batch of rides
+    costs one UPDATE per distinct cell. The heatmap is advisory: a failed
+    write is logged, not raised into the booking or ride flow.
+    """
+    start = period_start(at)
+    counts = Counter(
+        cell_for(ride.pickup_latitude, ride.pickup_longitude, settings.HEATMAP_CELL_DEGREES)
+        for ride in rides
+    )
+    try:
+        for (row, col), count in counts.items():
+            _increment(start, row, col, event, count)
+    except DatabaseError:
+        logger.exception('Recording %s rides in the demand heatmap failed', event)
+
+
+def _increment(start, row, col, event, count):
+    bucket = DemandBucket.objects.filter(period_start=start, cell_row=row, cell_col=col)
+    if bucket.update(**{event: F(event) + count}):
+        return
+    try:
+        with transaction.atomic():
+            DemandBucket.objects.create(period_start=start, cell_row=row, cell_col=col, **{event: count})
+    except IntegrityError:
+        # Another worker created the row first
+        bucket.update(**{event: F(event) + count})
+
+
+def heatmap(since, until, bounds=None):
+    """
+    Event counts per cell between since and until, summed over the buckets
+    in that window only.
+
+    Args:
+        since, until: The window; widened to whole buckets
+        bounds: Optional (south, west, north, east) box in degrees
+
+    Returns the window actually covered and the cells, each as
+    [row, col, requested, completed, cancelled].
+    """
+    since = period_start(since)
+    until = period_start(until - timedelta(microseconds=1)) + timedelta(seconds=settings.HEATMAP_BUCKET_SECONDS)
+
+    buckets = DemandBucket.objects.filter(period_start__gte=since, period_start__lt=until)
+    if bounds is not None:
+        south, west, north, east = bounds
+        min_row, min_col = cell_for(south, west, settings.HEATMAP_CELL_DEGREES)
+        max_row, max_col = cell_for(north, east, settings.HEATMAP_CELL_DEGREES)
+        buckets = buckets.filter(
+            cell_row__gte=min_row, cell_row__lte=max_row,
+            cell_col__gte=min_col, cell_col__lte=max_col
+        )
+
+    cells = buckets.values('cell_row', 'cell_col').annotate(
+        **{f'total_{event}': Sum(event) for event in EVENTS}
+    ).order_by('cell_row', 'cell_col')
+    return since, until, [
+        [cell['cell_row'], cell['cell_col'], *(cell[f'total_{event}'] for event in EVENTS)]
+        for cell in cells
+    ]
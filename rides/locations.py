@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from accounts.models import DriverProfile
+
+logger = logging.getLogger(__name__)
+
+
+class LocationCoalescer:
+    """
+    Hold driver location pings that arrive faster than the rate limit and
+    write only the latest one per driver.
+
+    A daemon thread flushes pending positions every interval seconds in one
+    transaction, so a client pinging every 100 ms costs one row update per
+    interval instead of ten writes a second. Pings within the limit are
+    written straight away with write(), which drops any pending position for
+    the driver; writes and flushes are serialized so an older pending
+    position never lands after a newer one.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, driver_id, lat, lng):
+        with self._lock:
+            self._pending[driver_id] = (lat, lng)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='location-coalescer', daemon=True)
+                self._thread.start()
+
+    def write(self, driver_id, lat, lng):
+        """Write a driver's position now, superseding any pending one."""
+        with self._write_lock:
+            with self._lock:
+                self._pending.pop(driver_id, None)
+            DriverProfile.objects.filter(user_id=driver_id).update(
+                current_latitude=lat,
+                current_longitude=lng
+            )
+
+    def flush(self):
+        """Write the pending positions. Returns how many drivers were updated."""
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            with transaction.atomic():
+                for driver_id, (lat, lng) in pending.items():
+                    DriverProfile.objects.filter(user_id=driver_id).update(
+                        current_latitude=lat,
+                        current_longitude=lng
+                    )
+        return len(pending)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Location flush failed')
+            finally:
+                close_old_connections()
+
+
+location_coalescer = LocationCoalescer(interval=settings.LOCATION_FLUSH_INTERVAL_SECONDS)
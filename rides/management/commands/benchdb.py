@@ -0,0 +1,142 @@
+import copy
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, OperationalError
+from accounts.models import User
+from chat.models import Message
+from rides.models import Ride
+
+def sqlite_mode(journal_mode, synchronous, conn_max_age):
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'CONN_MAX_AGE': conn_max_age,
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': f'PRAGMA journal_mode={journal_mode};PRAGMA synchronous={synchronous};',
+        },
+    }
+
+# The old defaults (rollback journal, a new connection per request) and
+# the tuned SQLite setup; 'configured' benchmarks DATABASES['default'],
+# e.g. PostgreSQL with DB_ENGINE=postgres
+MODES = {
+    'sqlite-rollback': sqlite_mode('DELETE', 'FULL', 0),
+    'sqlite-wal': sqlite_mode('WAL', 'NORMAL', None),
+    'configured': None,
+}
+
+class Command(BaseCommand):
+    help = 'Compare database write throughput for ride bookings and chat messages across configurations'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--modes',
+            default='sqlite-rollback,sqlite-wal,configured',
+            help=f'Comma-separated modes: {", ".join(MODES)}',
+        )
+        parser.add_argument('--threads', type=int, default=settings.ASGI_THREADS)
+        parser.add_argument('--ops', type=int, default=200, help='Writes per thread per workload')
+
+    def handle(self, *args, **options):
+        modes = [mode.strip() for mode in options['modes'].split(',') if mode.strip()]
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f'Unknown modes: {", ".join(sorted(unknown))}')
+
+        self.stdout.write(f'{options["threads"]} threads x {options["ops"]} writes per workload')
+        for mode in modes:
+            with tempfile.TemporaryDirectory() as directory:
+                alias = self.setup_database(mode, directory)
+                try:
+                    rider, driver, ride = self.fixtures(alias)
+                    for workload in ('book_ride', 'chat'):
+                        rate, errors = self.run(alias, workload, rider, driver, ride, options['threads'], options['ops'])
+                        self.stdout.write(
+                            f'{mode:16} {workload:10} {rate:10.0f} writes/s'
+                            + (f'  ({errors} failed)' if errors else '')
+                        )
+                finally:
+                    connections[alias].creation.destroy_test_db(verbosity=0)
+                    connections[alias].close()
+                    del connections.settings[alias]
+
+    def setup_database(self, mode, directory):
+        """Create and migrate a throwaway database for a mode; returns its alias."""
+        alias = f'bench_{mode.replace("-", "_")}'
+        config = copy.deepcopy(connections.settings['default'])
+        if MODES[mode] is not None:
+            config.update(copy.deepcopy(MODES[mode]))
+        if config['ENGINE'] == 'django.db.backends.sqlite3':
+            config['TEST'] = {**config.get('TEST', {}), 'NAME': os.path.join(directory, 'bench.sqlite3')}
+        connections.settings[alias] = config
+        connections[alias].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        return alias
+
+    def fixtures(self, alias):
+        rider = User.objects.db_manager(alias).create_user('bench_rider', password=None, role='RIDER')
+        driver = User.objects.db_manager(alias).create_user('bench_driver', password=None, role='DRIVER')
+        ride = Ride.objects.using(alias).create(
+            rider=rider,
+            driver=driver,
+            pickup_address='Bench pickup',
+            dropoff_address='Bench dropoff',
+            pickup_latitude=18.52,
+            pickup_longitude=73.85,
+            dropoff_latitude=18.55,
+            dropoff_longitude=73.90,
+            fare=150,
+            status='ACCEPTED'
+        )
+        return rider, driver, ride
+
+    def run(self, alias, workload, rider, driver, ride, threads, ops):
+        """Run a workload on all threads; returns (writes per second, failures)."""
+        errors = []
+        barrier = threading.Barrier(threads + 1)
+
+        def worker():
+            connection = connections[alias]
+            barrier.wait()
+            for i in range(ops):
+                try:
+                    if workload == 'book_ride':
+                        Ride.objects.using(alias).create(
+                            rider=rider,
+                            pickup_address='Bench pickup',
+                            dropoff_address='Bench dropoff',
+                            pickup_latitude=18.52,
+                            pickup_longitude=73.85,
+                            dropoff_latitude=18.55,
+                            dropoff_longitude=73.90,
+                            fare=150,
+                            distance=5,
+                            duration=12,
+                            status='REQUESTED'
+                        )
+                    else:
+                        Message.objects.using(alias).create(
+                            ride=ride,
+                            sender=driver if i % 2 else rider,
+                            content=f'Bench message {i}',
+                            is_read=False
+                        )
+                except OperationalError:
+                    errors.append(1)
+                # What Django does at the end of every request
+                connection.close_if_unusable_or_obsolete()
+            connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return threads * ops / elapsed, len(errors)
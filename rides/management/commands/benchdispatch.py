@@ -0,0 +1,45 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from rides.dispatch import pickup_cost_matrix, solve_assignment
+
+class Command(BaseCommand):
+    help = 'Benchmark building and solving one dispatch window on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=5000)
+        parser.add_argument('--rides', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument(
+            '--max-pickup-km',
+            type=float,
+            default=20,
+            help='Pickup radius beyond which pairs are left unassigned',
+        )
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        # Spread drivers and pickups over a ~30 x 30 km city
+        drivers = np.column_stack([
+            rng.uniform(18.40, 18.65, options['drivers']),
+            rng.uniform(73.70, 74.00, options['drivers']),
+        ])
+        pickups = np.column_stack([
+            rng.uniform(18.40, 18.65, options['rides']),
+            rng.uniform(73.70, 74.00, options['rides']),
+        ])
+
+        self.stdout.write(f"{options['drivers']} drivers x {options['rides']} rides")
+        for run in range(options['repeat']):
+            started = time.perf_counter()
+            cost = pickup_cost_matrix(drivers, pickups)
+            built = time.perf_counter()
+            driver_index, ride_index = solve_assignment(cost, options['max_pickup_km'])
+            solved = time.perf_counter()
+
+            self.stdout.write(
+                f'run {run + 1}: cost matrix {(built - started) * 1000:.0f} ms, '
+                f'assignment {(solved - built) * 1000:.0f} ms, '
+                f'{len(driver_index)} matches, '
+                f'mean pickup {cost[driver_index, ride_index].mean():.2f} km'
+            )
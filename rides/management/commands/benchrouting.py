@@ -0,0 +1,105 @@
+import random
+import statistics
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from rides.geo import calculate_distance
+from rides.road_network import RoadNetwork, build_graph
+
+def synthetic_city(size, seed=0):
+    """
+    Build a size x size street grid (~100 m blocks) with mixed road speeds,
+    a few one-way streets and some missing segments.
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = np.divmod(np.arange(size * size), size)
+    lat = 18.45 + rows * 0.0009 + rng.normal(0, 0.00005, size * size)
+    lng = 73.75 + cols * 0.00095 + rng.normal(0, 0.00005, size * size)
+
+    sources, targets = [], []
+    for r in range(size):
+        for c in range(size):
+            node = r * size + c
+            if c + 1 < size:
+                sources.append(node)
+                targets.append(node + 1)
+            if r + 1 < size:
+                sources.append(node)
+                targets.append(node + size)
+    sources = np.array(sources)
+    targets = np.array(targets)
+    keep = rng.random(len(sources)) > 0.05
+    sources, targets = sources[keep], targets[keep]
+
+    # Arterials every 10th street are faster
+    arterial = (rows[sources] % 10 == 0) | (cols[sources] % 10 == 0)
+    speed = np.where(arterial, 50.0, rng.uniform(15, 30, len(sources)))
+    length = np.array([
+        calculate_distance(lat[u], lng[u], lat[v], lng[v]) * 1000
+        for u, v in zip(sources, targets)
+    ])
+    seconds = length / (speed / 3.6)
+
+    oneway = rng.random(len(sources)) < 0.1
+    all_sources = np.concatenate([sources, targets[~oneway]])
+    all_targets = np.concatenate([targets, sources[~oneway]])
+    all_length = np.concatenate([length, length[~oneway]])
+    all_seconds = np.concatenate([seconds, seconds[~oneway]])
+    return build_graph(lat, lng, all_sources, all_targets, all_length, all_seconds)
+
+class Command(BaseCommand):
+    help = 'Benchmark road-network shortest-path queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--graph', help='Graph .npz file; a synthetic city grid is used if omitted')
+        parser.add_argument('--grid', type=int, default=300, help='Side of the synthetic grid in nodes')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--max-km', type=float, default=8, help='Maximum straight-line query length')
+        parser.add_argument('--targets', type=int, default=50, help='Targets per one-to-many query')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['graph']:
+            network = RoadNetwork.load(options['graph'])
+        else:
+            graph = synthetic_city(options['grid'])
+            network = RoadNetwork(**graph)
+        self.stdout.write(
+            f'{network.node_count} nodes, {len(network.indices)} edges, '
+            f'loaded in {time.perf_counter() - started:.1f} s'
+        )
+
+        random.seed(0)
+        pairs = []
+        while len(pairs) < options['queries']:
+            u, v = random.randrange(network.node_count), random.randrange(network.node_count)
+            km = calculate_distance(network.lat[u], network.lng[u], network.lat[v], network.lng[v])
+            if km <= options['max_km']:
+                pairs.append((u, v))
+
+        timings = []
+        for u, v in pairs:
+            t = time.perf_counter()
+            network.shortest_path(u, v)
+            timings.append((time.perf_counter() - t) * 1000)
+        self.report('point-to-point (bidirectional A*)', timings)
+
+        timings = []
+        for u, _ in pairs[:max(1, options['queries'] // 4)]:
+            targets = random.sample(range(network.node_count), options['targets'])
+            targets = [
+                t for t in targets
+                if calculate_distance(network.lat[u], network.lng[u], network.lat[t], network.lng[t]) <= options['max_km']
+            ] or [u]
+            t = time.perf_counter()
+            network.shortest_paths(u, targets)
+            timings.append((time.perf_counter() - t) * 1000)
+        self.report(f'one-to-many (Dijkstra, up to {options["targets"]} targets)', timings)
+
+    def report(self, label, timings):
+        timings = sorted(timings)
+        self.stdout.write(
+            f'{label}: median {statistics.median(timings):.2f} ms, '
+            f'p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms, '
+            f'max {timings[-1]:.2f} ms'
+        )
@@ -0,0 +1,60 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from rides.geo import calculate_distance
+from rides.road_network import RoadNetwork, build_graph
+
+class Command(BaseCommand):
+    help = 'Build a routing graph (.npz) from node and edge CSV files of a preprocessed OSM extract'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--nodes',
+            required=True,
+            help='CSV with columns id,lat,lng',
+        )
+        parser.add_argument(
+            '--edges',
+            required=True,
+            help='CSV with columns from,to,speed_kmh[,length_m][,oneway]',
+        )
+        parser.add_argument(
+            '--output',
+            required=True,
+            help='Path of the .npz graph file to write',
+        )
+
+    def handle(self, *args, **options):
+        node_index = {}
+        lat, lng = [], []
+        with open(options['nodes'], newline='') as f:
+            for row in csv.DictReader(f):
+                node_index[row['id']] = len(lat)
+                lat.append(float(row['lat']))
+                lng.append(float(row['lng']))
+
+        sources, targets, lengths, times = [], [], [], []
+        with open(options['edges'], newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    u, v = node_index[row['from']], node_index[row['to']]
+                except KeyError as e:
+                    raise CommandError(f'Edge references unknown node {e}')
+
+                length = row.get('length_m')
+                length = float(length) if length else calculate_distance(lat[u], lng[u], lat[v], lng[v]) * 1000
+                seconds = length / (float(row['speed_kmh']) / 3.6)
+
+                sources.append(u)
+                targets.append(v)
+                lengths.append(length)
+                times.append(seconds)
+                if row.get('oneway', '').lower() not in ('1', 'true', 'yes'):
+                    sources.append(v)
+                    targets.append(u)
+                    lengths.append(length)
+                    times.append(seconds)
+
+        RoadNetwork.save(options['output'], build_graph(lat, lng, sources, targets, lengths, times))
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {len(lat)} nodes and {len(sources)} directed edges to {options["output"]}'
+        ))
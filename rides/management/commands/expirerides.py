@@ -0,0 +1,42 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rides.sweeper import expire_stale_rides
+
+class Command(BaseCommand):
+    help = 'Cancel REQUESTED rides that no driver accepted within the request TTL'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl',
+            type=int,
+            default=settings.RIDE_REQUEST_TTL_SECONDS,
+            help='Seconds a ride request may wait for a driver',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.RIDE_SWEEP_INTERVAL_SECONDS,
+            help='Seconds between sweeps',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single sweep and exit',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.SHARED_CHANNEL_LAYER:
+            # Expiring still matters: riders see the cancellation through
+            # the notification polling API, just not pushed to their socket
+            self.stdout.write(self.style.WARNING(
+                'CHANNEL_LAYER_URL is not set; riders will not get socket pushes '
+                'for expired requests, only notifications when they poll'
+            ))
+        while True:
+            expired = expire_stale_rides(ttl=options['ttl'])
+            if expired:
+                self.stdout.write(f'Expired {expired} ride requests')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from rides.dispatch import Dispatcher
+
+class Command(BaseCommand):
+    help = 'Run the batched dispatcher that assigns drivers to requested rides'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window',
+            type=float,
+            default=settings.DISPATCH_WINDOW_SECONDS,
+            help='Seconds between dispatch windows',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single dispatch window and exit',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.SHARED_CHANNEL_LAYER:
+            # Offers are still written as notifications, which drivers pick
+            # up when they poll
+            self.stdout.write(self.style.WARNING(
+                'CHANNEL_LAYER_URL is not set; offers will not be pushed to driver '
+                'sockets, only seen when drivers poll'
+            ))
+        if not settings.DISPATCH_MODE:
+            self.stdout.write(self.style.WARNING(
+                'DISPATCH_MODE is off; offers will be sent but drivers can still accept any ride'
+            ))
+
+        dispatcher = Dispatcher(window=options['window'])
+
+        if options['once']:
+            offers = dispatcher.run_once()
+            self.stdout.write(self.style.SUCCESS(f'Sent {len(offers)} ride offers'))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Running dispatcher every {dispatcher.window}s'
+        ))
+        try:
+            dispatcher.run_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('Dispatcher stopped'))
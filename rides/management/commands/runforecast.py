@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rides.forecast import build_hints
+
+class Command(BaseCommand):
+    help = 'Forecast ride requests per cell and send repositioning hints to idle drivers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.FORECAST_INTERVAL_SECONDS,
+            help='Seconds between forecasts',
+        )
+        parser.add_argument(
+            '--horizon',
+            type=int,
+            default=settings.FORECAST_HORIZON_MINUTES,
+            help='Minutes ahead to forecast',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Forecast once, send hints and exit',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.SHARED_CHANNEL_LAYER:
+            self.stdout.write(self.style.WARNING(
+                'CHANNEL_LAYER_URL is not set; hints will not reach driver sockets'
+            ))
+        hints = build_hints()
+        hints.horizon_minutes = options['horizon']
+
+        if options['once']:
+            sent = hints.run_once()
+            for driver_id, (row, col) in sent:
+                self.stdout.write(f'Driver {driver_id}: cell {row},{col}')
+            self.stdout.write(self.style.SUCCESS(f'Sent {len(sent)} demand hints'))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Forecasting {hints.horizon_minutes} minutes ahead every {options['interval']}s"
+        ))
+        try:
+            hints.run_forever(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('Forecasting stopped'))
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-19 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0002_ride_status_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemandBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateTimeField()),
+                ('cell_row', models.IntegerField()),
+                ('cell_col', models.IntegerField()),
+                ('requested', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('cancelled', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('period_start', 'cell_row', 'cell_col'), name='unique_demand_bucket')],
+            },
+        ),
+    ]
@@ -39,6 +39,10 @@ class Ride(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Open requests by age, for available rides and the expiry sweep
+            models.Index(fields=['status', 'created_at']),
+        ]
     
     def __str__(self):
         return f"Ride {self.id} - {self.status}"
@@ -54,3 +58,25 @@ class RideLocation(models.Model):
     
     def __str__(self):
         return f"Location update for ride {self.ride.id} at {self.timestamp}"
+
+class DemandBucket(models.Model):
+    """
+    Ride requests, completions and cancellations by pickup cell in one time
+    bucket, kept up to date as rides change so the demand heatmap never
+    aggregates the rides table.
+    """
+    period_start = models.DateTimeField()
+    cell_row = models.IntegerField()
+    cell_col = models.IntegerField()
+    requested = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    cancelled = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            # Also serves the heatmap's range scans by period
+            models.UniqueConstraint(fields=['period_start', 'cell_row', 'cell_col'], name='unique_demand_bucket'),
+        ]
+    
+    def __str__(self):
+        return f"Demand in cell ({self.cell_row}, {self.cell_col}) at {self.period_start}"
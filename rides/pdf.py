@@ -0,0 +1,97 @@
+"""
+PDF renderers for ride receipts and driver statements.
+
+These run in worker processes, so they only take plain data and must not
+touch Django models or settings. Paragraph parses its text as markup, so
+anything a user typed (names, addresses) is escaped before it goes in one.
+"""
+import os
+from xml.sax.saxutils import escape
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import mm
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+TABLE_STYLE = TableStyle([
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f1f3f5')),
+    ('LINEBELOW', (0, 0), (-1, 0), 0.5, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('FONTSIZE', (0, 0), (-1, -1), 9),
+])
+
+
+def _write(path, story, title):
+    # Render to a temporary file and rename, so a half-written PDF is
+    # never served from the cache
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    doc = SimpleDocTemplate(tmp_path, pagesize=A4, title=title,
+                            leftMargin=18 * mm, rightMargin=18 * mm,
+                            topMargin=18 * mm, bottomMargin=18 * mm)
+    doc.build(story)
+    os.replace(tmp_path, path)
+    return path
+
+
+def render_receipt(data, path):
+    """Render a ride receipt to path. Returns the path."""
+    styles = getSampleStyleSheet()
+    story = [
+        Paragraph('Cabby', styles['Title']),
+        Paragraph(f"Receipt for ride #{data['ride_id']}", styles['Heading2']),
+        Paragraph(data['completed_at'], styles['Normal']),
+        Spacer(1, 8 * mm),
+    ]
+
+    details = [
+        ['Rider', data['rider']],
+        ['Driver', data['driver']],
+        ['Vehicle', data['vehicle']],
+        ['Pickup', Paragraph(escape(data['pickup_address']), styles['Normal'])],
+        ['Dropoff', Paragraph(escape(data['dropoff_address']), styles['Normal'])],
+        ['Distance', f"{data['distance']} km" if data['distance'] else '-'],
+        ['Duration', f"{data['duration']} min" if data['duration'] else '-'],
+        ['Fare', f"Rs. {data['fare']}"],
+    ]
+    table = Table(details, colWidths=[35 * mm, 130 * mm])
+    table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('LINEABOVE', (0, -1), (-1, -1), 0.5, colors.grey),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ]))
+    story.append(table)
+    return _write(path, story, f"Cabby receipt #{data['ride_id']}")
+
+
+def render_statement(data, path):
+    """Render a driver's monthly earnings statement to path. Returns the path."""
+    styles = getSampleStyleSheet()
+    story = [
+        Paragraph('Cabby', styles['Title']),
+        Paragraph(f"Earnings statement - {data['period_label']}", styles['Heading2']),
+        Paragraph(escape(f"{data['driver']} ({data['vehicle']})"), styles['Normal']),
+        Spacer(1, 8 * mm),
+    ]
+
+    rows = [['Date', 'Ride', 'Route', 'Distance', 'Fare']]
+    for ride in data['rides']:
+        rows.append([
+            ride['completed_at'],
+            f"#{ride['ride_id']}",
+            Paragraph(f"{escape(ride['pickup_address'])} &rarr; {escape(ride['dropoff_address'])}", styles['BodyText']),
+            f"{ride['distance']} km" if ride['distance'] else '-',
+            ride['fare'],
+        ])
+    rows.append(['', '', f"{len(data['rides'])} rides", '', data['total']])
+
+    table = Table(rows, colWidths=[28 * mm, 16 * mm, 88 * mm, 18 * mm, 22 * mm], repeatRows=1)
+    table.setStyle(TABLE_STYLE)
+    table.setStyle(TableStyle([
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('LINEABOVE', (0, -1), (-1, -1), 0.5, colors.grey),
+        ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+    ]))
+    story.append(table)
+    return _write(path, story, f"Cabby statement {data['period_label']}")
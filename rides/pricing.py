@@ -0,0 +1,269 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from decimal import Decimal
+from django.conf import settings
+from accounts.models import DriverProfile
+from .geo import cell_for
+from .models import Ride
+
+
+class SlidingWindowCounter:
+    """
+    Event counts per key over a sliding time window.
+
+    Events are counted in fixed-width time buckets and each key keeps a
+    running total, so adding, removing and reading a count are O(1)
+    amortized: every bucket is appended once and expired once.
+    """
+
+    def __init__(self, window_seconds, bucket_seconds):
+        self.window = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self._buckets = {}
+        self._totals = {}
+        self._last_sweep = time.time()
+
+    def _index(self, timestamp):
+        return int(timestamp // self.bucket_seconds)
+
+    def _expire(self, key, now):
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            return
+        oldest = self._index(now - self.window)
+        while buckets and buckets[0][0] < oldest:
+            self._totals[key] -= buckets.popleft()[1]
+        if not buckets:
+            del self._buckets[key]
+            del self._totals[key]
+
+    def _sweep(self, now):
+        # Drop keys nobody has read since they went quiet
+        if now - self._last_sweep < self.window:
+            return
+        self._last_sweep = now
+        for key in list(self._buckets):
+            self._expire(key, now)
+
+    def add(self, key, timestamp, amount=1):
+        """
+        Add amount to the bucket holding timestamp. A negative amount undoes
+        an earlier event; it is ignored once that event has left the window.
+        """
+        now = time.time()
+        self._sweep(now)
+        index = self._index(timestamp)
+        if index < self._index(now - self.window):
+            return
+
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            if amount < 0:
+                return
+            buckets = self._buckets[key] = deque()
+            self._totals[key] = 0
+
+        # Events almost always land in the newest bucket
+        if not buckets or buckets[-1][0] < index:
+            if amount < 0:
+                return
+            buckets.append([index, amount])
+        else:
+            for position in range(len(buckets) - 1, -1, -1):
+                if buckets[position][0] == index:
+                    buckets[position][1] += amount
+                    break
+                if buckets[position][0] < index:
+                    if amount < 0:
+                        return
+                    buckets.insert(position + 1, [index, amount])
+                    break
+            else:
+                if amount < 0:
+                    return
+                buckets.appendleft([index, amount])
+        self._totals[key] += amount
+
+    def count(self, key, now=None):
+        """Return the number of events for key within the window."""
+        self._expire(key, now or time.time())
+        return self._totals.get(key, 0)
+
+
+class SupplyTracker:
+    """
+    Available drivers per cell, counting only drivers seen within the window.
+
+    Drivers are kept in last-seen order so silent drivers expire from the
+    front in O(1) amortized time.
+    """
+
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self._drivers = OrderedDict()
+        self._counts = {}
+
+    def update(self, driver_id, cell, timestamp):
+        """Record that a driver is available in cell at timestamp."""
+        self.remove(driver_id)
+        self._drivers[driver_id] = (cell, timestamp)
+        self._counts[cell] = self._counts.get(cell, 0) + 1
+
+    def remove(self, driver_id):
+        """Stop counting a driver."""
+        entry = self._drivers.pop(driver_id, None)
+        if entry is None:
+            return
+        cell = entry[0]
+        self._counts[cell] -= 1
+        if not self._counts[cell]:
+            del self._counts[cell]
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        while self._drivers:
+            driver_id, (cell, last_seen) = next(iter(self._drivers.items()))
+            if last_seen >= cutoff:
+                break
+            self.remove(driver_id)
+
+    def count(self, cell, now=None):
+        """Return the number of available drivers in cell."""
+        self._expire(now or time.time())
+        return self._counts.get(cell, 0)
+
+
+class SurgeEngine:
+    """
+    Server-side surge multiplier per geographic cell.
+
+    Demand is the number of rides requested in a cell within the sliding
+    window that are still waiting for a driver; supply is the number of
+    available, idle drivers seen in the cell within the window. Both are
+    maintained incrementally from the booking, acceptance, cancellation and
+    availability code paths, so a lookup never touches the database.
+    """
+
+    def __init__(self, window_seconds=600, bucket_seconds=30, sensitivity=0.5, max_multiplier=3):
+        self.window = window_seconds
+        self.sensitivity = Decimal(str(sensitivity))
+        self.max_multiplier = Decimal(str(max_multiplier))
+        self.demand = SlidingWindowCounter(window_seconds, bucket_seconds)
+        self.supply = SupplyTracker(window_seconds)
+        self._busy_drivers = set()
+        self._lock = threading.Lock()
+        self._warmed = False
+
+    def warm(self):
+        """
+        Seed the counters from the database once per process, so the
+        multiplier is meaningful straight after a restart.
+        """
+        if self._warmed:
+            return
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+            since = time.time() - self.window
+
+            requested = Ride.objects.filter(
+                status='REQUESTED',
+                driver__isnull=True
+            ).order_by('created_at').values_list('pickup_latitude', 'pickup_longitude', 'created_at')
+            for lat, lng, created_at in requested.iterator():
+                timestamp = created_at.timestamp()
+                if timestamp >= since:
+                    self.demand.add(cell_for(lat, lng), timestamp)
+
+            self._busy_drivers.update(Ride.objects.filter(
+                status__in=['ACCEPTED', 'STARTED'],
+                driver__isnull=False
+            ).values_list('driver_id', flat=True))
+            available = DriverProfile.objects.filter(
+                is_available=True,
+                current_latitude__isnull=False,
+                current_longitude__isnull=False
+            ).exclude(user_id__in=self._busy_drivers).values_list('user_id', 'current_latitude', 'current_longitude')
+            now = time.time()
+            for driver_id, lat, lng in available.iterator():
+                self.supply.update(driver_id, cell_for(lat, lng), now)
+
+    def ride_requested(self, ride):
+        """Count a newly booked ride as demand in its pickup cell."""
+        self.warm()
+        with self._lock:
+            self.demand.add(
+                cell_for(ride.pickup_latitude, ride.pickup_longitude),
+                ride.created_at.timestamp()
+            )
+
+    def ride_closed(self, ride):
+        """Stop counting a requested ride once it is accepted or cancelled."""
+        self.warm()
+        with self._lock:
+            self.demand.add(
+                cell_for(ride.pickup_latitude, ride.pickup_longitude),
+                ride.created_at.timestamp(),
+                amount=-1
+            )
+
+    def driver_available(self, driver_id, lat, lng):
+        """
+        Count an available driver as supply in the cell of their current
+        position. Drivers on a ride are ignored until they are idle again.
+        """
+        if lat is None or lng is None:
+            return
+        self.warm()
+        with self._lock:
+            if driver_id not in self._busy_drivers:
+                self.supply.update(driver_id, cell_for(lat, lng), time.time())
+
+    def driver_unavailable(self, driver_id):
+        """Stop counting a driver who went offline."""
+        self.warm()
+        with self._lock:
+            self.supply.remove(driver_id)
+
+    def driver_busy(self, driver_id):
+        """Stop counting a driver who accepted a ride."""
+        self.warm()
+        with self._lock:
+            self._busy_drivers.add(driver_id)
+            self.supply.remove(driver_id)
+
+    def driver_idle(self, driver_id, lat=None, lng=None):
+        """
+        Mark a driver as free after their ride ended. They are counted as
+        supply again if their position is known.
+        """
+        self.warm()
+        with self._lock:
+            self._busy_drivers.discard(driver_id)
+        self.driver_available(driver_id, lat, lng)
+
+    def multiplier(self, lat, lng):
+        """Return the surge multiplier for a pickup point as a Decimal."""
+        self.warm()
+        cell = cell_for(lat, lng)
+        now = time.time()
+        with self._lock:
+            demand = self.demand.count(cell, now)
+            supply = self.supply.count(cell, now)
+
+        if demand <= supply:
+            return Decimal('1.0')
+
+        ratio = Decimal(demand) / Decimal(max(supply, 1))
+        multiplier = 1 + self.sensitivity * (ratio - 1)
+        return min(multiplier, self.max_multiplier).quantize(Decimal('0.1'))
+
+
+surge_engine = SurgeEngine(
+    window_seconds=settings.SURGE_WINDOW_SECONDS,
+    bucket_seconds=settings.SURGE_BUCKET_SECONDS,
+    sensitivity=settings.SURGE_SENSITIVITY,
+    max_multiplier=settings.SURGE_MAX_MULTIPLIER,
+)
@@ -0,0 +1,325 @@
+import heapq
+import threading
+from array import array
+from math import cos, radians, sqrt
+import numpy as np
+from django.conf import settings
+from .geo import calculate_distance
+
+# Kilometres per degree of latitude, and per degree of longitude at the equator
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LNG = 111.320
+
+# Size of the grid used to snap coordinates to the nearest graph node
+SNAP_CELL_DEGREES = 0.005
+
+
+def build_graph(lat, lng, sources, targets, length_m, time_s):
+    """
+    Pack a directed road graph into CSR arrays.
+
+    Args:
+        lat, lng: Node coordinates in degrees, indexed by node id
+        sources, targets: Edge endpoints as node ids
+        length_m: Edge lengths in metres
+        time_s: Edge travel times in seconds
+
+    Returns a dict of numpy arrays that RoadNetwork.save/load understand.
+    """
+    sources = np.asarray(sources, dtype=np.int32)
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(len(lat) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(lat)), out=indptr[1:])
+    return {
+        'lat': np.asarray(lat, dtype=np.float64),
+        'lng': np.asarray(lng, dtype=np.float64),
+        'indptr': indptr,
+        'indices': np.asarray(targets, dtype=np.int32)[order],
+        'length_m': np.asarray(length_m, dtype=np.float32)[order],
+        'time_s': np.asarray(time_s, dtype=np.float32)[order],
+    }
+
+
+class RoadNetwork:
+    """
+    Road graph held in compact array-backed adjacency (CSR) structures.
+
+    Point-to-point queries run a bidirectional A* search on travel time, with
+    a straight-line / top-speed lower bound as the potential. One-to-many
+    queries run a single Dijkstra search that stops once every target has
+    been settled. Coordinates are snapped to the nearest graph node and the
+    straight-line legs to and from the snapped nodes are added to the result.
+    """
+
+    def __init__(self, lat, lng, indptr, indices, length_m, time_s):
+        node_count = len(lat)
+        self.node_count = node_count
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+
+        # The search loops index these element by element; array.array keeps
+        # them compact while avoiding numpy's per-scalar overhead
+        self.indptr = array('q', np.asarray(indptr, dtype=np.int64).tobytes())
+        self.indices = array('i', np.asarray(indices, dtype=np.int32).tobytes())
+        self.length_m = array('f', np.asarray(length_m, dtype=np.float32).tobytes())
+        self.time_s = array('f', np.asarray(time_s, dtype=np.float32).tobytes())
+
+        # Reverse graph for the backward half of bidirectional searches
+        sources = np.repeat(np.arange(node_count, dtype=np.int32), np.diff(np.asarray(indptr)))
+        reverse = build_graph(self.lat, self.lng, indices, sources, length_m, time_s)
+        self.rev_indptr = array('q', reverse['indptr'].tobytes())
+        self.rev_indices = array('i', reverse['indices'].tobytes())
+        self.rev_length_m = array('f', reverse['length_m'].tobytes())
+        self.rev_time_s = array('f', reverse['time_s'].tobytes())
+
+        # Planar coordinates in km for the A* potential
+        origin_lat = radians(float(self.lat.mean())) if node_count else 0.0
+        self.x = array('d', (self.lng * KM_PER_DEGREE_LNG * cos(origin_lat)).tobytes())
+        self.y = array('d', (self.lat * KM_PER_DEGREE_LAT).tobytes())
+        top_speed = float((np.asarray(length_m) / np.maximum(np.asarray(time_s), 1e-3)).max()) if len(time_s) else 1.0
+        # Slightly under the true bound to absorb projection error, which
+        # keeps the potential consistent
+        self.seconds_per_km = 0.98 * 1000.0 / top_speed
+
+        # Grid index for snapping coordinates to nodes
+        self.snap_index = {}
+        rows = np.floor(self.lat / SNAP_CELL_DEGREES).astype(np.int64)
+        cols = np.floor(self.lng / SNAP_CELL_DEGREES).astype(np.int64)
+        for node, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+            self.snap_index.setdefault(cell, []).append(node)
+
+    @classmethod
+    def load(cls, path):
+        """Load a graph saved with RoadNetwork.save or build_graph."""
+        with np.load(path) as data:
+            return cls(
+                data['lat'], data['lng'], data['indptr'],
+                data['indices'], data['length_m'], data['time_s']
+            )
+
+    @staticmethod
+    def save(path, graph):
+        """Save the arrays returned by build_graph to an .npz file."""
+        np.savez_compressed(path, **graph)
+
+    def nearest_node(self, lat, lng):
+        """Return the id of the graph node closest to a point, or None."""
+        lat, lng = float(lat), float(lng)
+        row = int(lat // SNAP_CELL_DEGREES)
+        col = int(lng // SNAP_CELL_DEGREES)
+        best, best_distance, found_radius = None, None, None
+        for radius in range(0, 6):
+            # A node in the next ring out can still be closer than the
+            # first one found, so scan one more ring before stopping
+            if found_radius is not None and radius > found_radius + 1:
+                break
+            for r in range(row - radius, row + radius + 1):
+                for c in range(col - radius, col + radius + 1):
+                    # Only the new ring of cells at this radius
+                    if radius and abs(r - row) != radius and abs(c - col) != radius:
+                        continue
+                    for node in self.snap_index.get((r, c), ()):
+                        d = (self.lat[node] - lat) ** 2 + (self.lng[node] - lng) ** 2
+                        if best_distance is None or d < best_distance:
+                            best, best_distance = node, d
+            if best is not None and found_radius is None:
+                found_radius = radius
+        return None if best is None else int(best)
+
+    def _snap(self, lat, lng):
+        """Snap a point; returns (node, leg_km, leg_seconds) or None."""
+        node = self.nearest_node(lat, lng)
+        if node is None:
+            return None
+        leg = calculate_distance(float(lat), float(lng), float(self.lat[node]), float(self.lng[node]))
+        return node, leg, leg / settings.ROUTE_AVERAGE_SPEED_KMH * 3600
+
+    def _potential(self, node, target):
+        dx = self.x[node] - self.x[target]
+        dy = self.y[node] - self.y[target]
+        return sqrt(dx * dx + dy * dy) * self.seconds_per_km
+
+    def shortest_path(self, source, target):
+        """
+        Bidirectional A* on travel time between two nodes.
+        Returns (length_m, time_s) or None if target is unreachable.
+        """
+        if source == target:
+            return 0.0, 0.0
+
+        potential = self._potential
+        # Average of the forward and backward potentials, so both searches
+        # see the same reduced edge costs. Heap keys are distance + potential.
+        p_source = potential(source, target) / 2
+        p_target = potential(target, source) / 2
+
+        forward = (self.indptr, self.indices, self.time_s, self.length_m)
+        backward = (self.rev_indptr, self.rev_indices, self.rev_time_s, self.rev_length_m)
+        dist = ({source: 0.0}, {target: 0.0})
+        length = ({source: 0.0}, {target: 0.0})
+        settled = (set(), set())
+        heaps = ([(p_source, source)], [(p_target, target)])
+
+        best_time = float('inf')
+        best_length = None
+
+        while heaps[0] and heaps[1]:
+            # Stop once neither frontier can improve on the best meeting point
+            if heaps[0][0][0] + heaps[1][0][0] >= best_time:
+                break
+
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            sign = 1 if side == 0 else -1
+            indptr, indices, weights, lengths = forward if side == 0 else backward
+            my_dist, other_dist = dist[side], dist[1 - side]
+            my_length, other_length = length[side], length[1 - side]
+
+            _, node = heapq.heappop(heaps[side])
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+
+            node_dist = my_dist[node]
+            node_length = my_length[node]
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                new_dist = node_dist + weights[edge]
+                if new_dist < my_dist.get(neighbour, float('inf')):
+                    my_dist[neighbour] = new_dist
+                    my_length[neighbour] = node_length + lengths[edge]
+                    p = sign * (potential(neighbour, target) - potential(neighbour, source)) / 2
+                    heapq.heappush(heaps[side], (new_dist + p, neighbour))
+
+                    if neighbour in other_dist:
+                        total = new_dist + other_dist[neighbour]
+                        if total < best_time:
+                            best_time = total
+                            best_length = my_length[neighbour] + other_length[neighbour]
+
+        if best_length is None:
+            return None
+        return best_length, best_time
+
+    def shortest_paths(self, source, targets, reverse=False):
+        """
+        Dijkstra from source until every target is settled.
+        With reverse=True distances are measured from each target to source.
+        Returns {target: (length_m, time_s)} for the reachable targets.
+        """
+        if reverse:
+            indptr, indices, weights, lengths = self.rev_indptr, self.rev_indices, self.rev_time_s, self.rev_length_m
+        else:
+            indptr, indices, weights, lengths = self.indptr, self.indices, self.time_s, self.length_m
+
+        remaining = set(targets)
+        found = {}
+        dist = {source: 0.0}
+        length = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = set()
+
+        while heap and remaining:
+            node_dist, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            if node in remaining:
+                remaining.discard(node)
+                found[node] = (length[node], node_dist)
+
+            node_length = length[node]
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                new_dist = node_dist + weights[edge]
+                if new_dist < dist.get(neighbour, float('inf')):
+                    dist[neighbour] = new_dist
+                    length[neighbour] = node_length + lengths[edge]
+                    heapq.heappush(heap, (new_dist, neighbour))
+
+        return found
+
+    def route(self, lat1, lng1, lat2, lng2):
+        """
+        Road distance (km) and duration (minutes) between two points.
+        Returns None if either point can't be snapped or no path exists.
+        """
+        start, end = self._snap(lat1, lng1), self._snap(lat2, lng2)
+        if start is None or end is None:
+            return None
+        path = self.shortest_path(start[0], end[0])
+        if path is None:
+            return None
+        distance = path[0] / 1000 + start[1] + end[1]
+        duration = (path[1] + start[2] + end[2]) / 60
+        return distance, duration
+
+    def routes(self, lat, lng, points, reverse=False):
+        """
+        Road distance (km) and duration (minutes) from one point to many.
+        With reverse=True the routes run from each point to (lat, lng).
+        Returns a list aligned with points; unreachable entries are None.
+        """
+        origin = self._snap(lat, lng)
+        snapped = [self._snap(point_lat, point_lng) for point_lat, point_lng in points]
+        if origin is None:
+            return [None] * len(points)
+
+        found = self.shortest_paths(
+            origin[0],
+            {snap[0] for snap in snapped if snap is not None},
+            reverse=reverse
+        )
+
+        results = []
+        for snap in snapped:
+            if snap is None or snap[0] not in found:
+                results.append(None)
+                continue
+            length_m, time_s = found[snap[0]]
+            results.append((
+                length_m / 1000 + origin[1] + snap[1],
+                (time_s + origin[2] + snap[2]) / 60
+            ))
+        return results
+
+
+_network = None
+_network_lock = threading.Lock()
+
+
+def get_road_network():
+    """
+    Return the RoadNetwork loaded from ROAD_GRAPH_PATH, or None when no
+    graph is configured. The graph is loaded once per process.
+    """
+    global _network
+    path = settings.ROAD_GRAPH_PATH
+    if not path:
+        return None
+    if _network is None:
+        with _network_lock:
+            if _network is None:
+                _network = RoadNetwork.load(path)
+    return _network
+
+
+def straight_line_estimate(lat1, lng1, lat2, lng2):
+    """Approximate road distance (km) and duration (minutes) without a graph."""
+    distance = calculate_distance(float(lat1), float(lng1), float(lat2), float(lng2))
+    distance *= settings.ROUTE_DETOUR_FACTOR
+    return distance, distance / settings.ROUTE_AVERAGE_SPEED_KMH * 60
+
+
+def route_estimate(lat1, lng1, lat2, lng2):
+    """
+    Road distance (km) and duration (minutes) between two points, from the
+    road graph when one is configured and reachable, otherwise estimated
+    from the straight-line distance.
+    """
+    network = get_road_network()
+    if network is not None:
+        result = network.route(lat1, lng1, lat2, lng2)
+        if result is not None:
+            return result
+    return straight_line_estimate(lat1, lng1, lat2, lng2)
+
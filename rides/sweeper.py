@@ -0,0 +1,98 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+from accounts.models import Notification
+from accounts.utils import invalidate_active_rides, send_notifications_bulk
+from . import heatmap
+from .models import Ride
+
+EXPIRED_REASON = 'No driver accepted the request in time'
+
+
+def expire_stale_rides(ttl=None, batch_size=None, now=None):
+    """
+    Cancel REQUESTED rides nobody accepted within the TTL.
+
+    Each batch locks the stale rows, flips them with a single bulk UPDATE,
+    bulk-creates the rider notifications and pushes every update in one
+    channel-layer batch. Rides accepted concurrently are skipped by the
+    status filter on the UPDATE. Run from expirerides, the pushes only
+    reach sockets through a shared channel layer (CHANNEL_LAYER_URL);
+    without one riders still get the notifications when they poll.
+
+    Args:
+        ttl: Seconds a request may wait (defaults to RIDE_REQUEST_TTL_SECONDS)
+        batch_size: Rides per UPDATE (defaults to RIDE_SWEEP_BATCH_SIZE)
+        now: Optional reference time
+
+    Returns the number of rides expired.
+    """
+    ttl = ttl or settings.RIDE_REQUEST_TTL_SECONDS
+    batch_size = batch_size or settings.RIDE_SWEEP_BATCH_SIZE
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=ttl)
+
+    expired = 0
+    while True:
+        with transaction.atomic():
+            stale = list(Ride.objects.select_for_update(skip_locked=True).filter(
+                status='REQUESTED',
+                driver__isnull=True,
+                created_at__lt=cutoff
+            ).order_by('created_at').only(
+                'id', 'rider_id', 'pickup_latitude', 'pickup_longitude', 'created_at'
+            )[:batch_size])
+            if not stale:
+                break
+
+            Ride.objects.filter(
+                id__in=[ride.id for ride in stale],
+                status='REQUESTED',
+                driver__isnull=True
+            ).update(
+                status='CANCELLED',
+                cancellation_reason=EXPIRED_REASON,
+                updated_at=now
+            )
+
+        invalidate_active_rides([ride.rider_id for ride in stale])
+        notify_expired(stale)
+        # Surge demand isn't touched: the sweeper runs in its own process,
+        # and requests older than the TTL have slid out of the servers'
+        # surge windows by themselves unless SURGE_WINDOW_SECONDS is longer
+        heatmap.record('cancelled', stale, now)
+
+        expired += len(stale)
+        if len(stale) < batch_size:
+            break
+    return expired
+
+
+def notify_expired(rides):
+    """Tell riders their requests expired, in one INSERT and one push batch."""
+    message = 'No driver was available for your ride request. Please try booking again.'
+    notifications = []
+    status_events = []
+    for ride in rides:
+        action_url = reverse('ride_detail', args=[ride.id])
+        notifications.append(Notification(
+            user_id=ride.rider_id,
+            type='RIDE_CANCELLED',
+            title='Ride Request Expired',
+            message=message,
+            related_to_type='Ride',
+            related_to_id=ride.id,
+            action_url=action_url
+        ))
+        status_events.append((ride.rider_id, {
+            'type': 'ride_status_update',
+            'ride_id': ride.id,
+            'status': 'CANCELLED',
+            'driver_id': None,
+            'driver_name': None,
+            'message': message,
+            'redirect_url': action_url
+        }))
+    send_notifications_bulk(notifications, extra_events=status_events)
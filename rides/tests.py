@@ -1,3 +1,1134 @@
-from django.test import TestCase
+import copy
+import csv
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal, ROUND_CEILING
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.http import StreamingHttpResponse
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from scipy.sparse import csgraph, csr_matrix
+from accounts.models import User, DriverProfile, Notification, ReplicaHeartbeat
+from accounts.presence import presence
+from cabby.db_routers import lag_monitor
+from cabby.logconfig import BackgroundHandler, SamplingFilter
+from cabby.metrics import group_send, log_records_dropped, registry
+from cabby.tracing import JsonLinesExporter, MemoryCollector, summarize, tracer
+from accounts.routing import websocket_urlpatterns
+from cabby.ratelimit import rate_limiter
+from . import heatmap, pdf, transitions
+from .dispatch import Dispatcher
+from .documents import DocumentRenderer
+from .fares import RouteEstimateCache, quote_fare, time_of_day_tariff
+from .forecast import DemandForecaster, build_hints
+from .geo import cell_for
+from .geocoding import DiskCache, Geocoder, GeocodingProvider, OfflineProvider, geocoder
+from .locations import location_coalescer
+from .management.commands.benchrouting import synthetic_city
+from .models import DemandBucket, Ride
+from .pricing import SurgeEngine
+from .road_network import RoadNetwork
+from .sweeper import expire_stale_rides
 
-# Create your tests here.
+REPLICA = 'replica_test'
+
+# A second SQLite file standing in for a read replica; registered at import
+# so the test runner creates and migrates it alongside the primary
+connections.settings[REPLICA] = {
+    **copy.deepcopy(connections.settings['default']),
+    'TEST': {
+        **connections.settings['default']['TEST'],
+        'NAME': os.path.join(tempfile.gettempdir(), 'cabby_replica_test.sqlite3'),
+    },
+}
+
+
+class ReadReplicaRoutingTests(TransactionTestCase):
+    """
+    Routing against a second SQLite file standing in for a read replica.
+    Nothing replicates into it, so a read that reaches the replica can't
+    see rows written to the primary during the test.
+    """
+    databases = {'default', REPLICA}
+
+    def setUp(self):
+        # Scoped to the test body so teardown can still flush the replica
+        self.enterContext(override_settings(DATABASE_REPLICAS=[REPLICA], REPLICA_MAX_LAG_SECONDS=5, SHARED_CACHE=True))
+        cache.clear()
+        lag_monitor._memo.clear()
+        self.rider = User.objects.create_user('rider', password='secret', role='RIDER')
+        self.client.force_login(self.rider)
+        cache.clear()
+
+    def replicate_heartbeat(self, lag=0):
+        """Give the replica the primary's heartbeat, lag seconds behind, and measure."""
+        lag_monitor.check()
+        beat_at = ReplicaHeartbeat.objects.get(pk=1).beat_at - timedelta(seconds=lag)
+        ReplicaHeartbeat.objects.using(REPLICA).update_or_create(pk=1, defaults={'beat_at': beat_at})
+        return lag_monitor.check()
+
+    def create_ride(self):
+        return Ride.objects.create(
+            rider=self.rider,
+            pickup_address='Pickup',
+            dropoff_address='Dropoff',
+            pickup_latitude=18.52,
+            pickup_longitude=73.85,
+            dropoff_latitude=18.55,
+            dropoff_longitude=73.90,
+            fare=150
+        )
+
+    def history(self):
+        response = self.client.get('/rides/history/', secure=True)
+        self.assertEqual(response.status_code, 200)
+        return list(response.context['rides'])
+
+    def test_read_view_uses_replica(self):
+        self.create_ride()
+        self.replicate_heartbeat()
+        self.assertEqual(self.history(), [])
+
+    def test_unmeasured_or_stale_replica_gets_no_reads(self):
+        self.create_ride()
+        self.assertFalse(lag_monitor.is_healthy(REPLICA))
+        self.assertEqual(len(self.history()), 1)
+
+        self.replicate_heartbeat()
+        lag_monitor._memo.clear()
+        with mock.patch('cabby.db_routers.time.time', return_value=time.time() + 60):
+            self.assertFalse(lag_monitor.is_healthy(REPLICA))
+
+    def test_private_cache_keeps_reads_on_primary(self):
+        self.create_ride()
+        self.replicate_heartbeat()
+        with override_settings(SHARED_CACHE=False):
+            self.assertEqual(len(self.history()), 1)
+
+    def test_own_write_pins_user_to_primary(self):
+        self.replicate_heartbeat()
+        response = self.client.post('/rides/book/', {
+            'pickup_location': 'Pickup',
+            'dropoff_location': 'Dropoff',
+            'pickup_latitude': '18.52',
+            'pickup_longitude': '73.85',
+            'dropoff_latitude': '18.55',
+            'dropoff_longitude': '73.90',
+            'vehicle_type': 'SEDAN'
+        }, secure=True)
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(len(self.history()), 1)
+
+    def test_write_views_stay_on_primary(self):
+        ride = self.create_ride()
+        response = self.client.get(f'/rides/{ride.id}/status/', secure=True)
+        self.assertEqual(response.status_code, 200)
+
+    def test_lagging_replica_is_skipped(self):
+        self.create_ride()
+        lags = self.replicate_heartbeat(lag=30)
+        self.assertGreater(lags[REPLICA], 5)
+        self.assertFalse(lag_monitor.is_healthy(REPLICA))
+        self.assertEqual(len(self.history()), 1)
+
+    def test_caught_up_replica_is_used(self):
+        self.create_ride()
+        self.replicate_heartbeat()
+        self.assertTrue(lag_monitor.is_healthy(REPLICA))
+        self.assertEqual(self.history(), [])
+
+
+class DispatchTests(TransactionTestCase):
+    """Batched assignment of online drivers to requested rides."""
+
+    def setUp(self):
+        presence.reset()
+        self.addCleanup(presence.reset)
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+
+    def driver(self, username, lat, lng):
+        driver = User.objects.create_user(username, password=None, role='DRIVER')
+        DriverProfile.objects.create(user=driver, vehicle_number=username, vehicle_type='SEDAN', license_number=username)
+        presence.go_online(driver.id, lat, lng)
+        return driver.id
+
+    def ride(self, lat, lng):
+        return Ride.objects.create(
+            rider=self.rider, pickup_address='Pickup', dropoff_address='Dropoff',
+            pickup_latitude=lat, pickup_longitude=lng,
+            dropoff_latitude=18.55, dropoff_longitude=73.90, fare=150
+        ).id
+
+    def test_nearest_driver_is_offered_and_lapsed_offers_are_not_repeated(self):
+        first, second = self.driver('first', 18.520, 73.850), self.driver('second', 18.600, 73.900)
+        near_first, near_second = self.ride(18.521, 73.851), self.ride(18.601, 73.901)
+        dispatcher = Dispatcher(window=1, max_pickup_km=20, offer_timeout=15)
+
+        self.assertEqual(sorted(dispatcher.run_once()), sorted([(first, near_first), (second, near_second)]))
+        # Live offers tie up both drivers and rides
+        self.assertEqual(dispatcher.run_once(), [])
+
+        # Each lapsed ride goes to the driver who hasn't seen it, then nowhere
+        Notification.objects.update(created_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(sorted(dispatcher.run_once()), sorted([(first, near_second), (second, near_first)]))
+        Notification.objects.update(created_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(dispatcher.run_once(), [])
+
+    def test_command_offers_rides_without_a_shared_channel_layer(self):
+        driver = self.driver('first', 18.520, 73.850)
+        ride = self.ride(18.521, 73.851)
+        output = io.StringIO()
+        call_command('rundispatch', '--once', stdout=output)
+        self.assertIn('CHANNEL_LAYER_URL is not set', output.getvalue())
+        self.assertIn('Sent 1 ride offers', output.getvalue())
+        self.assertEqual(list(Dispatcher().past_offers([ride])), [(driver, ride)])
+
+
+class EtaMatrixTests(TransactionTestCase):
+    """Driver-to-pickup ETA matrices for riders and staff."""
+
+    def setUp(self):
+        presence.reset()
+        self.addCleanup(presence.reset)
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.drivers = []
+        for i in range(3):
+            driver = User.objects.create_user(f'driver{i}', password=None, role='DRIVER')
+            presence.go_online(driver.id, 18.52 + i * 0.01, 73.85)
+            self.drivers.append(driver.id)
+
+    def post(self, user, **body):
+        self.client.force_login(user)
+        return self.client.post('/rides/eta-matrix/', json.dumps(body), content_type='application/json', secure=True)
+
+    def test_nearest_drivers(self):
+        response = self.post(self.rider, pickups=[[18.52, 73.85], [18.53, 73.86]], nearest=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['driver_ids'], self.drivers[:2])
+        self.assertEqual(len(response.json()['distance'][0]), 2)
+
+    def test_nearest_must_be_positive(self):
+        for nearest in (0, -1):
+            self.assertEqual(self.post(self.rider, pickups=[[18.52, 73.85]], nearest=nearest).status_code, 400)
+
+    def test_driver_ids_are_for_staff(self):
+        self.assertEqual(self.post(self.rider, pickups=[[18.52, 73.85]], driver_ids=self.drivers).status_code, 403)
+        staff = User.objects.create_user('staff', password=None, is_staff=True)
+        response = self.post(staff, pickups=[[18.52, 73.85]], driver_ids=self.drivers[1:])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['driver_ids'], self.drivers[1:])
+
+    @override_settings(ETA_MATRIX_MAX_PICKUPS=2, ETA_MATRIX_MAX_DRIVERS=2)
+    def test_lists_are_capped_and_coordinates_checked(self):
+        staff = User.objects.create_user('staff', password=None, is_staff=True)
+        self.assertEqual(self.post(self.rider, pickups=[[18.52, 73.85]] * 3).status_code, 400)
+        self.assertEqual(self.post(self.rider, pickups=[]).status_code, 400)
+        self.assertEqual(self.post(staff, pickups=[[18.52, 73.85]], driver_ids=self.drivers).status_code, 400)
+        self.assertEqual(self.post(self.rider, pickups=[[91, 73.85]]).status_code, 400)
+        self.assertEqual(self.post(self.rider, pickups=[['nan', 73.85]]).status_code, 400)
+
+
+class RideSweeperTests(TransactionTestCase):
+    """Bulk expiry of ride requests nobody accepted."""
+
+    def setUp(self):
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+
+    def ride(self, age, **fields):
+        ride = Ride.objects.create(
+            rider=self.rider, pickup_address='Pickup', dropoff_address='Dropoff',
+            pickup_latitude=18.52, pickup_longitude=73.85,
+            dropoff_latitude=18.55, dropoff_longitude=73.90, fare=150, **fields
+        )
+        Ride.objects.filter(id=ride.id).update(created_at=timezone.now() - timedelta(seconds=age))
+        return ride.id
+
+    def test_only_stale_unaccepted_requests_expire(self):
+        stale = [self.ride(700) for _ in range(3)]
+        fresh = self.ride(60)
+        accepted = self.ride(700, driver=self.driver, status='ACCEPTED')
+
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'user_{self.rider.id}_notifications', channel)
+
+        self.assertEqual(expire_stale_rides(ttl=600, batch_size=2), 3)
+        self.assertEqual(set(Ride.objects.filter(status='CANCELLED').values_list('id', flat=True)), set(stale))
+        self.assertEqual(Ride.objects.get(id=fresh).status, 'REQUESTED')
+        self.assertEqual(Ride.objects.get(id=accepted).status, 'ACCEPTED')
+        self.assertEqual(Notification.objects.filter(user=self.rider, type='RIDE_CANCELLED').count(), 3)
+
+        events = [async_to_sync(layer.receive)(channel) for _ in range(6)]
+        self.assertEqual(
+            sorted(event['ride_id'] for event in events if event['type'] == 'ride_status_update'),
+            sorted(stale)
+        )
+        self.assertEqual(expire_stale_rides(ttl=600), 0)
+
+    def test_command_expires_rides_without_a_shared_channel_layer(self):
+        stale = self.ride(700)
+        output = io.StringIO()
+        call_command('expirerides', '--once', stdout=output)
+        self.assertIn('CHANNEL_LAYER_URL is not set', output.getvalue())
+        self.assertIn('Expired 1 ride requests', output.getvalue())
+        self.assertEqual(Ride.objects.get(id=stale).status, 'CANCELLED')
+        self.assertTrue(Notification.objects.filter(user=self.rider, type='RIDE_CANCELLED', related_to_id=stale).exists())
+
+
+class ExportTests(TransactionTestCase):
+    """Streamed ride history and earnings exports."""
+
+    def setUp(self):
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.other = User.objects.create_user('other', password=None, role='RIDER')
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=self.driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        self.staff = User.objects.create_user('staff', password=None, is_staff=True)
+        self.completed = self.ride(self.rider, status='COMPLETED', driver=self.driver, completed_at=timezone.now())
+        self.cancelled = self.ride(self.rider, status='CANCELLED', age=timedelta(days=40))
+        self.others = self.ride(self.other)
+
+    def ride(self, rider, age=None, **fields):
+        ride = Ride.objects.create(
+            rider=rider, pickup_address='Pickup, "Gate 2"', dropoff_address='Dropoff',
+            pickup_latitude=18.52, pickup_longitude=73.85,
+            dropoff_latitude=18.55, dropoff_longitude=73.90, fare=150, **fields
+        )
+        if age:
+            Ride.objects.filter(id=ride.id).update(created_at=timezone.now() - age)
+        return ride.id
+
+    def export(self, user, path='/rides/history/export/', **params):
+        self.client.force_login(user)
+        return self.client.get(path, params, secure=True)
+
+    def rows(self, response):
+        self.assertIsInstance(response, StreamingHttpResponse)
+        content = b''.join(response.streaming_content).decode()
+        if response['Content-Type'] == 'text/csv':
+            return list(csv.DictReader(io.StringIO(content)))
+        return [json.loads(line) for line in content.splitlines()]
+
+    def ids(self, response):
+        return sorted(int(row['id']) for row in self.rows(response))
+
+    def test_csv_and_jsonl(self):
+        response = self.export(self.rider, status='COMPLETED')
+        self.assertEqual(response['Content-Disposition'][-5:], '.csv"')
+        [row] = self.rows(response)
+        self.assertEqual((row['rider'], row['driver'], row['pickup_address']), ('rider', 'driver', 'Pickup, "Gate 2"'))
+
+        response = self.export(self.rider, format='jsonl', status='COMPLETED')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        [row] = self.rows(response)
+        self.assertEqual((row['id'], row['status'], row['fare']), (self.completed, 'COMPLETED', '150.00'))
+        self.assertEqual(self.export(self.rider, format='xml').status_code, 400)
+
+    def test_riders_and_drivers_only_export_their_own_rides(self):
+        self.assertEqual(self.ids(self.export(self.rider)), sorted([self.completed, self.cancelled]))
+        self.assertEqual(self.ids(self.export(self.driver)), [self.completed])
+
+    def test_staff_can_narrow_to_a_rider_or_driver(self):
+        self.assertEqual(self.ids(self.export(self.staff)), sorted([self.completed, self.cancelled, self.others]))
+        self.assertEqual(self.ids(self.export(self.staff, rider=self.other.id)), [self.others])
+        self.assertEqual(self.ids(self.export(self.staff, driver=self.driver.id)), [self.completed])
+        # Riders can't narrow to someone else's rides
+        self.assertEqual(self.ids(self.export(self.rider, rider=self.other.id)), sorted([self.completed, self.cancelled]))
+
+    def test_date_filters(self):
+        today = timezone.now().date()
+        self.assertEqual(self.ids(self.export(self.rider, date_range='month')), [self.completed])
+        self.assertEqual(self.ids(self.export(
+            self.rider, date_range='custom', end_date=(today - timedelta(days=30)).isoformat()
+        )), [self.cancelled])
+
+    def test_invalid_parameters_are_rejected_before_streaming(self):
+        for params in ({'rider': 'abc'}, {'driver': 'abc'}, {'date_range': 'custom', 'start_date': 'yesterday'},
+                       {'date_range': 'custom', 'end_date': '2024-02-30'}):
+            response = self.export(self.staff, **params)
+            self.assertEqual(response.status_code, 400, params)
+        self.assertEqual(self.export(self.staff, '/rides/earnings/export/', driver='abc').status_code, 400)
+
+    def test_earnings_export(self):
+        response = self.export(self.driver, '/rides/earnings/export/', format='jsonl', period='month')
+        self.assertEqual([row['id'] for row in self.rows(response)], [self.completed])
+        self.assertEqual(self.ids(self.export(self.staff, '/rides/earnings/export/', driver=self.driver.id)), [self.completed])
+        self.assertEqual(self.export(self.rider, '/rides/earnings/export/').status_code, 403)
+
+
+class RideTransitionTests(TransactionTestCase):
+    """Conditional-UPDATE ride transitions, including racing callers."""
+
+    def setUp(self):
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.drivers = [
+            User.objects.create_user(f'driver{i}', password=None, role='DRIVER')
+            for i in range(8)
+        ]
+        self.ride = Ride.objects.create(
+            rider=self.rider,
+            pickup_address='Pickup',
+            dropoff_address='Dropoff',
+            pickup_latitude=18.52,
+            pickup_longitude=73.85,
+            dropoff_latitude=18.55,
+            dropoff_longitude=73.90,
+            fare=150
+        )
+
+    def race(self, attempts):
+        """Run the callables at the same moment; returns their results."""
+        barrier = threading.Barrier(len(attempts))
+        results = [None] * len(attempts)
+
+        def run(index, attempt):
+            try:
+                barrier.wait()
+                results[index] = attempt()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(i, attempt)) for i, attempt in enumerate(attempts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_only_one_driver_can_accept(self):
+        results = self.race([
+            # Each driver works on their own copy, as concurrent requests do
+            lambda driver=driver: transitions.accept_ride(Ride.objects.get(id=self.ride.id), driver)
+            for driver in self.drivers
+        ])
+        self.assertEqual(results.count(True), 1)
+        winner = self.drivers[results.index(True)]
+
+        ride = Ride.objects.get(id=self.ride.id)
+        self.assertEqual(ride.status, 'ACCEPTED')
+        self.assertEqual(ride.driver, winner)
+
+    def test_complete_and_cancel_race(self):
+        driver = self.drivers[0]
+        self.assertTrue(transitions.accept_ride(self.ride, driver))
+        self.assertTrue(transitions.start_ride(self.ride, driver))
+
+        complete_copy = Ride.objects.get(id=self.ride.id)
+        cancel_copy = Ride.objects.get(id=self.ride.id)
+        cancel_copy.status = 'ACCEPTED'  # a stale page still showing the accepted ride
+        results = self.race([
+            lambda: transitions.complete_ride(complete_copy, driver),
+            lambda: transitions.cancel_ride(cancel_copy, self.rider),
+        ])
+        self.assertEqual(results, [True, False])
+        self.assertEqual(Ride.objects.get(id=self.ride.id).status, 'COMPLETED')
+
+    def test_transition_writes_only_changed_columns(self):
+        driver = self.drivers[0]
+        Ride.objects.filter(id=self.ride.id).update(pickup_address='Changed elsewhere')
+
+        self.assertTrue(transitions.accept_ride(self.ride, driver))
+        ride = Ride.objects.get(id=self.ride.id)
+        self.assertEqual(ride.pickup_address, 'Changed elsewhere')
+        self.assertEqual(self.ride.driver, driver)
+
+    def test_guards(self):
+        driver, other = self.drivers[:2]
+        self.assertFalse(transitions.start_ride(self.ride, driver))
+        self.assertTrue(transitions.accept_ride(self.ride, driver))
+        self.assertFalse(transitions.start_ride(Ride.objects.get(id=self.ride.id), other))
+        self.assertFalse(transitions.cancel_ride(Ride.objects.get(id=self.ride.id), other))
+        self.assertTrue(transitions.cancel_ride(self.ride, self.rider, 'Cancelled by rider'))
+        self.assertEqual(Ride.objects.get(id=self.ride.id).cancellation_reason, 'Cancelled by rider')
+
+
+class RateLimitTests(TransactionTestCase):
+    """Token-bucket limits on polling endpoints and coalesced location pings."""
+
+    def setUp(self):
+        self.enterContext(override_settings(RATE_LIMITS={'location': (1, 2), 'polling': (1, 3)}))
+        rate_limiter.reset()
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=self.driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        self.client.force_login(self.driver)
+
+    def ping(self, lat, lng):
+        return self.client.post('/rides/update-location/', {'latitude': lat, 'longitude': lng},
+                                content_type='application/json', secure=True)
+
+    def test_polling_gets_429_once_the_burst_is_spent(self):
+        codes = [self.client.get('/rides/available-rides/', secure=True).status_code for _ in range(4)]
+        self.assertEqual(codes, [200, 200, 200, 429])
+
+        response = self.client.get('/rides/available-rides/', secure=True)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_location_pings_over_the_limit_are_coalesced(self):
+        codes = [self.ping(18.5 + i / 1000, 73.8).status_code for i in range(5)]
+        self.assertEqual(codes, [200, 200, 202, 202, 202])
+
+        profile = DriverProfile.objects.get(user=self.driver)
+        self.assertEqual(float(profile.current_latitude), 18.501)
+
+        self.assertEqual(location_coalescer.flush(), 1)
+        profile.refresh_from_db()
+        self.assertEqual(float(profile.current_latitude), 18.504)
+
+    def test_direct_write_supersedes_pending_ping(self):
+        location_coalescer.add(self.driver.id, 18.6, 73.8)
+        location_coalescer.write(self.driver.id, 18.7, 73.8)
+        self.assertEqual(location_coalescer.flush(), 0)
+        self.assertEqual(float(DriverProfile.objects.get(user=self.driver).current_latitude), 18.7)
+
+
+class MetricsTests(TransactionTestCase):
+    """Prometheus exposition of request, query and ride metrics."""
+
+    def setUp(self):
+        registry.clear()
+        self.staff = User.objects.create_user('ops', password=None, role='RIDER', is_staff=True)
+        rider = User.objects.create_user('rider', password=None, role='RIDER')
+        Ride.objects.create(
+            rider=rider, pickup_address='A', dropoff_address='B',
+            pickup_latitude=18.52, pickup_longitude=73.85,
+            dropoff_latitude=18.55, dropoff_longitude=73.90,
+            status='REQUESTED', fare=100
+        )
+
+    def scrape(self, **headers):
+        return self.client.get('/metrics', secure=True, headers=headers)
+
+    def test_staff_only_without_token(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.client.force_login(self.staff)
+        response = self.scrape()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_token_and_recorded_series(self):
+        self.assertEqual(self.scrape(Authorization='Bearer wrong').status_code, 403)
+        self.client.get('/rides/history/', secure=True)
+
+        body = self.scrape(Authorization='Bearer s3cret').content.decode()
+        self.assertIn('cabby_requested_rides 1', body)
+        self.assertIn('cabby_http_request_duration_seconds_count{view="ride_history",method="GET",status="302"} 1', body)
+        self.assertIn('cabby_http_request_duration_seconds_bucket{view="ride_history",method="GET",status="302",le="+Inf"} 1', body)
+        self.assertIn('cabby_db_query_duration_seconds_count{database="default"}', body)
+
+
+class TracingTests(TransactionTestCase):
+    """Trace context from the HTTP view through the channel layer to the client."""
+
+    def setUp(self):
+        exporter, sample_rate = tracer.exporter, tracer.sample_rate
+        self.addCleanup(setattr, tracer, 'exporter', exporter)
+        self.addCleanup(setattr, tracer, 'sample_rate', sample_rate)
+        tracer.exporter, tracer.sample_rate = MemoryCollector(), 1.0
+
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=self.driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        self.ride = Ride.objects.create(
+            rider=self.rider, pickup_address='A', dropoff_address='B',
+            pickup_latitude=18.52, pickup_longitude=73.85,
+            dropoff_latitude=18.55, dropoff_longitude=73.90,
+            status='REQUESTED', fare=100
+        )
+
+    def test_accept_traces_writes_and_group_send(self):
+        self.client.force_login(self.driver)
+        response = self.client.post(f'/rides/accept-ride/{self.ride.id}/', secure=True)
+        self.assertTrue(response.json()['success'])
+
+        spans = tracer.exporter.spans(response['X-Trace-Id'])
+        names = [span['name'] for span in spans]
+        self.assertIn('http POST accept_ride_ajax', names)
+        self.assertIn('db.write', names)
+        self.assertIn('channel.group_send', names)
+        root = next(span for span in spans if span['parent_id'] is None)
+        self.assertTrue(all(span['trace_id'] == root['trace_id'] for span in spans))
+
+    def test_consumer_continues_trace_until_client_ack(self):
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/notifications/')
+            communicator.scope['user'] = self.rider
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+            with tracer.start_trace('http POST accept_ride_ajax') as root:
+                await group_send(get_channel_layer(), f'user_{self.rider.id}_notifications', {
+                    'type': 'ride_status_update', 'ride_id': self.ride.id,
+                    'status': 'ACCEPTED', 'message': 'Accepted'
+                })
+            message = await communicator.receive_json_from()
+            await communicator.send_json_to({'type': 'trace_ack', 'trace': message['trace']})
+            # Repeated and made-up acks add nothing
+            await communicator.send_json_to({'type': 'trace_ack', 'trace': message['trace']})
+            await communicator.send_json_to({'type': 'trace_ack', 'trace': {
+                'trace_id': 'a' * 32, 'span_id': 'b' * 16, 'sent_at': time.time()
+            }})
+            await communicator.send_json_to({'type': 'ping'})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+            return root.trace_id, message
+
+        trace_id, message = async_to_sync(run)()
+        self.assertEqual(message['trace']['trace_id'], trace_id)
+        spans = tracer.exporter.spans(trace_id)
+        self.assertEqual(
+            sorted(span['name'] for span in spans),
+            ['channel.group_send', 'client.ack', 'consumer.ride_status_update',
+             'http POST accept_ride_ajax', 'websocket.send']
+        )
+        summary, = summarize(spans)
+        self.assertEqual(summary['name'], 'http POST accept_ride_ajax')
+        self.assertGreaterEqual(summary['delivered_ms'], summary['spans_ms']['websocket.send'])
+        self.assertEqual(tracer.exporter.spans('a' * 32), [])
+
+    def test_client_traceparent_only_forces_a_trace_when_trusted(self):
+        tracer.sample_rate = 0
+        traceparent = f"00-{'c' * 32}-{'d' * 16}-01"
+        self.client.force_login(self.rider)
+        response = self.client.get('/rides/history/', secure=True, headers={'traceparent': traceparent})
+        self.assertNotIn('X-Trace-Id', response)
+
+        with mock.patch.object(tracer, 'trust_traceparent', True):
+            response = self.client.get('/rides/history/', secure=True, headers={'traceparent': traceparent})
+        self.assertEqual(response['X-Trace-Id'], 'c' * 32)
+
+    def test_trace_file_is_rotated(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'traces.jsonl')
+        exporter = JsonLinesExporter(path, max_bytes=10, backups=2)
+        for content in ('first span\n', 'second span\n', 'third span\n'):
+            with open(path, 'w') as output:
+                output.write(content)
+            exporter._rotate()
+        self.assertFalse(os.path.exists(path))
+        with open(f'{path}.1') as newest, open(f'{path}.2') as oldest:
+            self.assertEqual((newest.read(), oldest.read()), ('third span\n', 'second span\n'))
+        self.assertFalse(os.path.exists(f'{path}.3'))
+
+
+class LoggingPipelineTests(TransactionTestCase):
+    """Queued, structured log output with per-logger sampling."""
+
+    def handler(self, **kwargs):
+        stream = io.StringIO()
+        handler = BackgroundHandler(stream=stream, **kwargs)
+        self.addCleanup(handler.close)
+        logger = logging.getLogger('cabby.tests.pipeline')
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        self.addCleanup(logger.removeHandler, handler)
+        return handler, logger, stream
+
+    def test_records_are_written_as_json_lines(self):
+        handler, logger, stream = self.handler()
+        logger.info('Ride %s accepted', 7, extra={'ride_id': 7})
+        handler.flush()
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual((entry['level'], entry['message'], entry['ride_id']), ('INFO', 'Ride 7 accepted', 7))
+
+    def test_records_are_rendered_before_they_are_queued(self):
+        handler, logger, stream = self.handler()
+        handler.listener.stop()
+        rendered_on = []
+
+        class Ride:
+            def __init__(self):
+                self.status = 'REQUESTED'
+
+            def __str__(self):
+                rendered_on.append(threading.current_thread())
+                return f'Ride({self.status})'
+
+        ride = Ride()
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('Failed on %s', ride, extra={'ride': ride, 'context': {'ride': ride, 'ids': (1, 2)}})
+        ride.status = 'CANCELLED'
+        handler.listener.start()
+        handler.flush()
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry['message'], 'Failed on Ride(REQUESTED)')
+        self.assertEqual((entry['ride'], entry['context']), ('Ride(REQUESTED)', {'ride': 'Ride(REQUESTED)', 'ids': [1, 2]}))
+        self.assertIn('ValueError: boom', entry['exception'])
+        self.assertEqual(set(rendered_on), {threading.current_thread()})
+
+    def test_booking_log_leaves_out_the_form(self):
+        self.client.force_login(User.objects.create_user('rider', password=None, role='RIDER'))
+        with self.assertLogs('rides.views', logging.DEBUG) as logs:
+            self.client.post('/rides/book/', {
+                'csrfmiddlewaretoken': 'secret-token', 'pickup_latitude': '18.52', 'pickup_longitude': '73.85',
+                'pickup_location': 'Home, 4th floor', 'vehicle_type': 'SUV'
+            }, secure=True)
+        record = next(record for record in logs.records if record.getMessage() == 'Booking ride')
+        self.assertEqual((record.pickup, record.vehicle_type), (['18.52', '73.85'], 'SUV'))
+        self.assertFalse(hasattr(record, 'post'))
+        self.assertNotIn('secret-token', str(vars(record)))
+
+    def test_sampling_applies_to_children_and_spares_warnings(self):
+        sampling = SamplingFilter({'rides': 0, 'rides.api.kept': 1})
+        handler, logger, stream = self.handler()
+        handler.addFilter(sampling)
+
+        for name, level in (('rides.api', logging.INFO), ('rides.api', logging.WARNING), ('rides.api.kept', logging.DEBUG)):
+            record = logger.makeRecord(name, level, __file__, 0, name, (), None)
+            handler.handle(record)
+        handler.flush()
+        self.assertEqual(
+            [(entry['logger'], entry['level']) for entry in map(json.loads, stream.getvalue().splitlines())],
+            [('rides.api', 'WARNING'), ('rides.api.kept', 'DEBUG')]
+        )
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        registry.clear()
+        handler, logger, stream = self.handler(queue_size=1)
+        handler.listener.stop()
+
+        for i in range(3):
+            logger.info('Ping %d', i)
+        self.assertEqual(log_records_dropped.snapshot(), [(('cabby.tests.pipeline',), [2])])
+        handler.listener.start()
+        handler.flush()
+        self.assertEqual(len(stream.getvalue().splitlines()), 1)
+
+
+class DocumentRenderingTests(TransactionTestCase):
+    """PDF receipts and statements built from user-entered text."""
+
+    HOSTILE = ['<b>Main St', 'a </b> b', '<font face="x">Road', '<img src="/etc/passwd"/> & Co']
+
+    def setUp(self):
+        self.root = self.enterContext(tempfile.TemporaryDirectory())
+
+    def assert_pdf(self, path):
+        with open(path, 'rb') as document:
+            self.assertEqual(document.read(5), b'%PDF-')
+
+    def test_addresses_are_not_parsed_as_markup(self):
+        receipt = {
+            'ride_id': 1, 'completed_at': '01 Jan 2026, 10:00', 'rider': '<b>Rider',
+            'driver': 'Driver', 'vehicle': 'SEDAN MH12', 'distance': '4.2', 'duration': 12, 'fare': '150.00',
+        }
+        with mock.patch('builtins.open', wraps=open) as opened:
+            for address in self.HOSTILE:
+                path = os.path.join(self.root, 'receipt.pdf')
+                pdf.render_receipt({**receipt, 'pickup_address': address, 'dropoff_address': address}, path)
+                self.assert_pdf(path)
+        self.assertNotIn('/etc/passwd', [call.args[0] for call in opened.call_args_list if call.args])
+
+        path = os.path.join(self.root, 'statement.pdf')
+        pdf.render_statement({
+            'driver': '<i>Driver', 'vehicle': '<font face="x">', 'period_label': 'January 2026', 'total': '300.00',
+            'rides': [{
+                'ride_id': number, 'completed_at': '01 Jan 2026', 'pickup_address': address,
+                'dropoff_address': address, 'distance': None, 'fare': '150.00',
+            } for number, address in enumerate(self.HOSTILE)],
+        }, path)
+        self.assert_pdf(path)
+
+    def test_requester_deleted_while_rendering(self):
+        renderer = DocumentRenderer(self.root)
+        rider = User.objects.create_user('rider', password=None, role='RIDER')
+        other = User.objects.create_user('other', password=None, role='RIDER')
+        path = os.path.join(self.root, 'ride-1.pdf')
+        renderer._pending[path] = [(rider.id, 'Receipt', 'Ready', '/'), (other.id, 'Receipt', 'Ready', '/')]
+        rider.delete()
+
+        future = mock.Mock()
+        future.exception.return_value = None
+        renderer._finished(future, path)
+        self.assertEqual(list(other.notifications.values_list('title', flat=True)), ['Receipt ready'])
+
+
+class SurgePricingTests(TransactionTestCase):
+    """Sliding-window demand and supply counts behind the surge multiplier."""
+
+    def setUp(self):
+        patcher = mock.patch('rides.pricing.time')
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clock.time.return_value = 1_000_000.0
+        self.engine = SurgeEngine(window_seconds=600, bucket_seconds=30, sensitivity=0.5, max_multiplier=3)
+
+    def ride(self, lat=18.525, lng=73.855):
+        return SimpleNamespace(
+            pickup_latitude=lat, pickup_longitude=lng,
+            created_at=datetime.fromtimestamp(self.clock.time.return_value, dt_timezone.utc)
+        )
+
+    def request(self, lat=18.525, lng=73.855):
+        self.engine.ride_requested(self.ride(lat, lng))
+
+    def multiplier(self):
+        return self.engine.multiplier(18.525, 73.855)
+
+    def test_demand_over_supply_raises_the_multiplier(self):
+        for _ in range(4):
+            self.request()
+        self.request(lat=18.6)
+        self.engine.driver_available(1, 18.526, 73.856)
+        self.engine.driver_available(2, 18.6, 73.856)
+        # 4 requests for 1 driver: 1 + 0.5 * (4 - 1)
+        self.assertEqual(self.multiplier(), Decimal('2.5'))
+
+        self.engine.driver_available(3, 18.527, 73.857)
+        self.assertEqual(self.multiplier(), Decimal('1.5'))
+        self.engine.driver_busy(3)
+        self.engine.driver_available(3, 18.527, 73.857)
+        self.assertEqual(self.multiplier(), Decimal('2.5'))
+        self.engine.driver_idle(3, 18.527, 73.857)
+        # Two of the four requests are taken: 2 requests for 2 drivers
+        self.engine.ride_closed(self.ride())
+        self.engine.ride_closed(self.ride())
+        self.assertEqual(self.multiplier(), Decimal('1.0'))
+
+    def test_requests_and_silent_drivers_leave_the_window(self):
+        for _ in range(3):
+            self.request()
+        self.clock.time.return_value += 300
+        self.request()
+        self.engine.driver_available(1, 18.526, 73.856)
+        self.assertEqual(self.multiplier(), Decimal('2.5'))
+
+        # The first three requests age out; the driver was seen too recently
+        self.clock.time.return_value += 330
+        self.assertEqual(self.engine.demand.count(cell_for(18.525, 73.855)), 1)
+        self.assertEqual(self.multiplier(), Decimal('1.0'))
+
+        self.request()
+        self.clock.time.return_value += 630
+        self.request()
+        self.request()
+        self.assertEqual(self.engine.supply.count(cell_for(18.525, 73.855)), 0)
+        # No supply counts as one driver
+        self.assertEqual(self.multiplier(), Decimal('1.5'))
+
+    def test_multiplier_is_capped(self):
+        for _ in range(50):
+            self.request()
+        self.engine.driver_available(1, 18.526, 73.856)
+        self.assertEqual(self.multiplier(), Decimal('3'))
+
+
+class FareQuoteTests(TransactionTestCase):
+    """Server-side fare quotes and the route estimate cache behind them."""
+
+    def setUp(self):
+        patchers = [
+            mock.patch('rides.fares.route_cache', RouteEstimateCache(max_size=10, ttl=600)),
+            mock.patch('rides.fares.surge_engine', SurgeEngine()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def at(self, hour):
+        return datetime(2024, 5, 1, hour, 30, tzinfo=dt_timezone.utc)
+
+    def test_quote_breaks_down_the_fare(self):
+        quote = quote_fare('SUV', 18.52, 73.85, 18.60, 73.95, when=self.at(12))
+        tariff = settings.FARE_TARIFFS['SUV']
+        self.assertEqual(quote['vehicle_type'], 'SUV')
+        self.assertEqual(quote['time_of_day'], 'standard')
+        self.assertEqual(quote['surge_multiplier'], Decimal('1.0'))
+        self.assertEqual(quote['distance_fare'], (Decimal(tariff['per_km']) * Decimal(str(quote['distance']))).quantize(Decimal('0.01')))
+        self.assertEqual(quote['time_fare'], Decimal(tariff['per_minute'] * quote['duration']))
+        self.assertEqual(quote['total'], (quote['base_fare'] + quote['distance_fare'] + quote['time_fare']).quantize(Decimal('1'), rounding=ROUND_CEILING))
+        self.assertFalse(quote['cached'])
+        self.assertTrue(quote_fare('SUV', 18.5201, 73.8501, 18.6001, 73.9501, when=self.at(12))['cached'])
+
+    def test_short_trips_pay_the_minimum_and_unknown_vehicles_are_sedans(self):
+        quote = quote_fare('ROCKET', 18.52, 73.85, 18.52, 73.85, when=self.at(12))
+        self.assertEqual(quote['vehicle_type'], 'SEDAN')
+        self.assertEqual(quote['total'], settings.FARE_TARIFFS['SEDAN']['minimum'])
+
+    def test_night_tariff_wraps_past_midnight(self):
+        for hour, label in [(21, 'standard'), (22, 'night'), (23, 'night'), (0, 'night'), (5, 'night'), (6, 'standard'), (9, 'morning_peak')]:
+            self.assertEqual(time_of_day_tariff(self.at(hour))[1], label, hour)
+        night = quote_fare('SEDAN', 18.52, 73.85, 18.60, 73.95, when=self.at(2))
+        subtotal = night['base_fare'] + night['distance_fare'] + night['time_fare']
+        self.assertEqual(night['time_of_day_multiplier'], Decimal('1.25'))
+        self.assertEqual(night['total'], (subtotal * Decimal('1.25')).quantize(Decimal('1'), rounding=ROUND_CEILING))
+
+    def test_route_cache_expires_and_evicts_least_recently_used(self):
+        route_cache = RouteEstimateCache(max_size=2, ttl=60)
+        with mock.patch('rides.fares.time.monotonic', return_value=1000):
+            route_cache.set('a', 1)
+            route_cache.set('b', 2)
+            self.assertEqual(route_cache.get('a'), 1)
+            route_cache.set('c', 3)
+            self.assertIsNone(route_cache.get('b'))
+            self.assertEqual(route_cache.get('c'), 3)
+        with mock.patch('rides.fares.time.monotonic', return_value=1061):
+            self.assertIsNone(route_cache.get('a'))
+        self.assertEqual(route_cache.stats(), {'hits': 2, 'misses': 2, 'hit_ratio': 0.5, 'size': 1, 'max_size': 2})
+
+    def test_view_rejects_non_finite_coordinates(self):
+        self.client.force_login(User.objects.create_user('rider', password=None, role='RIDER'))
+        for value in ('nan', 'inf', '-inf', '91'):
+            response = self.client.get('/rides/quote/', {
+                'pickup_lat': value, 'pickup_lng': 73.85, 'dropoff_lat': 18.55, 'dropoff_lng': 73.90
+            }, secure=True)
+            self.assertEqual(response.status_code, 400, value)
+
+
+class RoadNetworkTests(TransactionTestCase):
+    """Graph searches checked against scipy's Dijkstra on a synthetic city."""
+
+    def setUp(self):
+        self.network = RoadNetwork(**synthetic_city(30))
+        self.times = csgraph.dijkstra(csr_matrix(
+            (self.network.time_s, self.network.indices, self.network.indptr),
+            shape=(self.network.node_count, self.network.node_count)
+        ))
+
+    def test_bidirectional_astar_matches_dijkstra(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            source, target = rng.randrange(self.network.node_count), rng.randrange(self.network.node_count)
+            path = self.network.shortest_path(source, target)
+            if np.isinf(self.times[source, target]):
+                self.assertIsNone(path)
+            else:
+                self.assertAlmostEqual(path[1], self.times[source, target], places=2)
+
+    def test_one_to_many_matches_dijkstra_both_ways(self):
+        targets = list(range(0, self.network.node_count, 37))
+        for reverse in (False, True):
+            found = self.network.shortest_paths(450, targets, reverse=reverse)
+            for target in targets:
+                expected = self.times[target, 450] if reverse else self.times[450, target]
+                if np.isinf(expected):
+                    self.assertNotIn(target, found)
+                else:
+                    self.assertAlmostEqual(found[target][1], expected, places=2)
+
+
+class CountingProvider(GeocodingProvider):
+    name = 'counting'
+
+    def __init__(self):
+        self.calls = []
+
+    def reverse(self, lat, lng):
+        self.calls.append((lat, lng))
+        return f'Address {len(self.calls)}'
+
+
+class GeocodingTests(TransactionTestCase):
+    """Reverse geocoding through the memory and disk caches to a provider."""
+
+    def setUp(self):
+        self.enterContext(mock.patch.object(geocoder, 'disk', None))
+        geocoder.clear()
+        rate_limiter.reset()
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.client.force_login(self.rider)
+
+    def test_offline_provider_names_landmarks_and_cities(self):
+        provider = OfflineProvider.from_csv(os.path.join(os.path.dirname(__file__), 'data', 'places.csv'))
+        self.assertEqual(provider.reverse(18.5290, 73.8740), 'Near Pune Junction, Pune')
+        self.assertEqual(provider.reverse(18.4500, 73.8000), '18.45000, 73.80000, Pune')
+        self.assertEqual(provider.reverse(0.0, 0.0), '0.00000, 0.00000')
+
+    def test_points_in_a_cell_share_one_lookup_and_survive_restarts(self):
+        provider = CountingProvider()
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'geocode.sqlite3')
+        disk = DiskCache(path)
+        self.addCleanup(disk.close)
+        cache = Geocoder(provider, cell_degrees=0.001, cache_size=1, disk=disk)
+
+        self.assertEqual(cache.reverse(18.52011, 73.85611), ('Address 1', 'provider'))
+        self.assertEqual(cache.reverse(18.52049, 73.85649), ('Address 1', 'memory'))
+        self.assertEqual(len(provider.calls), 1)
+
+        # The LRU holds one cell, so the first falls back to disk
+        cache.reverse(18.53, 73.85)
+        self.assertEqual(cache.reverse(18.52011, 73.85611), ('Address 1', 'disk'))
+
+        restarted = Geocoder(provider, cell_degrees=0.001, disk=DiskCache(path))
+        self.assertEqual(restarted.reverse(18.53, 73.85), ('Address 2', 'disk'))
+        self.assertEqual(len(provider.calls), 2)
+        restarted.disk.close()
+
+    def test_reverse_endpoint_and_booking_without_addresses(self):
+        response = self.client.get('/rides/geocode/reverse/', {'lat': 18.5821, 'lng': 73.9197}, secure=True)
+        self.assertEqual(response.json()['display_name'], 'Near Pune International Airport, Pune')
+        self.assertFalse(response.json()['cached'])
+        self.assertTrue(self.client.get('/rides/geocode/reverse/', {'lat': 18.5821, 'lng': 73.9197}, secure=True).json()['cached'])
+        self.assertEqual(self.client.get('/rides/geocode/reverse/', {'lat': 91, 'lng': 0}, secure=True).status_code, 400)
+
+        response = self.client.post('/rides/book/', {
+            'pickup_latitude': 18.5289, 'pickup_longitude': 73.8744,
+            'dropoff_latitude': 18.5821, 'dropoff_longitude': 73.9197,
+            'vehicle_type': 'SEDAN',
+        }, secure=True)
+        self.assertTrue(response.json()['success'])
+        ride = Ride.objects.get(rider=self.rider)
+        self.assertEqual(ride.pickup_address, 'Near Pune Junction, Pune')
+        self.assertEqual(ride.dropoff_address, 'Near Pune International Airport, Pune')
+
+
+class DemandHeatmapTests(TransactionTestCase):
+    """Per-cell demand counters kept in time buckets as rides change."""
+
+    def setUp(self):
+        rate_limiter.reset()
+        self.rider = User.objects.create_user('rider', password=None, role='RIDER')
+        self.staff = User.objects.create_user('ops', password=None, role='RIDER', is_staff=True)
+
+    def book(self, lat, lng):
+        self.client.force_login(self.rider)
+        response = self.client.post('/rides/book/', {
+            'pickup_location': 'A', 'dropoff_location': 'B',
+            'pickup_latitude': lat, 'pickup_longitude': lng,
+            'dropoff_latitude': 18.60, 'dropoff_longitude': 73.90,
+            'vehicle_type': 'SEDAN',
+        }, secure=True)
+        return Ride.objects.get(id=int(response.json()['redirect_url'].strip('/').split('/')[-1]))
+
+    def test_bookings_cancellations_and_expiries_are_counted_per_cell(self):
+        first = self.book(18.5204, 73.8567)
+        self.book(18.5250, 73.8590)
+        self.book(18.5821, 73.9197)
+        self.client.post(f'/rides/{first.id}/cancel/', secure=True)
+        Ride.objects.filter(status='REQUESTED').update(created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(expire_stale_rides(), 2)
+
+        now = timezone.now()
+        _, _, cells = heatmap.heatmap(now - timedelta(minutes=5), now)
+        self.assertEqual(cells, [[1852, 7385, 2, 0, 2], [1858, 7391, 1, 0, 1]])
+        # One row per cell and bucket, however many rides
+        self.assertEqual(DemandBucket.objects.count(), 2)
+
+        _, _, cells = heatmap.heatmap(now - timedelta(minutes=5), now, bounds=(18.55, 73.88, 18.60, 73.95))
+        self.assertEqual([cell[:2] for cell in cells], [[1858, 7391]])
+
+    def test_window_sums_only_its_buckets(self):
+        ride = self.book(18.5204, 73.8567)
+        heatmap.record('completed', [ride], ride.created_at - timedelta(hours=2))
+
+        now = timezone.now()
+        _, _, recent = heatmap.heatmap(now - timedelta(hours=1), now)
+        _, _, day = heatmap.heatmap(now - timedelta(hours=3), now)
+        self.assertEqual(recent, [[1852, 7385, 1, 0, 0]])
+        self.assertEqual(day, [[1852, 7385, 1, 1, 0]])
+
+    def test_admin_endpoint(self):
+        self.book(18.5204, 73.8567)
+        self.assertEqual(self.client.get('/rides/heatmap/', secure=True).status_code, 302)
+
+        self.client.force_login(self.staff)
+        response = self.client.get('/rides/heatmap/', {'minutes': 30}, secure=True)
+        data = response.json()
+        self.assertEqual(data['fields'], ['row', 'col', 'requested', 'completed', 'cancelled'])
+        self.assertEqual(data['cells'], [[1852, 7385, 1, 0, 0]])
+        self.assertEqual(self.client.get('/rides/heatmap/', {'minutes': 60 * 24 * 30}, secure=True).status_code, 400)
+
+    def test_invalid_bounds_are_rejected(self):
+        self.client.force_login(self.staff)
+        for bounds in ('nan,0,1,1', '18,73,inf,74', '18.6,73.8,18.5,73.9', '18.5,73.9,18.6,73.8', '18,73,91,74', '18,73,19'):
+            response = self.client.get('/rides/heatmap/', {'bounds': bounds}, secure=True)
+            self.assertEqual(response.status_code, 400, bounds)
+        response = self.client.get('/rides/heatmap/', {'bounds': '18.5,73.8,18.6,73.9'}, secure=True)
+        self.assertEqual(response.status_code, 200)
+
+
+class DemandForecastTests(TransactionTestCase):
+    """Seasonal per-cell request forecasts and repositioning hints."""
+
+    def test_profile_learns_the_week_and_level_tracks_surprises(self):
+        # Day-long buckets: slot 0 of each week is busy in cell A
+        forecaster = DemandForecaster(bucket_seconds=86400, season_alpha=0.5, level_alpha=0.5, damping=0.5)
+        for bucket in range(21):
+            forecaster.observe(bucket, {(0, 0): 10 if bucket % 7 == 0 else 0, (0, 1): 1})
+        forecaster.advance(20)
+
+        cells, expected = forecaster.predict(24 * 60)
+        self.assertEqual(cells.tolist(), [[0, 0], [0, 1]])
+        self.assertAlmostEqual(float(expected[0]), 10, places=3)
+        self.assertAlmostEqual(float(expected[1]), 1, places=3)
+
+        # An unexpectedly busy day raises tomorrow's forecast, damped
+        forecaster.observe(21, {(0, 1): 5})
+        forecaster.advance(22)
+        cells, expected = forecaster.predict(24 * 60)
+        self.assertAlmostEqual(float(expected[1]), 1 + 2 * 0.5, places=3)
+
+    @override_settings(FORECAST_HISTORY_DAYS=8, HEATMAP_CELL_DEGREES=0.01)
+    def test_idle_drivers_near_a_shortfall_get_a_hint(self):
+        presence.reset()
+        self.addCleanup(presence.reset)
+        driver = User.objects.create_user('driver', password=None, role='DRIVER')
+        DriverProfile.objects.create(user=driver, vehicle_number='MH12', vehicle_type='SEDAN', license_number='L1')
+        presence.go_online(driver.id, 18.535, 73.865)
+
+        hints = build_hints()
+        hints.horizon_minutes = 5
+        now = timezone.now()
+        # The bucket after this one was busy a week ago
+        next_bucket = hints.forecaster.bucket_for(now) + 1
+        DemandBucket.objects.create(
+            period_start=datetime.fromtimestamp(next_bucket * 300 - 7 * 86400, dt_timezone.utc),
+            cell_row=1852, cell_col=7385, requested=5
+        )
+
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'user_{driver.id}_notifications', channel)
+
+        self.assertEqual(hints.run_once(now), [(driver.id, (1852, 7385))])
+        message = async_to_sync(layer.receive)(channel)
+        self.assertEqual((message['type'], message['lat'], message['lng']), ('demand_hint', 18.525, 73.855))
+        self.assertEqual(message['expected_requests'], 5.0)
+        # Not repeated within the cooldown
+        self.assertEqual(hints.run_once(now), [])
+
+    def test_loop_survives_a_failed_run(self):
+        hints = build_hints()
+        with mock.patch.object(hints, 'run_once', side_effect=[DatabaseError('gone'), None, KeyboardInterrupt]) as run_once, \
+                mock.patch('rides.forecast.time.sleep'), self.assertLogs('rides.forecast', 'ERROR'):
+            with self.assertRaises(KeyboardInterrupt):
+                hints.run_forever(60)
+        self.assertEqual(run_once.call_count, 3)
+
+    def test_command_prints_hints_without_a_shared_channel_layer(self):
+        with mock.patch('rides.forecast.RepositioningHints.run_once', return_value=[(7, (1852, 7385))]):
+            output = io.StringIO()
+            call_command('runforecast', '--once', stdout=output)
+        self.assertIn('CHANNEL_LAYER_URL is not set', output.getvalue())
+        self.assertIn('Driver 7: cell 1852,7385', output.getvalue())
+
+    def test_hints_past_their_cooldown_are_forgotten(self):
+        hints = build_hints()
+        hints.cooldown = 600
+        now = time.monotonic()
+        hints._sent = {1: ((0, 0), now - 601), 2: ((0, 1), now - 10)}
+        hints.run_once()
+        self.assertEqual(list(hints._sent), [2])
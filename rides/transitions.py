@@ -0,0 +1,83 @@
+from django.db.models import Q
+from django.utils import timezone
+from accounts.utils import invalidate_active_rides
+from .models import Ride
+
+# Statuses each transition may start from
+ACCEPTABLE_STATUSES = ('REQUESTED',)
+STARTABLE_STATUSES = ('ACCEPTED',)
+COMPLETABLE_STATUSES = ('STARTED',)
+CANCELLABLE_STATUSES = ('REQUESTED', 'ACCEPTED')
+
+
+def transition(ride, to_status, from_statuses, guard=None, **fields):
+    """
+    Move a ride to a new status with one conditional UPDATE.
+
+    The UPDATE only matches while the row still has the status the caller
+    loaded (which must be one of from_statuses) and passes the optional
+    guard, so concurrent transitions can't both apply. Only the status,
+    updated_at and the given fields are written.
+
+    Args:
+        ride: The Ride instance as loaded by the caller
+        to_status: Status to move to
+        from_statuses: Statuses the transition is allowed from
+        guard: Optional Q object the row must also match
+        **fields: Other columns to set
+
+    Returns True if the transition applied, in which case the instance is
+    updated to match; False if the ride had already moved on.
+    """
+    if ride.status not in from_statuses:
+        return False
+
+    values = {'status': to_status, 'updated_at': timezone.now(), **fields}
+    rides = Ride.objects.filter(id=ride.id, status=ride.status)
+    if guard is not None:
+        rides = rides.filter(guard)
+    if not rides.update(**values):
+        return False
+
+    # update() sends no signals; drop the cached active rides of whoever
+    # had the ride before and has it now
+    invalidate_active_rides([ride.rider_id, ride.driver_id, getattr(fields.get('driver'), 'id', None)])
+    for field, value in values.items():
+        setattr(ride, field, value)
+    return True
+
+
+def accept_ride(ride, driver):
+    """Assign an unassigned requested ride to a driver."""
+    return transition(
+        ride, 'ACCEPTED', ACCEPTABLE_STATUSES,
+        guard=Q(driver__isnull=True),
+        driver=driver
+    )
+
+
+def start_ride(ride, driver):
+    """Start an accepted ride; only its driver may start it."""
+    return transition(
+        ride, 'STARTED', STARTABLE_STATUSES,
+        guard=Q(driver=driver),
+        started_at=timezone.now()
+    )
+
+
+def complete_ride(ride, driver):
+    """Complete a started ride; only its driver may complete it."""
+    return transition(
+        ride, 'COMPLETED', COMPLETABLE_STATUSES,
+        guard=Q(driver=driver),
+        completed_at=timezone.now()
+    )
+
+
+def cancel_ride(ride, user, reason=''):
+    """Cancel a requested or accepted ride; its rider or driver may cancel it."""
+    return transition(
+        ride, 'CANCELLED', CANCELLABLE_STATUSES,
+        guard=Q(rider=user) | Q(driver=user),
+        cancellation_reason=reason
+    )
@@ -1,41 +1,62 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import JsonResponse, FileResponse
 from django.contrib import messages
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.urls import reverse
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.models import AnonymousUser
+from django.contrib.admin.views.decorators import staff_member_required
 from collections import defaultdict
 import calendar
-from datetime import timedelta
+from datetime import date, timedelta
 import json
+import logging
 from decimal import Decimal, InvalidOperation
 from .models import Ride
-from accounts.models import User, DriverProfile
+from accounts.models import User
+from accounts.presence import presence
 from django.conf import settings
 from accounts.utils import send_notification, send_ride_status_update
+from .dispatch import offered_ride_ids
+from . import heatmap, transitions
+from .pricing import surge_engine
+from .fares import quote_fare, route_cache
+from .geocoding import geocoder
+from .exports import EXPORT_FORMATS, stream_export
+from .documents import document_renderer
+from cabby.db_routers import use_read_replica
+from cabby.ratelimit import rate_limit, rate_limiter, request_identity
+from .locations import location_coalescer
+from .eta import eta_service, haversine_matrix, nearest_drivers as find_nearest_drivers
+
+logger = logging.getLogger(__name__)
 
 @login_required
 def book_ride(request):
     if request.method == 'POST':
-        print("DEBUG book_ride - POST dict:", request.POST.dict())
+        # Only the trip itself: the form also carries the CSRF token
+        logger.debug('Booking ride', extra={
+            'user_id': request.user.id,
+            'vehicle_type': request.POST.get('vehicle_type'),
+            'pickup': [request.POST.get('pickup_latitude'), request.POST.get('pickup_longitude')],
+            'dropoff': [request.POST.get('dropoff_latitude'), request.POST.get('dropoff_longitude')],
+        })
         try:
             # Extract form data
-            pickup_location = request.POST.get('pickup_location')
-            dropoff_location = request.POST.get('dropoff_location')
+            pickup_location = request.POST.get('pickup_location', '').strip()
+            dropoff_location = request.POST.get('dropoff_location', '').strip()
             pickup_latitude = request.POST.get('pickup_latitude')
             pickup_longitude = request.POST.get('pickup_longitude')
             dropoff_latitude = request.POST.get('dropoff_latitude')
             dropoff_longitude = request.POST.get('dropoff_longitude')
-            fare = request.POST.get('fare')
+            vehicle_type = request.POST.get('vehicle_type')
             
             # Validate required fields
             required_fields = [
-                'pickup_location', 'dropoff_location',
                 'pickup_latitude', 'pickup_longitude',
-                'dropoff_latitude', 'dropoff_longitude',
-                'fare'
+                'dropoff_latitude', 'dropoff_longitude'
             ]
             missing_fields = [f for f in required_fields if not request.POST.get(f)]
             if missing_fields:
@@ -44,6 +65,19 @@ def book_ride(request):
                     'error': f'Missing required fields: {", ".join(missing_fields)}'
                 }, status=400)
             
+            # Addresses the client didn't send are looked up from the coordinates
+            if not pickup_location:
+                pickup_location = geocoder.address(float(pickup_latitude), float(pickup_longitude))
+            if not dropoff_location:
+                dropoff_location = geocoder.address(float(dropoff_latitude), float(dropoff_longitude))
+
+            # Price the ride server-side; any fare sent by the client is ignored
+            quote = quote_fare(
+                vehicle_type,
+                float(pickup_latitude), float(pickup_longitude),
+                float(dropoff_latitude), float(dropoff_longitude)
+            )
+            
             # Create the ride
             ride = Ride.objects.create(
                 rider=request.user,
@@ -53,9 +87,13 @@ def book_ride(request):
                 pickup_longitude=float(pickup_longitude),
                 dropoff_latitude=float(dropoff_latitude),
                 dropoff_longitude=float(dropoff_longitude),
-                fare=Decimal(str(fare)),
+                fare=quote['total'],
+                distance=Decimal(str(quote['distance'])),
+                duration=quote['duration'],
                 status='REQUESTED'
             )
+            surge_engine.ride_requested(ride)
+            heatmap.record('requested', [ride], ride.created_at)
 
             # Store additional info in session for later use
             request.session['vehicle_type'] = request.POST.get('vehicle_type')
@@ -64,6 +102,8 @@ def book_ride(request):
 
             return JsonResponse({
                 'success': True,
+                'fare': str(ride.fare),
+                'surge_multiplier': str(quote['surge_multiplier']),
                 'redirect_url': reverse('ride_detail', args=[ride.id])
             })
             
@@ -86,18 +126,145 @@ def book_ride(request):
     return render(request, 'rides/book_ride.html')
 
 @login_required
-def ride_history(request):
-    # Get filter parameters
+def fare_quote(request):
+    """
+    Quote a fare for a trip from the pickup/dropoff coordinates and vehicle type.
+    """
+    try:
+        pickup_lat = float(request.GET['pickup_lat'])
+        pickup_lng = float(request.GET['pickup_lng'])
+        dropoff_lat = float(request.GET['dropoff_lat'])
+        dropoff_lng = float(request.GET['dropoff_lng'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Pickup and dropoff coordinates required'}, status=400)
+    if not all(-90 <= lat <= 90 and -180 <= lng <= 180
+               for lat, lng in ((pickup_lat, pickup_lng), (dropoff_lat, dropoff_lng))):
+        return JsonResponse({'error': 'Coordinates out of range'}, status=400)
+    
+    quote = quote_fare(
+        request.GET.get('vehicle_type'),
+        pickup_lat, pickup_lng,
+        dropoff_lat, dropoff_lng
+    )
+    
+    return JsonResponse({
+        'vehicle_type': quote['vehicle_type'],
+        'distance': quote['distance'],
+        'duration': quote['duration'],
+        'base_fare': str(quote['base_fare']),
+        'distance_fare': str(quote['distance_fare']),
+        'time_fare': str(quote['time_fare']),
+        'time_of_day': quote['time_of_day'],
+        'time_of_day_multiplier': str(quote['time_of_day_multiplier']),
+        'surge_multiplier': str(quote['surge_multiplier']),
+        'fare': str(quote['total']),
+        'cached': quote['cached']
+    })
+
+@staff_member_required
+def fare_quote_stats(request):
+    """
+    Report the route estimate cache hit ratio.
+    """
+    return JsonResponse(route_cache.stats())
+
+@login_required
+@rate_limit('geocode')
+def reverse_geocode(request):
+    """
+    Address of a point, for the map pins on the booking and driver screens.
+    """
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Latitude and longitude required'}, status=400)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return JsonResponse({'error': 'Coordinates out of range'}, status=400)
+
+    address, source = geocoder.reverse(lat, lng)
+    if address is None:
+        return JsonResponse({'error': 'No address found for this location'}, status=503)
+    return JsonResponse({
+        'display_name': address,
+        'lat': lat,
+        'lng': lng,
+        'cached': source != 'provider'
+    })
+
+@staff_member_required
+@use_read_replica
+def demand_heatmap(request):
+    """
+    Ride requests, completions and cancellations per pickup cell over a
+    window: the last ?minutes= (default 60), or ?since= to ?until= as ISO
+    times. ?bounds=south,west,north,east limits it to the visible map.
+    """
+    try:
+        if 'since' in request.GET:
+            since = parse_datetime(request.GET['since'])
+            until = parse_datetime(request.GET['until']) if 'until' in request.GET else timezone.now()
+            if since is None or until is None:
+                raise ValueError
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            if timezone.is_naive(until):
+                until = timezone.make_aware(until)
+        else:
+            until = timezone.now()
+            since = until - timedelta(minutes=int(request.GET.get('minutes', 60)))
+        bounds = None
+        if 'bounds' in request.GET:
+            bounds = tuple(float(value) for value in request.GET['bounds'].split(','))
+            if len(bounds) != 4:
+                raise ValueError
+            south, west, north, east = bounds
+            # nan and inf parse as floats but fail these comparisons
+            if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+                raise ValueError
+    except ValueError:
+        return JsonResponse({'error': 'Invalid window or bounds'}, status=400)
+    
+    if since >= until or until - since > timedelta(hours=settings.HEATMAP_MAX_WINDOW_HOURS):
+        return JsonResponse({
+            'error': f'The window must be positive and at most {settings.HEATMAP_MAX_WINDOW_HOURS} hours'
+        }, status=400)
+    
+    since, until, cells = heatmap.heatmap(since, until, bounds)
+    return JsonResponse({
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'cell_degrees': settings.HEATMAP_CELL_DEGREES,
+        'fields': ['row', 'col', 'requested', 'completed', 'cancelled'],
+        'cells': cells
+    })
+
+@staff_member_required
+def geocode_stats(request):
+    """
+    Report the reverse geocoding provider and memory cache size.
+    """
+    return JsonResponse(geocoder.stats())
+
+def _parse_date(value):
+    """Parse an optional YYYY-MM-DD date; raises ValueError if malformed."""
+    if not value:
+        return None
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+def _filter_rides(request, rides):
+    """
+    Apply the ride history status, date range and sort filters from the
+    query string to a ride queryset. Raises ValueError for an invalid
+    custom start or end date.
+    """
     status = request.GET.get('status', '')
     date_range = request.GET.get('date_range', 'all')
     sort_by = request.GET.get('sort_by', 'date')
     
-    # Base queryset - fix for rider view
-    if hasattr(request.user, 'driver_profile') and request.user.driver_profile is not None:
-        rides = Ride.objects.filter(driver=request.user)
-    else:
-        rides = Ride.objects.filter(rider=request.user)
-    
     # Apply status filter
     if status:
         rides = rides.filter(status=status)
@@ -112,8 +279,10 @@ def ride_history(request):
     elif date_range == 'month':
         rides = rides.filter(created_at__month=today.month, created_at__year=today.year)
     elif date_range == 'custom':
-        start_date = request.GET.get('start_date')
-        end_date = request.GET.get('end_date')
+        # Check the dates now; the queryset is only evaluated later, which
+        # for a streamed export is after the response has started
+        start_date = _parse_date(request.GET.get('start_date'))
+        end_date = _parse_date(request.GET.get('end_date'))
         if start_date:
             rides = rides.filter(created_at__date__gte=start_date)
         if end_date:
@@ -127,8 +296,35 @@ def ride_history(request):
     else:  # Default to date
         rides = rides.order_by('-created_at')
     
-    # Debug log
-    print(f"User: {request.user}, Is driver: {hasattr(request.user, 'driver_profile')}, Rides found: {rides.count()}")
+    return rides
+
+@login_required
+@use_read_replica
+def ride_history(request):
+    # Get filter parameters
+    status = request.GET.get('status', '')
+    date_range = request.GET.get('date_range', 'all')
+    sort_by = request.GET.get('sort_by', 'date')
+    
+    # Base queryset - fix for rider view
+    if hasattr(request.user, 'driver_profile') and request.user.driver_profile is not None:
+        rides = Ride.objects.filter(driver=request.user)
+    else:
+        rides = Ride.objects.filter(rider=request.user)
+    
+    try:
+        rides = _filter_rides(request, rides)
+    except ValueError:
+        messages.error(request, 'Invalid date range.')
+        rides = rides.order_by('-created_at')
+    
+    # Counting costs a query, so only when the record would be written
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Ride history', extra={
+            'user_id': request.user.id,
+            'is_driver': hasattr(request.user, 'driver_profile'),
+            'rides_found': rides.count(),
+        })
     
     # Get status choices for the filter dropdown
     status_choices = Ride.STATUS_CHOICES
@@ -144,6 +340,42 @@ def ride_history(request):
     
     return render(request, 'rides/ride_history.html', context)
 
+@login_required
+@use_read_replica
+def export_ride_history(request):
+    """
+    Stream the ride history as CSV or JSON lines, with the same filters as
+    the ride history page. Staff export every ride, optionally narrowed to
+    one rider or driver.
+    """
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'Format must be csv or jsonl'}, status=400)
+    
+    # Everything is validated before streaming starts: a bad value would
+    # otherwise only fail inside the generator, mid-response
+    try:
+        if request.user.is_staff:
+            rides = Ride.objects.all()
+            if request.GET.get('rider'):
+                rides = rides.filter(rider_id=int(request.GET['rider']))
+            if request.GET.get('driver'):
+                rides = rides.filter(driver_id=int(request.GET['driver']))
+        elif hasattr(request.user, 'driver_profile') and request.user.driver_profile is not None:
+            rides = Ride.objects.filter(driver=request.user)
+        else:
+            rides = Ride.objects.filter(rider=request.user)
+        
+        rides = _filter_rides(request, rides)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid rider, driver or date range'}, status=400)
+    
+    return stream_export(request, rides, [
+        'id', 'created_at', 'status', 'rider__username', 'driver__username',
+        'pickup_address', 'dropoff_address', 'distance', 'duration', 'fare',
+        'started_at', 'completed_at', 'cancellation_reason'
+    ], f"ride-history-{timezone.now():%Y%m%d}", export_format)
+
 @login_required
 def ride_detail(request, ride_id):
     ride = get_object_or_404(Ride, id=ride_id)
@@ -162,10 +394,16 @@ def accept_ride(request, ride_id):
     if ride.status != 'REQUESTED':
         messages.error(request, 'This ride is no longer available.')
         return redirect('dashboard')
+    
+    if settings.DISPATCH_MODE and ride.id not in offered_ride_ids(request.user):
+        messages.error(request, 'This ride was not offered to you.')
+        return redirect('dashboard')
         
-    ride.driver = request.user
-    ride.status = 'ACCEPTED'
-    ride.save()
+    if not transitions.accept_ride(ride, request.user):
+        messages.error(request, 'This ride is no longer available.')
+        return redirect('dashboard')
+    surge_engine.ride_closed(ride)
+    surge_engine.driver_busy(request.user.id)
     
     messages.success(request, 'Ride accepted successfully.')
     return redirect('ride_detail', ride_id=ride_id)
@@ -185,9 +423,9 @@ def start_ride(request, ride_id):
         return redirect('ride_detail', ride_id=ride_id)
     
     # Update ride status
-    ride.status = 'STARTED'
-    ride.started_at = timezone.now()
-    ride.save()
+    if not transitions.start_ride(ride, request.user):
+        messages.error(request, "This ride cannot be started.")
+        return redirect('ride_detail', ride_id=ride_id)
     
     # Send real-time notification to rider
     notification_msg = "Your ride has started"
@@ -217,9 +455,11 @@ def complete_ride(request, ride_id):
         return redirect('ride_detail', ride_id=ride_id)
     
     # Update ride status
-    ride.status = 'COMPLETED'
-    ride.completed_at = timezone.now()
-    ride.save()
+    if not transitions.complete_ride(ride, request.user):
+        messages.error(request, "This ride cannot be completed.")
+        return redirect('ride_detail', ride_id=ride_id)
+    _release_driver(ride.driver)
+    heatmap.record('completed', [ride], ride.completed_at)
     
     # Send real-time notification to rider
     notification_msg = f"Your ride has been completed. Fare: ₹{ride.fare}"
@@ -231,6 +471,9 @@ def complete_ride(request, ride_id):
         redirect_url=reverse('ride_detail', args=[ride_id])
     )
     
+    # Render the rider's receipt in the background; they are notified when it's ready
+    document_renderer.receipt(ride, ride.rider)
+    
     # Also send a notification to the driver
     driver_msg = f"You've completed the ride and earned ₹{ride.fare}"
     send_notification(
@@ -259,9 +502,17 @@ def cancel_ride(request, ride_id):
         return redirect('ride_detail', ride_id=ride_id)
     
     # Update ride status
-    ride.status = 'CANCELLED'
-    ride.cancelled_at = timezone.now()
-    ride.save()
+    previous_status = ride.status
+    reason = 'Cancelled by rider' if request.user == ride.rider else 'Cancelled by driver'
+    if not transitions.cancel_ride(ride, request.user, reason):
+        messages.error(request, "This ride cannot be cancelled.")
+        return redirect('ride_detail', ride_id=ride_id)
+    
+    if previous_status == 'REQUESTED':
+        surge_engine.ride_closed(ride)
+    if ride.driver:
+        _release_driver(ride.driver)
+    heatmap.record('cancelled', [ride], ride.updated_at)
     
     # Determine who cancelled and notify the other party
     if request.user == ride.rider:
@@ -287,6 +538,28 @@ def cancel_ride(request, ride_id):
     messages.success(request, f"{cancel_msg} successfully!")
     return redirect('dashboard')
 
+@login_required
+def ride_receipt(request, ride_id):
+    """
+    Download the PDF receipt of a completed ride. If it isn't rendered yet,
+    rendering starts and the user is notified when it can be downloaded.
+    """
+    ride = get_object_or_404(Ride.objects.select_related('rider', 'driver'), id=ride_id)
+    if request.user != ride.rider and request.user != ride.driver:
+        messages.error(request, 'You do not have permission to view this ride.')
+        return redirect('dashboard')
+    
+    if ride.status != 'COMPLETED':
+        messages.error(request, 'Receipts are only available for completed rides.')
+        return redirect('ride_detail', ride_id=ride_id)
+    
+    path = document_renderer.receipt(ride, request.user)
+    if path is None:
+        messages.info(request, "Your receipt is being prepared. We'll notify you when it's ready.")
+        return redirect('ride_detail', ride_id=ride_id)
+    
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'cabby-receipt-{ride.id}.pdf')
+
 @login_required
 def rate_ride(request, ride_id):
     ride = get_object_or_404(Ride, id=ride_id)
@@ -323,6 +596,7 @@ def rate_ride(request, ride_id):
     return render(request, 'rides/rate_ride.html', {'ride': ride})
 
 @login_required
+@rate_limit('polling')
 def nearby_drivers(request):
     if not request.GET.get('lat') or not request.GET.get('lng'):
         return JsonResponse({'error': 'Location parameters required'}, status=400)
@@ -330,26 +604,82 @@ def nearby_drivers(request):
     lat = float(request.GET['lat'])
     lng = float(request.GET['lng'])
     
-    # Find available drivers within 5km radius
-    available_drivers = DriverProfile.objects.filter(
-        is_available=True,
-        current_latitude__isnull=False,
-        current_longitude__isnull=False
+    # Find the nearest available drivers within 5km radius
+    candidates = find_nearest_drivers(lat, lng, radius_km=5)
+    names = {
+        user.id: user.get_full_name()
+        for user in User.objects.filter(id__in=[candidate[0] for candidate in candidates])
+    }
+    
+    # Road distance and ETA from every driver to the pickup in one matrix
+    distance, minutes = eta_service.matrix(
+        [(candidate[1], candidate[2]) for candidate in candidates],
+        [(lat, lng)]
     )
     
     nearby_drivers = []
-    for driver in available_drivers:
-        distance = calculate_distance(lat, lng, driver.current_latitude, driver.current_longitude)
-        if distance <= 5:  # 5km radius
-            nearby_drivers.append({
-                'id': driver.user.id,
-                'name': driver.user.get_full_name(),
-                'latitude': driver.current_latitude,
-                'longitude': driver.current_longitude,
-                'distance': round(distance, 1)
-            })
+    for i, (driver_id, driver_lat, driver_lng, straight_distance) in enumerate(candidates):
+        nearby_drivers.append({
+            'id': driver_id,
+            'name': names.get(driver_id, ''),
+            'latitude': driver_lat,
+            'longitude': driver_lng,
+            'distance': round(straight_distance, 1),
+            'road_distance': round(float(distance[i, 0]), 1),
+            'eta_minutes': max(1, round(float(minutes[i, 0])))
+        })
     
-    return JsonResponse({'drivers': nearby_drivers})
+    return JsonResponse({
+        'drivers': nearby_drivers,
+        'surge_multiplier': str(surge_engine.multiplier(lat, lng))
+    })
+
+@login_required
+def eta_matrix(request):
+    """
+    Travel distance and time from a set of drivers to a set of pickups.
+    
+    Expects a JSON body with 'pickups' as [[lat, lng], ...] and either
+    'driver_ids' (staff only) or 'nearest' (K drivers nearest to the first
+    pickup).
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+        
+    try:
+        data = json.loads(request.body)
+        if not 0 < len(data['pickups']) <= settings.ETA_MATRIX_MAX_PICKUPS:
+            raise ValueError
+        pickups = [(float(lat), float(lng)) for lat, lng in data['pickups']]
+        if not all(-90 <= lat <= 90 and -180 <= lng <= 180 for lat, lng in pickups):
+            raise ValueError
+        if 'driver_ids' in data:
+            # Only staff may ask about arbitrary drivers: distances from a
+            # few chosen points would give away where any driver is
+            if not request.user.is_staff:
+                return JsonResponse({'error': 'driver_ids is for staff only'}, status=403)
+            if len(data['driver_ids']) > settings.ETA_MATRIX_MAX_DRIVERS:
+                raise ValueError
+            driver_ids = [int(driver_id) for driver_id in data['driver_ids']]
+        else:
+            nearest = int(data.get('nearest', settings.ETA_NEAREST_DRIVERS))
+            if nearest < 1:
+                raise ValueError
+            nearest = min(nearest, settings.ETA_NEAREST_DRIVERS)
+            driver_ids = [candidate[0] for candidate in find_nearest_drivers(pickups[0][0], pickups[0][1], k=nearest)]
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'Pickups and driver_ids or nearest required'}, status=400)
+        
+    if len(driver_ids) * len(pickups) > settings.ETA_MATRIX_MAX_CELLS:
+        return JsonResponse({'error': 'Matrix too large'}, status=400)
+    
+    driver_ids, distance, minutes = eta_service.for_drivers(driver_ids, pickups)
+    
+    return JsonResponse({
+        'driver_ids': driver_ids,
+        'distance': distance.round(2).tolist(),
+        'minutes': minutes.round(1).tolist()
+    })
 
 @login_required
 def update_location(request):
@@ -364,12 +694,21 @@ def update_location(request):
         if not lat or not lng:
             return JsonResponse({'error': 'Location parameters required'}, status=400)
             
-        if request.user.is_driver:
-            profile = request.user.driver_profile
-            profile.current_latitude = lat
-            profile.current_longitude = lng
-            profile.location_updated_at = timezone.now()
-            profile.save()
+        if request.user.is_driver():
+            # A ping is also a heartbeat; a driver who expired stays offline
+            # until they toggle availability again
+            is_available = presence.touch(request.user.id, lat, lng)
+            if is_available:
+                surge_engine.driver_available(request.user.id, lat, lng)
+            
+            # Pings over the limit aren't rejected: the latest one is kept
+            # and written with the next flush
+            allowed, _ = rate_limiter.hit('location', request_identity(request))
+            if not allowed:
+                location_coalescer.add(request.user.id, lat, lng)
+                return JsonResponse({'success': True, 'coalesced': True, 'is_available': is_available}, status=202)
+            location_coalescer.write(request.user.id, lat, lng)
+            return JsonResponse({'success': True, 'is_available': is_available})
             
         return JsonResponse({'success': True})
         
@@ -377,31 +716,37 @@ def update_location(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 @login_required
+@rate_limit('polling')
 def available_rides(request):
     if not request.user.is_driver:
         return JsonResponse({'error': 'Only drivers can view available rides'}, status=403)
         
-    profile = request.user.driver_profile
+    is_available = presence.is_online(request.user.id)
+    position = presence.position(request.user.id)
     
     # Debug information for troubleshooting
     debug_info = {
-        'is_available': profile.is_available,
-        'has_location': bool(profile.current_latitude and profile.current_longitude),
-        'current_latitude': float(profile.current_latitude) if profile.current_latitude else None,
-        'current_longitude': float(profile.current_longitude) if profile.current_longitude else None
+        'is_available': is_available,
+        'has_location': position is not None,
+        'current_latitude': position[0] if position else None,
+        'current_longitude': position[1] if position else None
     }
     
     # Only check availability status, not location
-    if not profile.is_available:
+    if not is_available:
         return JsonResponse({'rides': [], 'debug_info': debug_info})
     
     # Find requested rides
     available_rides = []
     requested_rides = Ride.objects.filter(status='REQUESTED', driver__isnull=True)
     
+    # In dispatch mode drivers only see the rides offered to them
+    if settings.DISPATCH_MODE:
+        requested_rides = requested_rides.filter(id__in=offered_ride_ids(request.user))
+    
     debug_info['total_requested_rides'] = requested_rides.count()
     
-    if not profile.current_latitude or not profile.current_longitude:
+    if position is None:
         # If driver is available but has no location yet, show ALL rides
         # This ensures a driver without location data can still see available rides
         for ride in requested_rides:
@@ -418,35 +763,26 @@ def available_rides(request):
         debug_info['showing_all_rides'] = True
     else:
         # Normal location-based filtering with increased radius (20km instead of 10km)
-        for ride in requested_rides:
-            try:
-                distance = calculate_distance(
-                    float(profile.current_latitude), 
-                    float(profile.current_longitude),
-                    float(ride.pickup_latitude),
-                    float(ride.pickup_longitude)
-                )
-                # Increased radius from 10km to 20km for better visibility
-                if distance <= 20:  
-                    available_rides.append({
-                        'id': ride.id,
-                        'pickup_address': ride.pickup_address,
-                        'dropoff_address': ride.dropoff_address,
-                        'fare': str(ride.fare),
-                        'distance': round(distance, 1),
-                        'created_at': ride.created_at.isoformat()
-                    })
-            except (ValueError, TypeError) as e:
-                # Handle any conversion errors and still show the ride
-                available_rides.append({
-                    'id': ride.id,
-                    'pickup_address': ride.pickup_address,
-                    'dropoff_address': ride.dropoff_address,
-                    'fare': str(ride.fare),
-                    'distance': None,
-                    'created_at': ride.created_at.isoformat()
-                })
-                debug_info['distance_calculation_error'] = str(e)
+        requested_rides = list(requested_rides)
+        driver_position = position
+        pickups = [(float(ride.pickup_latitude), float(ride.pickup_longitude)) for ride in requested_rides]
+        straight = haversine_matrix([driver_position], pickups)[0] if pickups else []
+        in_range = [i for i in range(len(requested_rides)) if straight[i] <= 20]
+        
+        # Road distance and ETA to every pickup in range in one matrix row
+        distance, minutes = eta_service.matrix([driver_position], [pickups[i] for i in in_range])
+        for j, i in enumerate(in_range):
+            ride = requested_rides[i]
+            available_rides.append({
+                'id': ride.id,
+                'pickup_address': ride.pickup_address,
+                'dropoff_address': ride.dropoff_address,
+                'fare': str(ride.fare),
+                'distance': round(float(straight[i]), 1),
+                'road_distance': round(float(distance[0, j]), 1),
+                'eta_minutes': max(1, round(float(minutes[0, j]))),
+                'created_at': ride.created_at.isoformat()
+            })
     
     debug_info['rides_in_range'] = len(available_rides)
     return JsonResponse({'rides': available_rides, 'debug_info': debug_info})
@@ -466,10 +802,20 @@ def accept_ride_ajax(request, ride_id):
                 'error': 'This ride is no longer available'
             })
         
+        if settings.DISPATCH_MODE and ride.id not in offered_ride_ids(request.user):
+            return JsonResponse({
+                'success': False,
+                'error': 'This ride was not offered to you'
+            }, status=403)
+        
         # Assign the driver and update status
-        ride.driver = request.user
-        ride.status = 'ACCEPTED'
-        ride.save()
+        if not transitions.accept_ride(ride, request.user):
+            return JsonResponse({
+                'success': False,
+                'error': 'This ride is no longer available'
+            })
+        surge_engine.ride_closed(ride)
+        surge_engine.driver_busy(request.user.id)
         
         # Send real-time notification to rider
         notification_msg = f"Driver {request.user.get_full_name()} has accepted your ride request"
@@ -498,28 +844,18 @@ def accept_ride_ajax(request, ride_id):
             'error': str(e)
         }, status=500)
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    from math import sin, cos, sqrt, atan2, radians
-    
-    R = 6371  # Earth's radius in kilometers
-    
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    distance = R * c
-    
-    return distance
+def _release_driver(driver):
+    """Count a driver whose ride ended as supply again if they are online."""
+    position = presence.position(driver.id)
+    if position is not None:
+        surge_engine.driver_idle(driver.id, *position)
+    else:
+        surge_engine.driver_idle(driver.id)
 
-@login_required
-def driver_earnings(request):
-    if not request.user.is_driver:
-        return JsonResponse({'error': 'Only drivers can view earnings'}, status=403)
-        
-    period = request.GET.get('period', 'week')
+def _earnings_period(period):
+    """
+    Get the (start_date, end_date) of the current week, month or year.
+    """
     today = timezone.now().date()
     
     if period == 'week':
@@ -532,6 +868,17 @@ def driver_earnings(request):
         start_date = today.replace(month=1, day=1)
         end_date = today.replace(month=12, day=31)
     
+    return start_date, end_date
+
+@login_required
+@use_read_replica
+def driver_earnings(request):
+    if not request.user.is_driver:
+        return JsonResponse({'error': 'Only drivers can view earnings'}, status=403)
+        
+    period = request.GET.get('period', 'week')
+    start_date, end_date = _earnings_period(period)
+    
     completed_rides = Ride.objects.filter(
         driver=request.user,
         status='COMPLETED',
@@ -563,4 +910,64 @@ def driver_earnings(request):
         'total_earnings': str(total_earnings),
         'total_rides': total_rides,
         'period': period
-    })
\ No newline at end of file
+    })
+
+@login_required
+@use_read_replica
+def export_earnings(request):
+    """
+    Stream a driver's completed rides for the earnings period as CSV or JSON
+    lines. Staff can export any driver's statement with ?driver=<id>.
+    """
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': 'Format must be csv or jsonl'}, status=400)
+    
+    if request.user.is_staff and request.GET.get('driver'):
+        try:
+            driver_id = int(request.GET['driver'])
+        except ValueError:
+            return JsonResponse({'error': 'Invalid driver'}, status=400)
+    elif request.user.is_driver():
+        driver_id = request.user.id
+    else:
+        return JsonResponse({'error': 'Only drivers can export earnings'}, status=403)
+    
+    period = request.GET.get('period', 'week')
+    start_date, end_date = _earnings_period(period)
+    
+    completed_rides = Ride.objects.filter(
+        driver_id=driver_id,
+        status='COMPLETED',
+        completed_at__date__range=[start_date, end_date]
+    ).order_by('completed_at')
+    
+    return stream_export(request, completed_rides, [
+        'id', 'completed_at', 'pickup_address', 'dropoff_address',
+        'distance', 'duration', 'fare'
+    ], f"earnings-{period}-{start_date:%Y%m%d}", export_format)
+
+@login_required
+def earnings_statement(request):
+    """
+    Download a driver's monthly earnings statement as PDF (?month=YYYY-MM,
+    default this month). If it isn't rendered yet, rendering starts and the
+    driver is notified when it can be downloaded.
+    """
+    if not request.user.is_driver():
+        messages.error(request, 'Only drivers have earnings statements.')
+        return redirect('dashboard')
+    
+    try:
+        year, month = map(int, request.GET.get('month', timezone.localdate().strftime('%Y-%m')).split('-'))
+        period_start = date(year, month, 1)
+    except ValueError:
+        messages.error(request, 'Invalid statement month.')
+        return redirect('dashboard')
+    
+    path = document_renderer.statement(request.user, year, month)
+    if path is None:
+        messages.info(request, "Your statement is being prepared. We'll notify you when it's ready.")
+        return redirect('dashboard')
+    
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'cabby-statement-{period_start:%Y-%m}.pdf')